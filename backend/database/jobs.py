@@ -0,0 +1,120 @@
+import time
+from typing import List, Optional
+
+from database.redis_db import r
+from models.job import Job
+
+# ZSET of job ids waiting, scored by the time they can run, delayed jobs are just scored in the future.
+queue_key = 'jobs:queue'
+# ZSET of job ids being run, scored by when their lease expires, a worker that dies gives them back on expiry.
+running_key = 'jobs:running'
+dead_key = 'jobs:dead'
+
+# Moves expired leases back to the queue, then leases up to ARGV[3] jobs that are due.
+_claim_script = r.register_script("""
+local now = tonumber(ARGV[1])
+local lease = tonumber(ARGV[2])
+local expired = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', now, 'LIMIT', 0, 100)
+for _, id in ipairs(expired) do
+    redis.call('ZREM', KEYS[2], id)
+    redis.call('ZADD', KEYS[1], now, id)
+end
+local ids = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', now, 'LIMIT', 0, tonumber(ARGV[3]))
+for _, id in ipairs(ids) do
+    redis.call('ZREM', KEYS[1], id)
+    redis.call('ZADD', KEYS[2], now + lease, id)
+end
+return ids
+""")
+
+
+# Drops a leased job whose data is gone, and frees its idempotency key (KEYS[2] holds its name) if still its own.
+_drop_script = r.register_script("""
+local key = redis.call('GET', KEYS[2])
+if key and redis.call('GET', key) == ARGV[1] then
+    redis.call('DEL', key)
+end
+redis.call('DEL', KEYS[2])
+redis.call('ZREM', KEYS[1], ARGV[1])
+""")
+
+
+def _job_key(job_id: str) -> str:
+    return f'jobs:{job_id}'
+
+
+def _idempotency_key(key: str) -> str:
+    return f'jobs:idempotency:{key}'
+
+
+def _job_idempotency_key(job_id: str) -> str:
+    # the idempotency key of a job, to free it when the job data is gone
+    return f'jobs:{job_id}:idempotency'
+
+
+def enqueue_job(job: Job) -> Optional[str]:
+    """Returns the job id, or None if a job with the same idempotency key is already queued or running."""
+    if job.idempotency_key:
+        if not r.set(_idempotency_key(job.idempotency_key), job.id, nx=True, ex=60 * 60 * 24):
+            return None
+
+    pipe = r.pipeline()
+    pipe.set(_job_key(job.id), job.model_dump_json())
+    if job.idempotency_key:
+        pipe.set(_job_idempotency_key(job.id), _idempotency_key(job.idempotency_key), ex=60 * 60 * 24)
+    pipe.zadd(queue_key, {job.id: job.run_at.timestamp()})
+    pipe.execute()
+    return job.id
+
+
+def claim_jobs(count: int, lease_seconds: int) -> List[Job]:
+    ids = _claim_script(keys=[queue_key, running_key], args=[time.time(), lease_seconds, count])
+    if not ids:
+        return []
+    jobs = []
+    for job_id, data in zip(ids, r.mget([_job_key(job_id.decode()) for job_id in ids])):
+        if data is None:
+            # data expired or deleted, nothing to run
+            _drop_script(keys=[running_key, _job_idempotency_key(job_id.decode())], args=[job_id])
+            continue
+        jobs.append(Job.model_validate_json(data))
+    return jobs
+
+
+def complete_job(job: Job):
+    pipe = r.pipeline()
+    pipe.delete(_job_key(job.id))
+    pipe.zrem(running_key, job.id)
+    if job.idempotency_key:
+        pipe.delete(_idempotency_key(job.idempotency_key), _job_idempotency_key(job.id))
+    pipe.execute()
+
+
+def retry_job(job: Job):
+    pipe = r.pipeline()
+    pipe.set(_job_key(job.id), job.model_dump_json())
+    pipe.zrem(running_key, job.id)
+    pipe.zadd(queue_key, {job.id: job.run_at.timestamp()})
+    pipe.execute()
+
+
+def fail_job(job: Job):
+    """Out of attempts, kept a week for inspection."""
+    pipe = r.pipeline()
+    pipe.set(_job_key(job.id), job.model_dump_json(), ex=60 * 60 * 24 * 7)
+    pipe.zrem(running_key, job.id)
+    pipe.lpush(dead_key, job.id)
+    pipe.ltrim(dead_key, 0, 999)
+    if job.idempotency_key:
+        pipe.delete(_idempotency_key(job.idempotency_key), _job_idempotency_key(job.id))
+    pipe.execute()
+
+
+def get_jobs_stats() -> dict:
+    pipe = r.pipeline()
+    pipe.zcount(queue_key, '-inf', time.time())
+    pipe.zcard(queue_key)
+    pipe.zcard(running_key)
+    pipe.llen(dead_key)
+    ready, queued, running, dead = pipe.execute()
+    return {'ready': ready, 'delayed': queued - ready, 'running': running, 'dead': dead}
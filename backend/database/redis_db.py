@@ -2,7 +2,7 @@ import base64
 import json
 import os
 from datetime import datetime, timezone
-from typing import List, Union
+from typing import List, Optional, Union
 
 import redis
 
@@ -128,6 +128,18 @@ def remove_user_soniox_speech_profile(uid: str):
     r.delete(f'users:{uid}:has_soniox_speech_profile')
 
 
+def set_speech_profile_generation(uid: str, generation: int, ttl: int = 60 * 60 * 24):
+    # 0 means the user has no speech profile
+    r.set(f'users:{uid}:speech_profile_generation', generation, ex=ttl)
+
+
+def get_speech_profile_generation(uid: str):
+    generation = r.get(f'users:{uid}:speech_profile_generation')
+    if generation is None:
+        return None
+    return int(generation)
+
+
 def cache_user_name(uid: str, name: str, ttl: int = 60 * 60 * 24 * 7):
     r.set(f'users:{uid}:name', name)
     r.expire(f'users:{uid}:name', ttl)
@@ -224,6 +236,28 @@ def get_in_progress_memory_id(uid: str) -> str:
     return memory_id.decode()
 
 
+# LISTEN SESSIONS
+@try_catch_decorator
+def set_listen_session_checkpoint(session_token: str, checkpoint: dict, audio: bytes, ttl: int):
+    pipe = r.pipeline()
+    pipe.set(f'listen_sessions:{session_token}', json.dumps(checkpoint, default=str), ex=ttl)
+    pipe.set(f'listen_sessions:{session_token}:audio', audio, ex=ttl)
+    pipe.execute()
+
+
+@try_catch_decorator
+def get_listen_session_checkpoint(session_token: str):
+    checkpoint, audio = r.mget([f'listen_sessions:{session_token}', f'listen_sessions:{session_token}:audio'])
+    if not checkpoint:
+        return None
+    return json.loads(checkpoint), audio or b''
+
+
+@try_catch_decorator
+def remove_listen_session_checkpoint(session_token: str):
+    r.delete(f'listen_sessions:{session_token}', f'listen_sessions:{session_token}:audio')
+
+
 def set_user_webhook_db(uid: str, wtype: str, url: str):
     r.set(f'users:{uid}:developer:webhook:{wtype}', url)
 
@@ -247,6 +281,23 @@ def get_user_webhook_db(uid: str, wtype: str) -> str:
     return url.decode()
 
 
+def get_realtime_targets_data(uid: str, wtype: str):
+    """Enabled plugins, the cached plugins list, and the webhook status and url of `wtype`, in one round trip."""
+    plugins_key = base64.b64encode('get_plugins_data'.encode('utf-8')).decode('utf-8')
+    pipe = r.pipeline(transaction=False)
+    pipe.smembers(f'users:{uid}:enabled_plugins')
+    pipe.get(f'cache:{plugins_key}')
+    pipe.get(f'users:{uid}:developer:webhook_status:{wtype}')
+    pipe.get(f'users:{uid}:developer:webhook:{wtype}')
+    enabled, plugins, status, url = pipe.execute()
+    return (
+        [x.decode() for x in enabled or []],
+        json.loads(plugins) if plugins else None,
+        status.decode() == str(True).lower() if status is not None else None,
+        url.decode() if url else '',
+    )
+
+
 def get_filter_category_items(uid: str, category: str) -> List[str]:
     val = r.smembers(f'users:{uid}:filters:{category}')
     if not val:
@@ -264,3 +315,187 @@ def remove_filter_category_item(uid: str, category: str, item: str):
 
 def remove_all_filter_category_items(uid: str, category: str):
     r.delete(f'users:{uid}:filters:{category}')
+
+
+# LLM CACHE
+@try_catch_decorator
+def get_llm_cache(key: str):
+    data = r.get(f'llm_cache:{key}')
+    return json.loads(data) if data else None
+
+
+@try_catch_decorator
+def set_llm_cache(key: str, generations: List[str], ttl: int):
+    r.set(f'llm_cache:{key}', json.dumps(generations), ex=ttl)
+
+
+@try_catch_decorator
+def get_embeddings_cache(keys: List[str]) -> List[bytes]:
+    return r.mget([f'embeddings_cache:{key}' for key in keys])
+
+
+@try_catch_decorator
+def set_embeddings_cache(vectors: dict, ttl: int):
+    pipe = r.pipeline(transaction=False)
+    for key, vector in vectors.items():
+        pipe.set(f'embeddings_cache:{key}', vector, ex=ttl)
+    pipe.execute()
+
+
+# MEMORY FACETS
+@try_catch_decorator
+def set_memory_facets(uid: str, memory_id: str, facets: dict):
+    r.hset(f'users:{uid}:memory_facets', memory_id, json.dumps(facets))
+
+
+@try_catch_decorator
+def get_memory_facets(uid: str, memory_ids: List[str]) -> List[Optional[dict]]:
+    if not memory_ids:
+        return []
+    values = r.hmget(f'users:{uid}:memory_facets', memory_ids)
+    return [json.loads(value) if value else None for value in values]
+
+
+# FACET INDEX
+def _facet_index_key(uid: str, category: str, field: str) -> str:
+    return f'users:{uid}:facets:{category}:{field}'
+
+
+@try_catch_decorator
+def update_facet_index(uid: str, category: str, increments: dict, seen_at: int):
+    """Adds `increments` (value -> +/- count) to the user facets, values reaching 0 are removed."""
+    pipe = r.pipeline(transaction=False)
+    for value, increment in increments.items():
+        pipe.hincrby(_facet_index_key(uid, category, 'count'), value, increment)
+    counts = pipe.execute()
+
+    pipe = r.pipeline(transaction=False)
+    removed = [value for value, count in zip(increments, counts) if count <= 0]
+    added = [value for value, increment in increments.items() if increment > 0 and value not in removed]
+    if removed:
+        pipe.hdel(_facet_index_key(uid, category, 'count'), *removed)
+        pipe.hdel(_facet_index_key(uid, category, 'seen'), *removed)
+    if added:
+        pipe.hset(_facet_index_key(uid, category, 'seen'), mapping={value: seen_at for value in added})
+    pipe.incr(f'users:{uid}:facets:version')
+    pipe.execute()
+
+
+@try_catch_decorator
+def get_facet_index(uid: str, category: str) -> dict:
+    """value -> (count, last seen timestamp)"""
+    pipe = r.pipeline(transaction=False)
+    pipe.hgetall(_facet_index_key(uid, category, 'count'))
+    pipe.hgetall(_facet_index_key(uid, category, 'seen'))
+    counts, seen = pipe.execute()
+    return {value.decode(): (int(count), int(seen.get(value, 0))) for value, count in counts.items()}
+
+
+# Replaces the facets counted for a memory (KEYS[1] hash, field ARGV[1]) by the ARGV[2] ones, in the count and seen
+# hashes of each category, KEYS[4..], so running it again for the same facets changes nothing. KEYS[1] is only
+# written here, the memory_facets hash is also filled from the vector metadata, with facets that weren't counted.
+_update_memory_facet_index_script = r.register_script("""
+local function as_set(values)
+    local set = {}
+    if type(values) == 'table' then
+        for _, value in ipairs(values) do
+            if value ~= '' then set[value] = true end
+        end
+    end
+    return set
+end
+
+local previous = redis.call('HGET', KEYS[1], ARGV[1])
+if previous then
+    previous = cjson.decode(previous)
+else
+    previous = {}
+    redis.call('INCR', KEYS[3])
+end
+local facets = cjson.decode(ARGV[2])
+local changed = false
+for i = 4, #ARGV do
+    local category = ARGV[i]
+    local counts, seen = KEYS[2 * i - 4], KEYS[2 * i - 3]
+    local before, after = as_set(previous[category]), as_set(facets[category])
+    for value in pairs(after) do
+        if not before[value] then
+            changed = true
+            if redis.call('HINCRBY', counts, value, 1) <= 0 then
+                redis.call('HDEL', counts, value)
+                redis.call('HDEL', seen, value)
+            else
+                redis.call('HSET', seen, value, ARGV[3])
+            end
+        end
+    end
+    for value in pairs(before) do
+        if not after[value] then
+            changed = true
+            if redis.call('HINCRBY', counts, value, -1) <= 0 then
+                redis.call('HDEL', counts, value)
+                redis.call('HDEL', seen, value)
+            end
+        end
+    end
+end
+if changed then
+    redis.call('INCR', KEYS[2])
+end
+redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+""")
+
+
+@try_catch_decorator
+def update_memory_facet_index(uid: str, memory_id: str, facets: dict, seen_at: int):
+    """
+    Counts the memory `facets` (category -> values) in the user facets, replacing the ones counted for it before,
+    atomically. A memory seen for the first time is added to the memories count.
+    """
+    categories = list(facets)
+    keys = [f'users:{uid}:facets:counted', f'users:{uid}:facets:version', f'users:{uid}:facets:memories']
+    for category in categories:
+        keys += [_facet_index_key(uid, category, 'count'), _facet_index_key(uid, category, 'seen')]
+    _update_memory_facet_index_script(keys=keys, args=[memory_id, json.dumps(facets), seen_at] + categories)
+
+
+@try_catch_decorator
+def claim_facet_index_migration(uid: str) -> bool:
+    """True for the first caller only, the one that migrates the user filter sets."""
+    return bool(r.set(f'users:{uid}:facets:migrated', 1, nx=True))
+
+
+@try_catch_decorator
+def get_facet_index_version(uid: str) -> int:
+    version = r.get(f'users:{uid}:facets:version')
+    return int(version) if version else 0
+
+
+@try_catch_decorator
+def incr_facet_index_memories(uid: str, amount: int = 1):
+    r.incrby(f'users:{uid}:facets:memories', amount)
+
+
+@try_catch_decorator
+def get_facet_index_memories(uid: str) -> int:
+    count = r.get(f'users:{uid}:facets:memories')
+    return int(count) if count else 0
+
+
+# shared by all users, dropped this long after being embedded, and embedded again if still used
+facet_vectors_ttl = 60 * 60 * 24 * 30
+
+
+@try_catch_decorator
+def get_facet_vectors(values: List[str]) -> List[Optional[bytes]]:
+    if not values:
+        return []
+    return r.mget([f'facet_vectors:{value}' for value in values])
+
+
+@try_catch_decorator
+def set_facet_vectors(vectors: dict):
+    pipe = r.pipeline(transaction=False)
+    for value, vector in vectors.items():
+        pipe.set(f'facet_vectors:{value}', vector, ex=facet_vectors_ttl)
+    pipe.execute()
@@ -1,20 +1,40 @@
 import json
 import os
+import time
 from collections import defaultdict
 from datetime import datetime, timezone
-from typing import List
+from typing import Dict, List
 
 from pinecone import Pinecone
 
+from database import redis_db
+from database.vector_store import VectorStore, PineconeVectorStore, LocalVectorStore
 from models.memory import Memory
 from utils.llm import embeddings
+from utils.llm_cache import LRU
+from utils.other import metrics
 
-if os.getenv('PINECONE_API_KEY') is not None:
+# pinecone, or local to keep the vectors on this host disk, see LocalVectorStore, only when asked for explicitly.
+vector_store = os.getenv('VECTOR_STORE') or 'pinecone'
+
+if vector_store == 'local':
+    index: VectorStore = LocalVectorStore(os.getenv('VECTOR_STORE_PATH', '_vectors'))
+elif os.getenv('PINECONE_API_KEY') is not None:
     pc = Pinecone(api_key=os.getenv('PINECONE_API_KEY', ''))
-    index = pc.Index(os.getenv('PINECONE_INDEX_NAME', ''))
+    index: VectorStore = PineconeVectorStore(pc.Index(os.getenv('PINECONE_INDEX_NAME', '')))
 else:
     index = None
 
+# Memories returned by query_vectors_by_metadata, out of the nearest `retrieval_candidates` re-ranked by their facets,
+# widened up to `retrieval_max_candidates` when too few mention what was asked for.
+retrieval_results = 5
+retrieval_candidates = int(os.getenv('RETRIEVAL_CANDIDATES', 50))
+retrieval_max_candidates = int(os.getenv('RETRIEVAL_MAX_CANDIDATES', 800))
+# people, topics and entities of each memory, also kept in Redis, see _memory_facets
+_facet_keys = ['people', 'topics', 'entities']
+_facets_cache = LRU(int(os.getenv('MEMORY_FACETS_CACHE_SIZE', 20000)))
+facets_cache_seconds = 60 * 10
+
 
 def _get_data(uid: str, memory_id: str, vector: List[float]):
     return {
@@ -37,12 +57,16 @@ def upsert_vector2(uid: str, memory: Memory, vector: List[float], metadata: dict
     data = _get_data(uid, memory.id, vector)
     data['metadata'].update(metadata)
     res = index.upsert(vectors=[data], namespace="ns1")
+    redis_db.set_memory_facets(uid, memory.id, _get_facets(metadata))
+    _facets_cache.set((uid, memory.id), None)
     print('upsert_vector', res)
 
 
 def update_vector_metadata(uid: str, memory_id: str, metadata: dict):
     metadata['uid'] = uid
     metadata['memory_id'] = memory_id
+    redis_db.set_memory_facets(uid, memory_id, _get_facets(metadata))
+    _facets_cache.set((uid, memory_id), None)
     return index.update(f'{uid}-{memory_id}', set_metadata=metadata, namespace="ns1")
 
 
@@ -69,6 +93,74 @@ def query_vectors(query: str, uid: str, starts_at: int = None, ends_at: int = No
     return [item['id'].replace(f'{uid}-', '') for item in xc['matches']]
 
 
+def _get_facets(metadata: dict) -> dict:
+    return {key: metadata.get(key) or [] for key in _facet_keys}
+
+
+def _memory_facets(uid: str, vector: List[float], memory_ids: List[str]) -> Dict[str, dict]:
+    """Facet sets of the memories, from the local cache, then Redis, then the index metadata (and cached)."""
+    now = time.time()
+    facets = {}
+    for memory_id in memory_ids:
+        cached = _facets_cache.get((uid, memory_id))
+        if cached and now - cached[0] < facets_cache_seconds:
+            facets[memory_id] = cached[1]
+
+    missing = [memory_id for memory_id in memory_ids if memory_id not in facets]
+    for memory_id, data in zip(missing, redis_db.get_memory_facets(uid, missing) or [None] * len(missing)):
+        if data:
+            facets[memory_id] = {key: set(data.get(key, [])) for key in _facet_keys}
+            _facets_cache.set((uid, memory_id), (now, facets[memory_id]))
+
+    # vectors stored before the facets were, their metadata is fetched once
+    missing = [memory_id for memory_id in memory_ids if memory_id not in facets]
+    if missing:
+        xc = index.query(
+            vector=vector, filter={'$and': [{'uid': {'$eq': uid}}, {'memory_id': {'$in': missing}}]},
+            namespace="ns1", include_metadata=True, top_k=len(missing)
+        )
+        for item in xc['matches']:
+            memory_id = item['metadata']['memory_id']
+            data = _get_facets(item['metadata'])
+            redis_db.set_memory_facets(uid, memory_id, data)
+            facets[memory_id] = {key: set(data[key]) for key in _facet_keys}
+            _facets_cache.set((uid, memory_id), (now, facets[memory_id]))
+    return facets
+
+
+def _query_and_rank(uid: str, vector: List[float], filter_data: dict, k: int, max_k: int, people: List[str],
+                    topics: List[str], entities: List[str]) -> List[str]:
+    """
+    Stage one, the `k` nearest memories matching the filter, ids only. Stage two, re-ranked by how many of the
+    people, topics and entities asked for they mention. k is widened while the page is full and too few candidates
+    mention any of them, the ones further down could.
+    """
+    wanted = {'people': people, 'topics': topics, 'entities': entities}
+    while True:
+        xc = index.query(
+            vector=vector, filter=filter_data, namespace="ns1", include_values=False, include_metadata=False, top_k=k
+        )
+        memories_id = [item['id'].replace(f'{uid}-', '') for item in xc['matches']]
+        if not memories_id or not (people or topics or entities):
+            return memories_id
+
+        facets = _memory_facets(uid, vector, memories_id)
+        memory_id_to_matches = defaultdict(int)
+        for memory_id in memories_id:
+            memory_facets = facets.get(memory_id)
+            if not memory_facets:
+                continue
+            for key, values in wanted.items():
+                memory_id_to_matches[memory_id] += sum(1 for value in values if value in memory_facets[key])
+
+        matched = sum(1 for memory_id in memories_id if memory_id_to_matches[memory_id])
+        if matched >= retrieval_results or len(memories_id) < k or k >= max_k:
+            memories_id.sort(key=lambda x: memory_id_to_matches[x], reverse=True)
+            return memories_id
+        k = min(k * 4, max_k)
+        metrics.incr('retrieval_k_widened')
+
+
 def query_vectors_by_metadata(
         uid: str, vector: List[float], dates_filter: List[datetime], people: List[str], topics: List[str],
         entities: List[str], dates: List[str]
@@ -85,48 +177,29 @@ def query_vectors_by_metadata(
                 # {'dates': {'$in': dates_mentioned}},
             ]}
         )
-    if dates_filter:
+    if dates_filter and dates_filter[0] and dates_filter[1]:
         filter_data['$and'].append(
             {'created_at': {'$gte': int(dates_filter[0].timestamp()), '$lte': int(dates_filter[1].timestamp())}}
         )
 
     print('query_vectors_by_metadata:', json.dumps(filter_data))
 
-    xc = index.query(
-        vector=vector, filter=filter_data, namespace="ns1", include_values=False,
-        include_metadata=True,
-        top_k=10000
+    start = time.time()
+    memories_id = _query_and_rank(
+        uid, vector, filter_data, retrieval_candidates, retrieval_max_candidates, people, topics, entities
     )
-    if not xc['matches']:
+    if not memories_id:
         if len(filter_data['$and']) == 3:
             filter_data['$and'].pop(1)
             print('query_vectors_by_metadata retrying without structured filters:', json.dumps(filter_data))
-            xc = index.query(
-                vector=vector, filter=filter_data, namespace="ns1", include_values=False,
-                include_metadata=True,
-                top_k=20
-            )
+            # none of the people, topics or entities in the dates range, no point in widening
+            memories_id = _query_and_rank(uid, vector, filter_data, 20, 20, people, topics, entities)
         else:
             return []
+    metrics.observe('retrieval_seconds', time.time() - start)
 
-    memory_id_to_matches = defaultdict(int)
-    for item in xc['matches']:
-        metadata = item['metadata']
-        memory_id = metadata['memory_id']
-        for topic in topics:
-            if topic in metadata.get('topics', []):
-                memory_id_to_matches[memory_id] += 1
-        for entity in entities:
-            if entity in metadata.get('entities', []):
-                memory_id_to_matches[memory_id] += 1
-        for person in people:
-            if person in metadata.get('people_mentioned', []):
-                memory_id_to_matches[memory_id] += 1
-
-    memories_id = [item['id'].replace(f'{uid}-', '') for item in xc['matches']]
-    memories_id.sort(key=lambda x: memory_id_to_matches[x], reverse=True)
-    print('query_vectors_by_metadata result:', memories_id)
-    return memories_id[:5] if len(memories_id) > 5 else memories_id
+    print('query_vectors_by_metadata result:', memories_id[:retrieval_results])
+    return memories_id[:retrieval_results]
 
 
 def delete_vector(memory_id: str):
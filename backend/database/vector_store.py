@@ -0,0 +1,354 @@
+import fcntl
+import hashlib
+import json
+import os
+import threading
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+import numpy as np
+
+
+class VectorStore(ABC):
+    """
+    The part of the Pinecone index API the backend uses. `query` returns {'matches': [{'id', 'score', 'metadata',
+    'values'}]}, filters use the Pinecone metadata filter language.
+    """
+
+    @abstractmethod
+    def upsert(self, vectors: List[dict], namespace: str):
+        pass
+
+    @abstractmethod
+    def update(self, id: str, set_metadata: dict, namespace: str):
+        pass
+
+    @abstractmethod
+    def query(self, vector: List[float], top_k: int, namespace: str, filter: Optional[dict] = None,
+              include_metadata: bool = False, include_values: bool = False) -> dict:
+        pass
+
+    @abstractmethod
+    def delete(self, ids: List[str], namespace: str):
+        pass
+
+
+class PineconeVectorStore(VectorStore):
+    def __init__(self, index):
+        self.index = index
+
+    def upsert(self, vectors: List[dict], namespace: str):
+        return self.index.upsert(vectors=vectors, namespace=namespace)
+
+    def update(self, id: str, set_metadata: dict, namespace: str):
+        return self.index.update(id, set_metadata=set_metadata, namespace=namespace)
+
+    def query(self, vector: List[float], top_k: int, namespace: str, filter: Optional[dict] = None,
+              include_metadata: bool = False, include_values: bool = False) -> dict:
+        return self.index.query(vector=vector, top_k=top_k, namespace=namespace, filter=filter,
+                                include_metadata=include_metadata, include_values=include_values)
+
+    def delete(self, ids: List[str], namespace: str):
+        return self.index.delete(ids=ids, namespace=namespace)
+
+
+# *************************************************
+# ************* METADATA FILTERS ******************
+# *************************************************
+
+def _compare(value, op: str, operand) -> bool:
+    # list fields (people, topics...) match when any of their items does, as in Pinecone
+    values = value if isinstance(value, list) else [value]
+    if op == '$eq':
+        return operand in values
+    if op == '$ne':
+        return operand not in values
+    if op == '$in':
+        return any(v in operand for v in values)
+    if op == '$nin':
+        return not any(v in operand for v in values)
+    if value is None:
+        return False
+    if op == '$gt':
+        return value > operand
+    if op == '$gte':
+        return value >= operand
+    if op == '$lt':
+        return value < operand
+    if op == '$lte':
+        return value <= operand
+    raise ValueError(f'Unsupported filter operator {op}')
+
+
+def matches_filter(metadata: dict, filter: Optional[dict]) -> bool:
+    if not filter:
+        return True
+    for key, condition in filter.items():
+        if key == '$and':
+            if not all(matches_filter(metadata, f) for f in condition):
+                return False
+        elif key == '$or':
+            if not any(matches_filter(metadata, f) for f in condition):
+                return False
+        elif isinstance(condition, dict):
+            value = metadata.get(key)
+            for op, operand in condition.items():
+                if value is None and op not in ('$ne', '$nin'):
+                    return False
+                if not _compare(value, op, operand):
+                    return False
+        elif key not in metadata or not _compare(metadata[key], '$eq', condition):
+            return False
+    return True
+
+
+def _filter_uid(filter: Optional[dict]) -> Optional[str]:
+    """The uid every match must have, if the filter requires one, to only search that uid partition."""
+    if not filter:
+        return None
+    condition = filter.get('uid')
+    if isinstance(condition, str):
+        return condition
+    if isinstance(condition, dict) and isinstance(condition.get('$eq'), str):
+        return condition['$eq']
+    for f in filter.get('$and', []):
+        if uid := _filter_uid(f):
+            return uid
+    return None
+
+
+# *************************************************
+# ************* LOCAL VECTOR STORE ****************
+# *************************************************
+
+class _Partition:
+    """
+    Vectors of a uid: float32 rows appended to `vectors.f32`, memory-mapped for queries, and an append-only log of
+    metadata changes. Upserting an id again appends a new row, the file is compacted when half of it is stale.
+
+    Several processes can share a partition: every operation holds a lock on the `lock` file, shared to read and
+    exclusive to write, and first reads what the others appended to the log since, or all of it after a compaction.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.vectors_path = os.path.join(path, 'vectors.f32')
+        self.log_path = os.path.join(path, 'log.jsonl')
+        self.lock_path = os.path.join(path, 'lock')
+        self.dim = None
+        self.size = 0
+        self.rows: Dict[str, int] = {}
+        self.metadata: Dict[str, dict] = {}
+        self._matrix = None
+        self._log_inode = None
+        self._log_offset = 0
+
+    @contextmanager
+    def _locked(self, exclusive: bool):
+        if exclusive:
+            os.makedirs(self.path, exist_ok=True)
+        elif not os.path.isdir(self.path):
+            yield
+            return
+        with open(self.lock_path, 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                self._refresh()
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _reset(self):
+        self.dim = None
+        self.size = 0
+        self.rows, self.metadata = {}, {}
+        self._matrix = None
+        self._log_inode, self._log_offset = None, 0
+
+    def _refresh(self):
+        try:
+            stat = os.stat(self.log_path)
+        except FileNotFoundError:
+            self._reset()
+            return
+        # compacted by another process since it was read
+        if stat.st_ino != self._log_inode or stat.st_size < self._log_offset:
+            self._reset()
+            self._log_inode = stat.st_ino
+        if stat.st_size > self._log_offset:
+            with open(self.log_path) as f:
+                f.seek(self._log_offset)
+                for line in f:
+                    if line.strip():
+                        self._apply(json.loads(line))
+                self._log_offset = f.tell()
+        if self.dim:
+            self.size = os.path.getsize(self.vectors_path) // (4 * self.dim)
+
+    def _apply(self, entry: dict):
+        id = entry['id']
+        if entry.get('deleted'):
+            self.rows.pop(id, None)
+            self.metadata.pop(id, None)
+        elif 'row' in entry:
+            self.dim = entry['dim']
+            self.rows[id] = entry['row']
+            self.metadata[id] = dict(entry['metadata'])
+        elif id in self.metadata:
+            self.metadata[id].update(entry['metadata'])
+
+    def _log(self, entries: List[dict]):
+        with open(self.log_path, 'a') as f:
+            for entry in entries:
+                self._apply(entry)
+                f.write(json.dumps(entry) + '\n')
+            self._log_inode, self._log_offset = os.fstat(f.fileno()).st_ino, f.tell()
+
+    def matrix(self) -> np.ndarray:
+        if self._matrix is None or self._matrix.shape[0] != self.size:
+            self._matrix = np.memmap(self.vectors_path, dtype=np.float32, mode='r', shape=(self.size, self.dim)) \
+                if self.size else np.zeros((0, self.dim or 0), dtype=np.float32)
+        return self._matrix
+
+    def contains(self, id: str) -> bool:
+        with self._locked(False):
+            return id in self.rows
+
+    def candidates(self, filter: Optional[dict], include_metadata: bool):
+        """Ids matching the filter, their rows, metadata and the matrix holding them, None if there are none."""
+        with self._locked(False):
+            ids = [id for id, metadata in self.metadata.items() if matches_filter(metadata, filter)]
+            if not ids:
+                return None
+            rows = [self.rows[id] for id in ids]
+            metadata = [dict(self.metadata[id]) for id in ids] if include_metadata else None
+            return ids, rows, metadata, self.matrix()
+
+    def upsert(self, vectors: List[dict]):
+        values = np.asarray([v['values'] for v in vectors], dtype=np.float32)
+        with self._locked(True):
+            if self.dim is not None and values.shape[1] != self.dim:
+                raise ValueError(f'Vector dimension {values.shape[1]} does not match the index dimension {self.dim}')
+            with open(self.vectors_path, 'ab') as f:
+                f.write(values.tobytes())
+            entries = [
+                {'id': v['id'], 'row': self.size + i, 'dim': values.shape[1], 'metadata': v.get('metadata', {})}
+                for i, v in enumerate(vectors)
+            ]
+            self.size += len(vectors)
+            self._log(entries)
+            if self.size > 64 and len(self.rows) < self.size / 2:
+                self._compact()
+
+    def update(self, id: str, set_metadata: dict):
+        with self._locked(True):
+            if id in self.rows:
+                self._log([{'id': id, 'metadata': set_metadata}])
+
+    def delete(self, ids: List[str]):
+        with self._locked(True):
+            self._log([{'id': id, 'deleted': True} for id in ids if id in self.rows])
+
+    def _compact(self):
+        ids = list(self.rows)
+        values = np.asarray(self.matrix()[[self.rows[id] for id in ids]])
+        self._matrix = None
+        with open(self.vectors_path + '.tmp', 'wb') as f:
+            f.write(values.tobytes())
+        with open(self.log_path + '.tmp', 'w') as f:
+            for row, id in enumerate(ids):
+                f.write(json.dumps({'id': id, 'row': row, 'dim': self.dim, 'metadata': self.metadata[id]}) + '\n')
+        os.replace(self.vectors_path + '.tmp', self.vectors_path)
+        os.replace(self.log_path + '.tmp', self.log_path)
+        stat = os.stat(self.log_path)
+        self._log_inode, self._log_offset = stat.st_ino, stat.st_size
+        self.rows = {id: row for row, id in enumerate(ids)}
+        self.size = len(ids)
+
+
+class LocalVectorStore(VectorStore):
+    """
+    Embedded vector store, one partition per uid under `path`, exact (brute force) cosine top-k over the vectors
+    matching the filter. For local development, tests, and deployments small enough to skip Pinecone. Processes
+    sharing `path` on the same host see each other's writes, see _Partition, a network filesystem isn't supported.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._partitions: Dict[str, _Partition] = {}
+        self._lock = threading.RLock()
+
+    def _partition(self, namespace: str, uid: str) -> _Partition:
+        folder = hashlib.sha256(uid.encode('utf-8')).hexdigest()[:32]
+        return self._partition_at(os.path.join(self.path, namespace, folder))
+
+    def _partition_at(self, path: str) -> _Partition:
+        if path not in self._partitions:
+            self._partitions[path] = _Partition(path)
+        return self._partitions[path]
+
+    def _all_partitions(self, namespace: str) -> List[_Partition]:
+        folder = os.path.join(self.path, namespace)
+        if not os.path.isdir(folder):
+            return []
+        return [self._partition_at(os.path.join(folder, name)) for name in sorted(os.listdir(folder))]
+
+    def _find(self, id: str, namespace: str) -> Optional[_Partition]:
+        # ids are {uid}-{memory_id}, uids have no dashes
+        uid = id.split('-')[0]
+        partition = self._partition(namespace, uid)
+        if partition.contains(id):
+            return partition
+        return next((p for p in self._all_partitions(namespace) if p.contains(id)), None)
+
+    def upsert(self, vectors: List[dict], namespace: str):
+        with self._lock:
+            by_uid = {}
+            for vector in vectors:
+                by_uid.setdefault(vector.get('metadata', {}).get('uid', ''), []).append(vector)
+            for uid, items in by_uid.items():
+                self._partition(namespace, uid).upsert(items)
+        return {'upserted_count': len(vectors)}
+
+    def update(self, id: str, set_metadata: dict, namespace: str):
+        with self._lock:
+            if partition := self._find(id, namespace):
+                partition.update(id, set_metadata)
+        return {}
+
+    def delete(self, ids: List[str], namespace: str):
+        with self._lock:
+            for id in ids:
+                if partition := self._find(id, namespace):
+                    partition.delete([id])
+        return {}
+
+    def query(self, vector: List[float], top_k: int, namespace: str, filter: Optional[dict] = None,
+              include_metadata: bool = False, include_values: bool = False) -> dict:
+        with self._lock:
+            uid = _filter_uid(filter)
+            partitions = [self._partition(namespace, uid)] if uid else self._all_partitions(namespace)
+            candidates = []
+            for partition in partitions:
+                if found := partition.candidates(filter, include_metadata):
+                    candidates.append(found)
+
+        query = np.asarray(vector, dtype=np.float32)
+        query /= np.linalg.norm(query) or 1
+        matches = []
+        for ids, rows, metadata, matrix in candidates:
+            values = matrix[rows]
+            norms = np.linalg.norm(values, axis=1)
+            norms[norms == 0] = 1
+            scores = values @ query / norms
+            top = np.argpartition(-scores, top_k - 1)[:top_k] if len(ids) > top_k else np.arange(len(ids))
+            for i in top:
+                match = {'id': ids[i], 'score': float(scores[i])}
+                if include_metadata:
+                    match['metadata'] = metadata[i]
+                if include_values:
+                    match['values'] = values[i].tolist()
+                matches.append(match)
+        matches.sort(key=lambda m: m['score'], reverse=True)
+        return {'matches': matches[:top_k], 'namespace': namespace}
@@ -2,11 +2,13 @@ import json
 import os
 
 import firebase_admin
-from fastapi import FastAPI
+from fastapi import FastAPI, Depends
 
 from modal import Image, App, asgi_app, Secret, Cron
 from routers import workflow, chat, firmware, plugins, memories, transcribe_v2, notifications, \
     speech_profile, agents, facts, users, processing_memories, trends, sdcard, sync
+from utils.other import metrics
+from utils.other.endpoints import verify_admin_key
 from utils.other.notifications import start_cron_job
 
 if os.environ.get('SERVICE_ACCOUNT_JSON'):
@@ -71,6 +73,12 @@ async def notifications_cronjob():
     await start_cron_job()
 
 
+@app.get('/metrics', dependencies=[Depends(verify_admin_key)])
+def get_metrics():
+    # per container, ingest queue depth/lag/drops of the listen sessions among others
+    return metrics.snapshot()
+
+
 @app.post('/webhook')
 async def webhook(data: dict):
     diarization = data['output']['diarization']
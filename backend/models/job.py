@@ -0,0 +1,30 @@
+from datetime import datetime
+from enum import Enum
+from typing import Optional
+
+from pydantic import BaseModel
+
+
+class JobType(str, Enum):
+    memory_vector = 'memory_vector'
+    memory_facts = 'memory_facts'
+    memory_created_webhook = 'memory_created_webhook'
+    day_summary_webhook = 'day_summary_webhook'
+    delete_postprocessing_audio = 'delete_postprocessing_audio'
+    delete_syncing_temporal_file = 'delete_syncing_temporal_file'
+
+
+class Job(BaseModel):
+    id: str
+    type: JobType
+    uid: Optional[str] = None
+    memory_id: Optional[str] = None
+    payload: dict = {}
+
+    # at most one job with the same key is queued or running, memory jobs use memory_id:type
+    idempotency_key: Optional[str] = None
+    attempts: int = 0
+    max_attempts: int = 5
+    created_at: datetime
+    run_at: datetime
+    last_error: Optional[str] = None
@@ -2,7 +2,7 @@ from datetime import datetime
 from enum import Enum
 from typing import List, Optional, Dict
 
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, PrivateAttr
 
 from models.chat import Message
 from models.transcript_segment import TranscriptSegment
@@ -170,6 +170,14 @@ class Memory(BaseModel):
     processing_memory_id: Optional[str] = None
     status: Optional[MemoryStatus] = MemoryStatus.completed
 
+    # rendered transcripts, see get_transcript
+    _transcripts: dict = PrivateAttr(default_factory=dict)
+
+    def __setattr__(self, name, value):
+        if name == 'transcript_segments':
+            self.invalidate_transcript()
+        super().__setattr__(name, value)
+
     @staticmethod
     def memories_to_string(memories: List['Memory'], use_transcript: bool = False) -> str:
         result = []
@@ -197,9 +205,27 @@ class Memory(BaseModel):
 
         return "\n\n---------------------\n\n".join(result).strip()
 
-    def get_transcript(self, include_timestamps: bool) -> str:
+    def get_transcript(self, include_timestamps: bool, compact: bool = False) -> str:
+        """
+        Rendered once per memory, the plugins and every LLM prompt of a memory use it. Setting transcript_segments
+        resets it, in place changes of a segment must call invalidate_transcript.
+        """
         # Warn: missing transcript for workflow source
-        return TranscriptSegment.segments_as_string(self.transcript_segments, include_timestamps=include_timestamps)
+        segments = self.transcript_segments
+        # appends without invalidating are still caught
+        version = (id(segments), len(segments), segments[-1].end if segments else None)
+        key = (include_timestamps, compact)
+        cached = self._transcripts.get(key)
+        if cached and cached[0] == version:
+            return cached[1]
+        transcript = TranscriptSegment.segments_as_string(
+            segments, include_timestamps=include_timestamps, compact=compact
+        )
+        self._transcripts[key] = (version, transcript)
+        return transcript
+
+    def invalidate_transcript(self):
+        self._transcripts.clear()
 
     def as_dict_cleaned_dates(self):
         memory_dict = self.dict()
@@ -224,8 +250,10 @@ class CreateMemory(BaseModel):
 
     processing_memory_id: Optional[str] = None
 
-    def get_transcript(self, include_timestamps: bool) -> str:
-        return TranscriptSegment.segments_as_string(self.transcript_segments, include_timestamps=include_timestamps)
+    def get_transcript(self, include_timestamps: bool, compact: bool = False) -> str:
+        return TranscriptSegment.segments_as_string(
+            self.transcript_segments, include_timestamps=include_timestamps, compact=compact
+        )
 
 
 class WorkflowMemorySource(str, Enum):
@@ -243,7 +271,7 @@ class WorkflowCreateMemory(BaseModel):
     source: MemorySource = MemorySource.workflow
     language: Optional[str] = None
 
-    def get_transcript(self, include_timestamps: bool) -> str:
+    def get_transcript(self, include_timestamps: bool, compact: bool = False) -> str:
         return self.text
 
 
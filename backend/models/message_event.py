@@ -64,3 +64,13 @@ class MemoryBackwardSycnedEvent(MessageEvent):
         j = self.model_dump(mode="json")
         j["type"] = self.event_type
         return j
+
+
+class ListenSessionEvent(MessageEvent):
+    session_token: str
+    resumed: bool = False
+
+    def to_json(self):
+        j = self.model_dump(mode="json")
+        j["type"] = self.event_type
+        return j
@@ -1,8 +1,20 @@
+import bisect
+import re
 from datetime import timedelta
-from typing import Optional, List
+from typing import Optional, List, Tuple
 
 from pydantic import BaseModel, Field
 
+# lowercase, or capitalized starting a sentence, "UM" is a name, hyphenated words are left alone except "mm-hmm"
+_filler_words = re.compile(
+    r'(?<![\w-])(?:[Uu]u*h+m*|[Uu]u*m+|[Ee]e*r+m+|[Hh]h*m+|[Mm]m*-?hm+|[Mm]m+|[Aa]a*h+)(?![\w-])[,.]?\s*'
+)
+# stutters only, of the words people stumble on and never repeat on purpose, other repetitions are content:
+# "very very important", "no no no", "had had", "5 5 5", "B B C"
+_repeated_words = re.compile(
+    r'\b(I|an|the|and|but|to|it|we|you|he|she|they|my|this)(?:\s+\1\b)+(?![\w-])', re.IGNORECASE
+)
+
 
 class TranscriptSegment(BaseModel):
     text: str
@@ -23,66 +35,143 @@ class TranscriptSegment(BaseModel):
         return f'{str(start_duration).split(".")[0]} - {str(end_duration).split(".")[0]}'
 
     @staticmethod
-    def segments_as_string(segments, include_timestamps=False, user_name: str = None):
+    def segments_as_string(segments, include_timestamps=False, user_name: str = None, compact: bool = False):
         if not user_name:
             user_name = 'User'
-        transcript = ''
+        if compact:
+            segments = TranscriptSegment.compact(segments)
         include_timestamps = include_timestamps and TranscriptSegment.can_display_seconds(segments)
+        lines = []
         for segment in segments:
             segment_text = segment.text.strip()
             timestamp_str = f'[{segment.get_timestamp_string()}] ' if include_timestamps else ''
-            transcript += f'{timestamp_str}{user_name if segment.is_user else f"Speaker {segment.speaker_id}"}: {segment_text}\n\n'
-        return transcript.strip()
+            lines.append(f'{timestamp_str}{user_name if segment.is_user else f"Speaker {segment.speaker_id}"}: {segment_text}')
+        return '\n\n'.join(lines).strip()
 
     @staticmethod
     def can_display_seconds(segments):
-        for i in range(len(segments)):
-            for j in range(i + 1, len(segments)):
-                if segments[i].start > segments[j].end or segments[i].end > segments[j].start:
-                    return False
+        # no segment starts or ends before an earlier one ends or starts, checked against the running maximums
+        max_start, max_end = float('-inf'), float('-inf')
+        for segment in segments:
+            if max_start > segment.end or max_end > segment.start:
+                return False
+            max_start, max_end = max(max_start, segment.start), max(max_end, segment.end)
         return True
 
+    @staticmethod
+    def compact(segments, max_gap_seconds: float = 30) -> List['TranscriptSegment']:
+        """
+        Copy of `segments` with less tokens for the LLM, filler words and stutters removed, empty and repeated
+        segments dropped, and consecutive turns of the same speaker merged.
+        """
+        compacted = []
+        previous_text = None  # of the last segment kept, repeated segments are compared whole
+        for segment in segments:
+            text = _repeated_words.sub(r'\1', _filler_words.sub('', segment.text)).strip()
+            if not text.strip('.,?!- '):
+                continue
+            if compacted and (compacted[-1].speaker == segment.speaker or (compacted[-1].is_user and segment.is_user)):
+                last = compacted[-1]
+                if segment.start - last.end < max_gap_seconds:
+                    if text.lower() == previous_text:
+                        continue
+                    compacted[-1] = last.model_copy(update={'text': f'{last.text} {text}', 'end': segment.end})
+                    previous_text = text.lower()
+                    continue
+            compacted.append(segment.model_copy(update={'text': text}))
+            previous_text = text.lower()
+        return compacted
+
     @staticmethod
     def combine_segments(segments: [], new_segments: [], delta_seconds: int = 0):
+        """Merges `new_segments` into `segments`, normalizing all of them, see TranscriptSegmentStore for live sessions."""
         if not new_segments or len(new_segments) == 0:
             return segments
 
-        joined_similar_segments = []
-        for new_segment in new_segments:
-            if delta_seconds > 0:
-                new_segment.start += delta_seconds
-                new_segment.end += delta_seconds
-
-            if (joined_similar_segments and
-                    (joined_similar_segments[-1].speaker == new_segment.speaker or
-                     (joined_similar_segments[-1].is_user and new_segment.is_user))):
-                joined_similar_segments[-1].text += f' {new_segment.text}'
-                joined_similar_segments[-1].end = new_segment.end
-            else:
-                joined_similar_segments.append(new_segment)
-
-        if (segments and
-                (segments[-1].speaker == joined_similar_segments[0].speaker or
-                 (segments[-1].is_user and joined_similar_segments[0].is_user)) and
-                (joined_similar_segments[0].start - segments[-1].end < 30)):
-            segments[-1].text += f' {joined_similar_segments[0].text}'
-            segments[-1].end = joined_similar_segments[0].end
-            joined_similar_segments.pop(0)
-
-        segments.extend(joined_similar_segments)
-
-        # Speechmatics specific issue with punctuation
+        _merge_segments(segments, new_segments, delta_seconds)
         for i, segment in enumerate(segments):
-            segments[i].text = (
-                segments[i].text.strip()
-                .replace('  ', '')
-                .replace(' ,', ',')
-                .replace(' .', '.')
-                .replace(' ?', '?')
-            )
+            segments[i].text = _normalize_text(segments[i].text)
         return segments
 
 
+def _merge_segments(segments: List[TranscriptSegment], new_segments: List[TranscriptSegment], delta_seconds: int) -> int:
+    """Appends `new_segments` to `segments` joining same speaker turns, returns the index of the first changed one."""
+    joined_similar_segments = []
+    for new_segment in new_segments:
+        if delta_seconds > 0:
+            new_segment.start += delta_seconds
+            new_segment.end += delta_seconds
+
+        if (joined_similar_segments and
+                (joined_similar_segments[-1].speaker == new_segment.speaker or
+                 (joined_similar_segments[-1].is_user and new_segment.is_user))):
+            joined_similar_segments[-1].text += f' {new_segment.text}'
+            joined_similar_segments[-1].end = new_segment.end
+        else:
+            joined_similar_segments.append(new_segment)
+
+    first_changed = len(segments)
+    if (segments and
+            (segments[-1].speaker == joined_similar_segments[0].speaker or
+             (segments[-1].is_user and joined_similar_segments[0].is_user)) and
+            (joined_similar_segments[0].start - segments[-1].end < 30)):
+        segments[-1].text += f' {joined_similar_segments[0].text}'
+        segments[-1].end = joined_similar_segments[0].end
+        joined_similar_segments.pop(0)
+        first_changed -= 1
+
+    segments.extend(joined_similar_segments)
+    return first_changed
+
+
+def _normalize_text(text: str) -> str:
+    # Speechmatics specific issue with punctuation
+    return (
+        text.strip()
+        .replace('  ', '')
+        .replace(' ,', ',')
+        .replace(' .', '.')
+        .replace(' ?', '?')
+    )
+
+
+class TranscriptSegmentStore:
+    """
+    Segments of a live session, combined as `TranscriptSegment.combine_segments` does, with the same result, but only
+    the merged and new segments are normalized on each update (normalizing is idempotent), instead of all of them.
+
+    Segments only change at the tail, every update bumps `version`, and `delta(version)` returns what changed since.
+    The store owns `segments` and updates it in place.
+    """
+
+    def __init__(self, segments: Optional[List[TranscriptSegment]] = None):
+        self.segments = segments if segments is not None else []
+        self.version = 0
+        # the segments before it are normalized, the ones given might not be, they are on the first update
+        self._normalized = 0
+        # version each segment was last changed at, non-decreasing as only the tail changes
+        self._segment_versions = [0] * len(self.segments)
+
+    def add(self, new_segments: List[TranscriptSegment], delta_seconds: int = 0) -> int:
+        if not new_segments:
+            return self.version
+
+        first_changed = min(_merge_segments(self.segments, new_segments, delta_seconds), self._normalized)
+        for i in range(first_changed, len(self.segments)):
+            self.segments[i].text = _normalize_text(self.segments[i].text)
+        self._normalized = len(self.segments)
+
+        self.version += 1
+        del self._segment_versions[first_changed:]
+        self._segment_versions.extend([self.version] * (len(self.segments) - first_changed))
+        return self.version
+
+    def delta(self, since_version: int) -> Tuple[int, List[TranscriptSegment]]:
+        """Index from which segments changed after `since_version`, and the segments from it, to replace the tail."""
+        start = bisect.bisect_right(self._segment_versions, since_version)
+        return start, self.segments[start:]
+
+
 class ImprovedTranscriptSegment(BaseModel):
     speaker_id: int = Field(..., description='The correctly assigned speaker id')
     text: str = Field(..., description='The corrected text of the segment')
@@ -1,17 +1,22 @@
+import json
+import queue
+import threading
 import uuid
 from datetime import datetime, timezone
 from typing import List, Optional
 
 from fastapi import APIRouter, Depends, HTTPException
+from fastapi.responses import StreamingResponse
 
 import database.chat as chat_db
 from database.plugins import record_plugin_usage
-from models.chat import Message, SendMessageRequest, MessageSender
+from models.chat import Message, SendMessageRequest, MessageSender, MessageMemory
 from models.plugin import UsageHistoryType
 from utils.llm import initial_chat_message
+from utils.llm_scheduler import llm_priority, LLMPriority
 from utils.other import endpoints as auth
 from utils.plugins import get_plugin_by_id
-from utils.retrieval.graph import execute_graph_chat
+from utils.retrieval.graph import execute_graph_chat, execute_graph_chat_stream
 
 router = APIRouter()
 
@@ -42,21 +47,92 @@ def send_message(
     messages = list(reversed([Message(**msg) for msg in chat_db.get_messages(uid, limit=10)]))
     response, memories = execute_graph_chat(uid, messages)
 
-    ai_message = Message(
+    ai_message = _ai_message(response, plugin_id, memories)
+    chat_db.add_message(uid, ai_message.dict())
+    ai_message.memories = memories if len(memories) < 5 else memories[:5]
+    if plugin_id:
+        record_plugin_usage(uid, plugin_id, UsageHistoryType.chat_message_sent, message_id=ai_message.id)
+
+    return ai_message
+
+
+def _ai_message(text: str, plugin_id: Optional[str], memories) -> Message:
+    return Message(
         id=str(uuid.uuid4()),
-        text=response,
+        text=text,
         created_at=datetime.now(timezone.utc),
         sender='ai',
         plugin_id=plugin_id,
         type='text',
         memories_id=[m.id for m in (memories if len(memories) < 5 else memories[:5])],
     )
+
+
+def _sse(event: dict) -> str:
+    data = json.dumps(event, default=lambda o: o.isoformat() if isinstance(o, datetime) else str(o))
+    return f'data: {data}\n\n'
+
+
+def _stream_answer(
+        uid: str, plugin_id: Optional[str], messages: List[Message], human_saved: threading.Thread,
+        events: queue.Queue
+):
+    text, memories = '', []
+    try:
+        for event in execute_graph_chat_stream(uid, messages):
+            if event['type'] == 'memories':
+                memories = event['memories'][:5]
+                event = {'type': 'memories', 'memories': [MessageMemory(**m.dict()).dict() for m in memories]}
+            elif event['type'] == 'delta':
+                text += event['text']
+            events.put(event)
+        ai_message = _ai_message(text, plugin_id, memories)
+        events.put({'type': 'done', 'message': ai_message.dict()})
+    except Exception as e:
+        print('send_message_stream failed', uid, e)
+        events.put({'type': 'error'})
+        return
+    finally:
+        events.put(None)
+
+    # saved once the client has the whole answer, it is even if the client is gone
+    human_saved.join()
     chat_db.add_message(uid, ai_message.dict())
-    ai_message.memories = memories if len(memories) < 5 else memories[:5]
     if plugin_id:
         record_plugin_usage(uid, plugin_id, UsageHistoryType.chat_message_sent, message_id=ai_message.id)
 
-    return ai_message
+
+@router.post('/v1/messages/stream', tags=['chat'])
+def send_message_stream(
+        data: SendMessageRequest, plugin_id: Optional[str] = None, uid: str = Depends(auth.get_current_user_uid)
+):
+    """
+    Same as POST /v1/messages, as server-sent events: `progress` (retrieval steps), `memories`, `delta` (answer
+    text), then `done` with the message, or `error`.
+    """
+    print('send_message_stream', data.text, plugin_id, uid)
+    message = Message(
+        id=str(uuid.uuid4()), text=data.text, created_at=datetime.now(timezone.utc), sender='human', type='text'
+    )
+    # saved while the answer is generated, the history is read without it
+    human_saved = threading.Thread(target=chat_db.add_message, args=(uid, message.dict()))
+    human_saved.start()
+    plugin = get_plugin_by_id(plugin_id)
+    plugin_id = plugin.id if plugin else None
+
+    history = [Message(**msg) for msg in chat_db.get_messages(uid, limit=10) if msg['id'] != message.id][:9]
+    messages = list(reversed(history)) + [message]
+
+    events = queue.Queue()
+    threading.Thread(
+        target=_stream_answer, args=(uid, plugin_id, messages, human_saved, events), daemon=True
+    ).start()
+
+    def stream():
+        while (event := events.get()) is not None:
+            yield _sse(event)
+
+    return StreamingResponse(stream(), media_type='text/event-stream', headers={'Cache-Control': 'no-cache'})
 
 
 @router.delete('/v1/messages', tags=['chat'], response_model=Message)
@@ -69,7 +145,8 @@ def clear_chat_messages(uid: str = Depends(auth.get_current_user_uid)):
 
 def initial_message_util(uid: str, plugin_id: Optional[str] = None):
     plugin = get_plugin_by_id(plugin_id)
-    text = initial_chat_message(uid, plugin)
+    with llm_priority(LLMPriority.interactive, uid):
+        text = initial_chat_message(uid, plugin)
 
     ai_message = Message(
         id=str(uuid.uuid4()),
@@ -5,7 +5,8 @@ import database.redis_db as redis_db
 from database.vector_db import delete_vector
 from models.memory import *
 from routers.speech_profile import expand_speech_profile
-from routers.transcribe_v2 import retrieve_in_progress_memory
+from utils.llm_cache import bypass_llm_cache
+from utils.memories.in_progress import retrieve_in_progress_memory
 from utils.memories.process_memory import process_memory
 from utils.other import endpoints as auth
 from utils.other.storage import get_memory_recording_if_exists, \
@@ -64,7 +65,9 @@ def reprocess_memory(
     if not language_code:
         language_code = memory.language or 'en'
 
-    return process_memory(uid, language_code, memory, force_process=True, is_reprocess=True)
+    # the user asked for it, don't hand back the cached llm responses
+    with bypass_llm_cache():
+        return process_memory(uid, language_code, memory, force_process=True, is_reprocess=True)
 
 
 @router.get('/v1/memories', response_model=List[Memory], tags=['memories'])
@@ -199,6 +202,7 @@ def set_assignee_memory_segment(
     else:
         print(assign_type)
         raise HTTPException(status_code=400, detail="Invalid assign type")
+    memory.invalidate_transcript()
 
     memories_db.update_memory_segments(uid, memory_id, [segment.dict() for segment in memory.transcript_segments])
     segment_words = len(memory.transcript_segments[segment_idx].text.split(' '))
@@ -1,3 +1,4 @@
+import struct
 import uuid
 from datetime import datetime, timezone, timedelta
 from enum import Enum
@@ -38,19 +39,29 @@ async def _websocket_util_transcript(
     websocket_active = True
     websocket_close_code = 1000
 
-    loop = asyncio.get_event_loop()
-
     # task
     async def receive_segments():
         nonlocal websocket_active
         nonlocal websocket_close_code
 
+        last_batch_id = 0
         try:
             while websocket_active:
-                segments = await websocket.receive_json()
-                #print(f"pusher received segments {len(segments)}")
-                asyncio.run_coroutine_threadsafe(trigger_realtime_integrations(uid, segments), loop)
-                asyncio.run_coroutine_threadsafe(realtime_transcript_webhook(uid, segments), loop)
+                data = await websocket.receive_json()
+                # batches {batch_id, segments} are acked, plain lists of segments are from older backends
+                batch_id = None
+                if isinstance(data, dict):
+                    batch_id, segments = data['batch_id'], data['segments']
+                else:
+                    segments = data
+                if batch_id is None or batch_id > last_batch_id:
+                    #print(f"pusher received segments {len(segments)}")
+                    # both only queue the segments on the shared fan-out, requests run on this loop
+                    await trigger_realtime_integrations(uid, segments)
+                    await realtime_transcript_webhook(uid, segments)
+                if batch_id is not None:
+                    last_batch_id = max(last_batch_id, batch_id)
+                    await websocket.send_json({"type": "ack", "batch_id": batch_id})
 
         except WebSocketDisconnect:
             print("WebSocket disconnected")
@@ -105,7 +116,7 @@ async def websocket_endpoint_transcript(
 
 
 async def _websocket_util_audio_bytes(
-        websocket: WebSocket, uid: str, sample_rate: int = 8000,
+        websocket: WebSocket, uid: str, sample_rate: int = 8000, ack: bool = False,
 ):
     print('_websocket_util_audio_bytes', uid)
 
@@ -129,11 +140,20 @@ async def _websocket_util_audio_bytes(
         nonlocal websocket_close_code
 
         audiobuffer = bytearray()
+        last_batch_id = 0
 
         try:
             while websocket_active:
                 data = await websocket.receive_bytes()
                 #print(f"pusher received audio bytes {len(data)}")
+                if ack:
+                    # 8 bytes batch id, then the pcm
+                    batch_id = struct.unpack('<Q', data[:8])[0]
+                    await websocket.send_json({"type": "ack", "batch_id": batch_id})
+                    if batch_id <= last_batch_id:
+                        continue
+                    last_batch_id = batch_id
+                    data = memoryview(data)[8:]
                 audiobuffer.extend(data)
                 if audio_bytes_webhook_delay_seconds and len(
                         audiobuffer) > sample_rate * audio_bytes_webhook_delay_seconds * 2:
@@ -187,6 +207,6 @@ async def _websocket_util_audio_bytes(
 
 @router.websocket("/v1/trigger/audio-bytes/listen")
 async def websocket_endpoint_audio_bytes(
-        websocket: WebSocket, uid: str, sample_rate: int = 8000,
+        websocket: WebSocket, uid: str, sample_rate: int = 8000, ack: bool = False,
 ):
-    await _websocket_util_audio_bytes(websocket, uid, sample_rate)
+    await _websocket_util_audio_bytes(websocket, uid, sample_rate, ack)
@@ -1,20 +1,21 @@
 import os
 import struct
 import threading
-import time
 from datetime import datetime
 from typing import List
 
 from fastapi import APIRouter, UploadFile, File, Depends, HTTPException
-from opuslib import Decoder
 from pydub import AudioSegment
 
 from database.memories import get_closest_memory_to_timestamps, update_memory_segments
+from models.job import JobType
 from models.memory import CreateMemory
 from models.transcript_segment import TranscriptSegment
+from utils.audio import get_codec
+from utils.jobs import enqueue_job
 from utils.memories.process_memory import process_memory
 from utils.other import endpoints as auth
-from utils.other.storage import get_syncing_file_temporal_signed_url, delete_syncing_temporal_file
+from utils.other.storage import get_syncing_file_temporal_signed_url
 from utils.stt.pre_recorded import fal_whisperx, fal_postprocessing
 from utils.stt.vad import vad_is_empty
 
@@ -25,9 +26,9 @@ import wave
 
 
 def decode_opus_file_to_wav(opus_file_path, wav_file_path, sample_rate=16000, channels=1):
-    decoder = Decoder(sample_rate, channels)
+    decoder = get_codec('opus', sample_rate, channels)
     with open(opus_file_path, 'rb') as f:
-        pcm_data = []
+        pcm_data = bytearray()
         frame_count = 0
         while True:
             length_bytes = f.read(4)
@@ -45,19 +46,17 @@ def decode_opus_file_to_wav(opus_file_path, wav_file_path, sample_rate=16000, ch
                 print(f"Unexpected end of file at frame {frame_count}.")
                 break
             try:
-                pcm_frame = decoder.decode(opus_data, frame_size=160)
-                pcm_data.append(pcm_frame)
+                pcm_data.extend(decoder.decode(opus_data))
                 frame_count += 1
             except Exception as e:
                 print(f"Error decoding frame {frame_count}: {e}")
                 break
         if pcm_data:
-            pcm_bytes = b''.join(pcm_data)
             with wave.open(wav_file_path, 'wb') as wav_file:
                 wav_file.setnchannels(channels)
                 wav_file.setsampwidth(2)  # 16-bit audio
                 wav_file.setframerate(sample_rate)
-                wav_file.writeframes(pcm_bytes)
+                wav_file.writeframes(pcm_data)
             print(f"Decoded audio saved to {wav_file_path}")
         else:
             print("No PCM data was decoded.")
@@ -152,11 +151,8 @@ def retrieve_vad_segments(path: str, segmented_paths: set):
 def process_segment(path: str, uid: str, response: dict):
     url = get_syncing_file_temporal_signed_url(path)
 
-    def delete_file():
-        time.sleep(480)
-        delete_syncing_temporal_file(path)
-
-    threading.Thread(target=delete_file).start()
+    # FAL downloads the file from the signed url, give it time before deleting it
+    enqueue_job(JobType.delete_syncing_temporal_file, uid=uid, payload={'file_path': path}, delay_seconds=480)
 
     words, language = fal_whisperx(url, 3, 2, True)
     transcript_segments: List[TranscriptSegment] = fal_postprocessing(words, 0)
@@ -1,26 +1,33 @@
-import uuid
-from datetime import datetime, timezone, timedelta
+from datetime import datetime, timezone
 from enum import Enum
+from typing import Optional
 
-import opuslib
-import webrtcvad
 from fastapi import APIRouter
 from fastapi.websockets import WebSocketDisconnect, WebSocket
-from pydub import AudioSegment
 from starlette.websockets import WebSocketState
 
 import database.memories as memories_db
 from database import redis_db
 from database.redis_db import get_cached_user_geolocation
-from models.memory import Memory, TranscriptSegment, MemoryStatus, Structured, Geolocation
-from models.message_event import MemoryEvent, MessageEvent
+from models.memory import Memory, MemoryStatus, Geolocation
+from models.message_event import MemoryEvent, MessageEvent, ListenSessionEvent
+from utils.audio import get_codec
+from utils.memories.in_progress import InProgressMemoryBuffer, retrieve_in_progress_memory
 from utils.memories.location import get_google_maps_location
 from utils.memories.process_memory import process_memory
+from utils.other import metrics
 from utils.plugins import trigger_external_integrations, trigger_realtime_integrations
+from utils.stt.failover import STTProviderRouter
+from utils.stt.ingest import TranscriptIngestQueue, persistence_executor
+from utils.stt.session import AudioTail, new_session_token, save_session_checkpoint, get_session_checkpoint
+from utils.stt.speech_gate import get_speech_gate
+from utils.stt.speech_profile import get_speech_profile_pcm
 from utils.stt.streaming import *
 from utils.webhooks import send_audio_bytes_developer_webhook, realtime_transcript_webhook, \
     get_audio_bytes_webhook_seconds
-from utils.pusher import connect_to_transcript_pusher, connect_to_audio_bytes_pusher
+from utils.pusher import connect_to_transcript_pusher, connect_to_audio_bytes_pusher, PusherForwarder, \
+    encode_transcript_batch, encode_audio_bytes_batch, pusher_transcript_flush_seconds, pusher_audio_flush_seconds, \
+    pusher_max_pending_segments, pusher_max_pending_audio_seconds
 
 router = APIRouter()
 
@@ -29,8 +36,7 @@ class STTService(str, Enum):
     deepgram = "deepgram"
     soniox = "soniox"
     speechmatics = "speechmatics"
-
-    # auto = "auto"
+    auto = "auto"
 
     @staticmethod
     def get_model_name(value):
@@ -40,27 +46,16 @@ class STTService(str, Enum):
             return 'soniox_streaming'
         elif value == STTService.speechmatics:
             return 'speechmatics_streaming'
-
-
-def retrieve_in_progress_memory(uid):
-    memory_id = redis_db.get_in_progress_memory_id(uid)
-    existing = None
-
-    if memory_id:
-        existing = memories_db.get_memory(uid, memory_id)
-        if existing and existing['status'] != 'in_progress':
-            existing = None
-
-    if not existing:
-        existing = memories_db.get_in_progress_memory(uid)
-    return existing
+        elif value == STTService.auto:
+            return 'auto_streaming'
 
 
 async def _websocket_util(
         websocket: WebSocket, uid: str, language: str = 'en', sample_rate: int = 8000, codec: str = 'pcm8',
-        channels: int = 1, include_speech_profile: bool = True, stt_service: STTService = STTService.soniox
+        channels: int = 1, include_speech_profile: bool = True, stt_service: STTService = STTService.soniox,
+        session_token: Optional[str] = None,
 ):
-    print('_websocket_util', uid, language, sample_rate, codec, include_speech_profile)
+    print('_websocket_util', uid, language, sample_rate, codec, include_speech_profile, session_token)
 
     # Not when comes from the phone, and only Friend's with 1.0.4
     if stt_service == STTService.soniox and language not in soniox_valid_languages:
@@ -72,28 +67,49 @@ async def _websocket_util(
         print(e)
         await websocket.close(code=1011, reason="Dirty state")
         return
+    connected_at = time.time()
+    first_transcript_received = False
 
-    # Initiate a separate vad for each websocket
-    w_vad = webrtcvad.Vad()
-    w_vad.set_mode(1)
-
-    # A  frame must be either 10, 20, or 30 ms in duration
-    def _has_speech(data, sample_rate):
-        sample_size = 320 if sample_rate == 16000 else 160
-        offset = 0
-        while offset < len(data):
-            sample = data[offset:offset + sample_size]
-            if len(sample) < sample_size:
-                sample = sample + bytes([0x00] * (sample_size - len(sample) % sample_size))
-            has_speech = w_vad.is_speech(sample, sample_rate)
-            if has_speech:
-                return True
-            offset += sample_size
-        return False
+    # Initiate a separate speech gate for each websocket, it keeps the partial frames between packets
+    speech_gate = get_speech_gate(sample_rate)
 
     # Stream transcript
     loop = asyncio.get_event_loop()
     memory_creation_timeout = 120
+    memory_buffer = InProgressMemoryBuffer(uid, language)
+
+    # Resume a dropped session, the checkpoint aligns the segments and its audio tail is replayed
+    resume_checkpoint, resume_audio = None, b''
+    if session_token:
+        resume_checkpoint, resume_audio = get_session_checkpoint(session_token, uid, sample_rate)
+        print('_websocket_util resume', session_token, resume_checkpoint)
+
+    # Speech profile preamble, before the live audio, so deepgram and speechmatics can tell the user apart, soniox
+    # identifies the user itself
+    # TODO: how bee does for recognizing other languages speech profile
+    file_path, speech_profile_duration = None, 0
+    if language == 'en' and (codec == 'opus' or codec == 'pcm16') and include_speech_profile \
+            and stt_service in (STTService.deepgram, STTService.speechmatics):
+        try:
+            file_path, profile_duration, profile_sample_rate = await loop.run_in_executor(
+                persistence_executor, get_speech_profile_pcm, uid
+            )
+            if file_path and profile_sample_rate == sample_rate:
+                speech_profile_duration = profile_duration + 5
+        except Exception as e:
+            print(f'_websocket_util speech profile unavailable: {e}')
+
+    # With the preamble, provider times are shifted from the audio sent, and deepgram splits the live audio between
+    # two sockets, segments can't be placed on the audio_tail timeline: these sessions are not resumed nor checkpointed
+    if speech_profile_duration and resume_checkpoint:
+        print('_websocket_util not resuming a session with speech profile', session_token)
+        resume_checkpoint, resume_audio = None, b''
+    if not resume_checkpoint:
+        session_token = new_session_token()
+
+    # Audio sent to the STT provider, and provider seconds up to which segments were received
+    audio_tail = AudioTail(sample_rate)
+    acked_seconds = 0
 
     async def _send_message_event(msg: MessageEvent):
         print(f"Message: type ${msg.event_type}")
@@ -113,8 +129,11 @@ async def _websocket_util(
             await asyncio.sleep(delay_seconds)
 
             # recheck session
-            memory = retrieve_in_progress_memory(uid)
-            if not memory or memory['finished_at'] > finished_at:
+            memory_finished_at = memory_buffer.finished_at
+            if memory_finished_at is None:
+                memory = retrieve_in_progress_memory(uid)
+                memory_finished_at = memory['finished_at'] if memory else None
+            if not memory_finished_at or memory_finished_at > finished_at:
                 print(f"_trigger_create_memory_with_delay not memory or not last session")
                 return
             await _create_current_memory()
@@ -166,7 +185,8 @@ async def _websocket_util(
         seconds_to_trim = None
         seconds_to_add = None
 
-        memory = retrieve_in_progress_memory(uid)
+        memory = await loop.run_in_executor(persistence_executor, memory_buffer.detach)
+        memory = memory.dict() if memory else retrieve_in_progress_memory(uid)
         if not memory or not memory['transcript_segments']:
             return
         await _create_memory(memory)
@@ -180,8 +200,13 @@ async def _websocket_util(
     # Determine previous disconnected socket seconds to add + start processing timer if a memory in progress
     if existing_memory := retrieve_in_progress_memory(uid):
         # segments seconds alignment
-        started_at = datetime.fromisoformat(existing_memory['started_at'].isoformat())
-        seconds_to_add = (datetime.now(timezone.utc) - started_at).total_seconds()
+        if resume_checkpoint and resume_checkpoint['memory_id'] == existing_memory['id'] \
+                and resume_checkpoint['seconds_to_add'] is not None:
+            seconds_to_add = resume_checkpoint['seconds_to_add']
+            seconds_to_trim = 0
+        else:
+            started_at = datetime.fromisoformat(existing_memory['started_at'].isoformat())
+            seconds_to_add = (datetime.now(timezone.utc) - started_at).total_seconds()
 
         # processing if needed logic
         finished_at = datetime.fromisoformat(existing_memory['finished_at'].isoformat())
@@ -196,33 +221,6 @@ async def _websocket_util(
                 _trigger_create_memory_with_delay(memory_creation_timeout - seconds_since_last_segment, finished_at)
             )
 
-    def _get_or_create_in_progress_memory(segments: List[dict]):
-        if existing := retrieve_in_progress_memory(uid):
-            # print('_get_or_create_in_progress_memory existing', existing['id'])
-            memory = Memory(**existing)
-            memory.transcript_segments = TranscriptSegment.combine_segments(
-                memory.transcript_segments, [TranscriptSegment(**segment) for segment in segments]
-            )
-            redis_db.set_in_progress_memory_id(uid, memory.id)
-            return memory
-
-        started_at = datetime.now(timezone.utc) - timedelta(seconds=segments[0]['end'] - segments[0]['start'])
-        memory = Memory(
-            id=str(uuid.uuid4()),
-            uid=uid,
-            structured=Structured(),
-            language=language,
-            created_at=started_at,
-            started_at=started_at,
-            finished_at=datetime.now(timezone.utc),
-            transcript_segments=[TranscriptSegment(**segment) for segment in segments],
-            status=MemoryStatus.in_progress,
-        )
-        print('_get_in_progress_memory new', memory)
-        memories_db.upsert_memory(uid, memory_data=memory.dict())
-        redis_db.set_in_progress_memory_id(uid, memory.id)
-        return memory
-
     async def create_memory_on_segment_received_task(finished_at: datetime):
         nonlocal memory_creation_task
         async with memory_creation_task_lock:
@@ -236,80 +234,56 @@ async def _websocket_util(
                 _trigger_create_memory_with_delay(memory_creation_timeout, finished_at))
 
     async def create_pusher_task_handler():
-        nonlocal websocket_active
-
         # Transcript
-        transcript_ws = await connect_to_transcript_pusher(uid)
-        segment_buffers = []
-
-        def transcript_send(segments):
-            nonlocal segment_buffers
-            segment_buffers.extend(segments)
-
-        async def transcript_consume():
-            nonlocal websocket_active
-            nonlocal segment_buffers
-            while websocket_active:
-                await asyncio.sleep(1)
-                if len(segment_buffers) > 0:
-                    try:
-                        await transcript_ws.send(json.dumps(segment_buffers))
-                        segment_buffers = []
-                    except websockets.exceptions.ConnectionClosed as e:
-                        print(f"Pusher transcripts Connection closed: {e}")
-                    except Exception as e:
-                        print(f"Pusher transcripts failed: {e}")
+        transcript_forwarder = PusherForwarder(
+            'transcript', lambda: connect_to_transcript_pusher(uid), encode_transcript_batch,
+            flush_size=20, flush_seconds=pusher_transcript_flush_seconds, max_pending=pusher_max_pending_segments,
+        )
+        transcript_forwarder.start()
 
         # Audio bytes
-        audio_bytes_ws = None
-        audio_buffers = bytearray()
+        audio_bytes_forwarder = None
         audio_bytes_webhook_delay_seconds = get_audio_bytes_webhook_seconds(uid)
         if audio_bytes_webhook_delay_seconds:
-            audio_bytes_ws = await connect_to_audio_bytes_pusher(uid, sample_rate)
-
-        def audio_bytes_send(audio_bytes):
-            nonlocal audio_buffers
-            audio_buffers.extend(audio_bytes)
-
-        async def audio_bytes_consume():
-            nonlocal websocket_active
-            nonlocal audio_buffers
-            while websocket_active:
-                await asyncio.sleep(1)
-                if len(audio_buffers) > 0:
-                    try:
-                        await audio_bytes_ws.send(audio_buffers.copy())
-                        audio_buffers = bytearray()
-                    except websockets.exceptions.ConnectionClosed as e:
-                        print(f"Pusher audio_bytes Connection closed: {e}")
-                    except Exception as e:
-                        print(f"Pusher audio_bytes failed: {e}")
+            audio_bytes_forwarder = PusherForwarder(
+                'audio_bytes', lambda: connect_to_audio_bytes_pusher(uid, sample_rate), encode_audio_bytes_batch,
+                flush_size=sample_rate * 2, flush_seconds=pusher_audio_flush_seconds,
+                max_pending=sample_rate * 2 * pusher_max_pending_audio_seconds,
+            )
+            audio_bytes_forwarder.start()
 
         async def close(code: int = 1000):
-            if transcript_ws:
-                await transcript_ws.close(code)
-
-            if audio_bytes_ws:
-                await audio_bytes_ws.close(code)
+            await transcript_forwarder.close(code)
+            if audio_bytes_forwarder:
+                await audio_bytes_forwarder.close(code)
 
-        return (close, transcript_send, transcript_consume,
-                audio_bytes_send if audio_bytes_ws else None, audio_bytes_consume if audio_bytes_ws else None)
+        return close, transcript_forwarder.send, audio_bytes_forwarder.send if audio_bytes_forwarder else None
 
-    pusher_close, transcript_send, transcript_consume, audio_bytes_send, audio_bytes_consume = await create_pusher_task_handler()
+    pusher_close, transcript_send, audio_bytes_send = await create_pusher_task_handler()
 
-    def stream_transcript(segments):
+    async def process_segments(segments):
         nonlocal websocket
         nonlocal seconds_to_trim
+        nonlocal acked_seconds
+        nonlocal first_transcript_received
 
         if not segments or len(segments) == 0:
             return
 
+        if not first_transcript_received:
+            first_transcript_received = True
+            first_transcript_seconds = time.time() - connected_at
+            metrics.observe(f'listen_first_transcript_seconds:{stt_service.value}', first_transcript_seconds)
+            print('_websocket_util first transcript', stt_service.value, first_transcript_seconds)
+
+        acked_seconds = max(acked_seconds, segments[-1]["end"])
+
         # Align the start, end segment
         if seconds_to_trim is None:
             seconds_to_trim = segments[0]["start"]
 
         finished_at = datetime.now(timezone.utc)
-        asyncio.run_coroutine_threadsafe(create_memory_on_segment_received_task(finished_at), loop)
+        await create_memory_on_segment_received_task(finished_at)
 
         # Segments aligning duration seconds.
         if seconds_to_add:
@@ -324,30 +298,33 @@ async def _websocket_util(
                 segments[i] = segment
 
         # Send to client
-        asyncio.run_coroutine_threadsafe(websocket.send_json(segments), loop)
+        try:
+            await websocket.send_json(segments)
+        except Exception as e:
+            print(f"Can not send segments, error: {e}")
 
         # Send to external trigger
         if transcript_send:
-            transcript_send(segments)
+            await transcript_send(segments)
 
-        memory = _get_or_create_in_progress_memory(segments)  # can trigger race condition? increase soniox utterance?
-        memories_db.update_memory_segments(uid, memory.id, [s.dict() for s in memory.transcript_segments])
-        memories_db.update_memory_finished_at(uid, memory.id, finished_at)
+        # Firestore is written by the buffer flush, not on every segment
+        await loop.run_in_executor(persistence_executor, memory_buffer.add_segments, segments, finished_at)
 
         # threading.Thread(target=process_segments, args=(uid, segments)).start() # restore when plugins work
 
+    # Providers push from their own threads or tasks, segments are processed in order by a single consumer
+    ingest_queue = TranscriptIngestQueue(loop, process_segments)
+    stream_transcript = ingest_queue.push
+
     soniox_socket = None
     speechmatics_socket = None
     deepgram_socket = None
     deepgram_socket2 = None
+    stt_router = None
 
-    speech_profile_duration = 0
     try:
-        file_path, speech_profile_duration = None, 0
-        # TODO: how bee does for recognizing other languages speech profile
-        if language == 'en' and (codec == 'opus' or codec == 'pcm16') and include_speech_profile:
-            file_path = get_profile_audio_if_exists(uid)
-            speech_profile_duration = AudioSegment.from_wav(file_path).duration_seconds + 5 if file_path else 0
+        # pcm is passed through as is, opus is decoded into a reused ring of pcm buffers
+        decoder = get_codec(codec, sample_rate, 1)
 
         # DEEPGRAM
         if stt_service == STTService.deepgram:
@@ -360,7 +337,7 @@ async def _websocket_util(
                 async def deepgram_socket_send(data):
                     return deepgram_socket.send(data)
 
-                await send_initial_file_path(file_path, deepgram_socket_send)
+                await send_speech_profile_preamble(file_path, deepgram_socket_send, 'deepgram', sample_rate)
         # SONIOX
         elif stt_service == STTService.soniox:
             soniox_socket = await process_audio_soniox(
@@ -373,16 +350,45 @@ async def _websocket_util(
                 stream_transcript, sample_rate, language, preseconds=speech_profile_duration
             )
             if speech_profile_duration:
-                await send_initial_file_path(file_path, speechmatics_socket.send)
+                await send_speech_profile_preamble(file_path, speechmatics_socket.send, 'speechmatics', sample_rate)
                 print('speech_profile speechmatics duration', speech_profile_duration)
+        # AUTO, hedged start and failover across providers
+        elif stt_service == STTService.auto:
+            stt_router = STTProviderRouter(
+                stream_transcript, language, sample_rate, uid if include_speech_profile else None
+            )
+            await stt_router.start()
+
+        # Replay the audio of the previous connection that was not transcribed yet
+        if resume_audio:
+            print('_websocket_util replaying', len(resume_audio) / audio_tail.bytes_per_second, 'seconds')
+            audio_tail.append(resume_audio)
+            chunk_size = audio_tail.bytes_per_second // 2
+            for i in range(0, len(resume_audio), chunk_size):
+                chunk = resume_audio[i:i + chunk_size]
+                if deepgram_socket:
+                    deepgram_socket.send(chunk)
+                if soniox_socket:
+                    await soniox_socket.send(chunk)
+                if speechmatics_socket:
+                    await speechmatics_socket.send(chunk)
+                if stt_router:
+                    await stt_router.send(chunk)
+
+        await _send_message_event(
+            ListenSessionEvent(event_type="listen_session", session_token=session_token,
+                               resumed=resume_checkpoint is not None)
+        )
 
     except Exception as e:
         print(f"Initial processing error: {e}")
+        ingest_queue.close()
+        memory_buffer.close()
+        await pusher_close()
         websocket_close_code = 1011
         await websocket.close(code=websocket_close_code)
         return
 
-    decoder = opuslib.Decoder(sample_rate, 1)
     websocket_active = True
     websocket_close_code = 1001  # Going Away, don't close with good from backend
 
@@ -400,20 +406,23 @@ async def _websocket_util(
                 # f.write(struct.pack('I', data_length))  # Write length as 4 bytes
                 # f.write(data)
 
-                if codec == 'opus' and sample_rate == 16000:
-                    data = decoder.decode(bytes(data), frame_size=160)
+                data = decoder.decode(data)
 
                 if include_speech_profile and codec != 'opus':  # don't do for opus 1.0.4 for now
-                    has_speech = _has_speech(data, sample_rate)
-                    if not has_speech:
+                    if not speech_gate.process(data):
                         continue
 
+                audio_tail.append(data)
+
                 if soniox_socket is not None:
                     await soniox_socket.send(data)
 
                 if speechmatics_socket1 is not None:
                     await speechmatics_socket1.send(data)
 
+                if stt_router is not None:
+                    await stt_router.send(data)
+
                 if dg_socket1 is not None:
                     elapsed_seconds = time.time() - timer_start
                     if elapsed_seconds > speech_profile_duration or not dg_socket2:
@@ -427,7 +436,7 @@ async def _websocket_util(
 
                 # Send to external trigger
                 if audio_bytes_send:
-                    audio_bytes_send(data)
+                    await audio_bytes_send(data)
 
         except WebSocketDisconnect:
             print("WebSocket disconnected")
@@ -444,6 +453,8 @@ async def _websocket_util(
                 await soniox_socket.close()
             if speechmatics_socket:
                 await speechmatics_socket.close()
+            if stt_router:
+                await stt_router.close()
 
     # heart beat
     started_at = time.time()
@@ -479,24 +490,58 @@ async def _websocket_util(
         finally:
             websocket_active = False
 
+    async def flush_in_progress_memory():
+        while websocket_active:
+            await asyncio.sleep(1)
+            if memory_buffer.should_flush():
+                await loop.run_in_executor(persistence_executor, memory_buffer.flush)
+
+    ingest_task = None
     try:
         receive_task = asyncio.create_task(
             receive_audio(deepgram_socket, deepgram_socket2, soniox_socket, speechmatics_socket)
         )
         heartbeat_task = asyncio.create_task(send_heartbeat())
+        flush_task = asyncio.create_task(flush_in_progress_memory())
+        ingest_task = asyncio.create_task(ingest_queue.run())
 
-        # consumer
-        consume_tasks = [asyncio.create_task(transcript_consume())]
-        if audio_bytes_consume:
-            consume_tasks.append(asyncio.create_task(audio_bytes_consume()))
-
-        tasks = [receive_task, heartbeat_task] + consume_tasks
+        tasks = [receive_task, heartbeat_task, flush_task]
         await asyncio.gather(*tasks)
 
     except Exception as e:
         print(f"Error during WebSocket operation: {e}")
     finally:
         websocket_active = False
+
+        # drain segments received before the providers were closed
+        ingest_queue.close()
+        if ingest_task:
+            try:
+                await asyncio.wait_for(ingest_task, timeout=10)
+            except Exception as e:
+                print(f"Error draining ingest queue: {e}")
+
+        # Checkpoint, so the client can resume the session with its token if the connection dropped
+        if seconds_to_add:
+            seconds_to_shift = seconds_to_add
+        elif seconds_to_trim is not None:
+            seconds_to_shift = -seconds_to_trim
+        else:
+            seconds_to_shift = None
+        memory_id = memory_buffer.memory.id if memory_buffer.memory else None
+        try:
+            if not speech_profile_duration:
+                await loop.run_in_executor(
+                    persistence_executor, save_session_checkpoint, session_token, uid, sample_rate, memory_id,
+                    seconds_to_shift, acked_seconds, audio_tail, memory_creation_timeout,
+                )
+        except Exception as e:
+            print(f"Error saving session checkpoint: {e}")
+
+        try:
+            await loop.run_in_executor(persistence_executor, memory_buffer.close)
+        except Exception as e:
+            print(f"Error flushing in progress memory: {e}")
         if websocket.client_state == WebSocketState.CONNECTED:
             try:
                 await websocket.close(code=websocket_close_code)
@@ -512,6 +557,9 @@ async def _websocket_util(
 @router.websocket("/v2/listen")
 async def websocket_endpoint(
         websocket: WebSocket, uid: str, language: str = 'en', sample_rate: int = 8000, codec: str = 'pcm8',
-        channels: int = 1, include_speech_profile: bool = True, stt_service: STTService = STTService.soniox
+        channels: int = 1, include_speech_profile: bool = True, stt_service: STTService = STTService.soniox,
+        session_token: Optional[str] = None,
 ):
-    await _websocket_util(websocket, uid, language, sample_rate, codec, channels, include_speech_profile, stt_service)
+    await _websocket_util(
+        websocket, uid, language, sample_rate, codec, channels, include_speech_profile, stt_service, session_token
+    )
@@ -28,6 +28,8 @@ firebase_admin.initialize_app()
 
 from models.transcript_segment import TranscriptSegment
 from utils.stt.streaming import process_audio_dg, process_audio_soniox, process_audio_speechmatics
+from utils.stt.failover import STTProviderRouter
+from utils.other import metrics
 from groq import Groq
 
 from utils.other.storage import upload_postprocessing_audio
@@ -88,7 +90,8 @@ async def _execute_single(file_path: str):
     result = {
         'deepgram': [],
         'soniox': [],
-        'speechmatics': []
+        'speechmatics': [],
+        'router': [],
     }
 
     def stream_transcript_deepgram(new_segments, _):
@@ -103,10 +106,17 @@ async def _execute_single(file_path: str):
         print('stream_transcript_speechmatics', new_segments)
         add_model_result_segments('speechmatics', new_segments, result)
 
+    def stream_transcript_router(new_segments):
+        print('stream_transcript_router', new_segments)
+        add_model_result_segments('router', new_segments, result)
+
     # streaming models
     socket = await process_audio_dg(stream_transcript_deepgram, '1', 'en', 16000, 'pcm16', 1, 0)
     socket_soniox = await process_audio_soniox(stream_transcript_soniox, '1', 16000, 'en', None)
     socket_speechmatics = await process_audio_speechmatics(stream_transcript_speechmatics, '1', 16000, 'en', 0)
+    # hedged start + failover across providers, its decisions are printed and counted in metrics
+    router = STTProviderRouter(stream_transcript_router, 'en', 16000)
+    await router.start()
     print('duration', duration)
     with open(file_path, "rb") as file:
         while True:
@@ -116,6 +126,7 @@ async def _execute_single(file_path: str):
             socket.send(bytes(chunk))
             await socket_soniox.send(bytes(chunk))
             await socket_speechmatics.send(bytes(chunk))
+            await router.send(bytes(chunk))
             await asyncio.sleep(0.005)
 
     print('Finished sending audio')
@@ -135,6 +146,7 @@ async def _execute_single(file_path: str):
     print('Waiting for sockets to finish', min(60, duration), 'seconds')
     await asyncio.sleep(min(30, duration))
 
+    result['router_metrics'] = {k: v for k, v in metrics.snapshot()['counters'].items() if k.startswith('stt_router')}
     os.makedirs('results', exist_ok=True)
     with open(f'results/{memory_id}.json', 'w') as f:
         json.dump(result, f, indent=2)
@@ -142,6 +154,7 @@ async def _execute_single(file_path: str):
     socket.finish()
     await socket_soniox.close()
     await socket_speechmatics.close()
+    await router.close()
 
 
 def batched(iterable, n):
@@ -240,6 +253,8 @@ def compute_wer():
 
         # Iterate through each model in the JSON
         for model, segments in result.items():
+            if model == 'router_metrics':
+                continue
             if model == reference_model:
                 model_text = reference_text  # Reference model's transcript
             else:
@@ -0,0 +1,80 @@
+import argparse
+import json
+import sys
+import time
+import uuid
+from datetime import datetime, timezone
+
+import numpy as np
+
+sys.path.append('..')
+
+import database.chat as chat_db
+from models.chat import Message
+from utils.llm_cache import bypass_llm_cache
+from utils.retrieval.graph import execute_graph_chat, execute_graph_chat_stream
+
+# Time to first token of a chat turn, blocking (the whole answer at once) vs streamed, and time to the first
+# progress event. Runs the user's recent messages plus each question, skipping the LLM and chat state caches.
+# python chat_stream_benchmark.py --uid <uid> [--questions questions.json] [--runs 3]
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--uid', required=True)
+parser.add_argument('--questions', help='json list of questions')
+parser.add_argument('--runs', type=int, default=3)
+args = parser.parse_args()
+
+default_questions = [
+    'Hi, how are you?',
+    'What did I talk about with my manager last week?',
+    'Which books were recommended to me?',
+    'What are my plans for the weekend?',
+]
+
+
+def blocking(messages):
+    start = time.time()
+    execute_graph_chat(args.uid, messages)
+    elapsed = time.time() - start
+    return {'first_event': elapsed, 'first_token': elapsed, 'total': elapsed}
+
+
+def streamed(messages):
+    start, result = time.time(), {}
+    for event in execute_graph_chat_stream(args.uid, messages):
+        result.setdefault('first_event', time.time() - start)
+        if event['type'] == 'delta':
+            result.setdefault('first_token', time.time() - start)
+    result['total'] = time.time() - start
+    result.setdefault('first_token', result['total'])
+    return result
+
+
+def print_stats(name, results):
+    line = f'  {name:<9}'
+    for key in ['first_event', 'first_token', 'total']:
+        values = np.array([r[key] for r in results])
+        line += f'  {key} p50 {np.percentile(values, 50):5.2f}s p95 {np.percentile(values, 95):5.2f}s'
+    print(line)
+
+
+if __name__ == '__main__':
+    questions = json.load(open(args.questions)) if args.questions else default_questions
+    history = list(reversed([Message(**msg) for msg in chat_db.get_messages(args.uid, limit=9)]))
+    results = {'blocking': [], 'streamed': []}
+    for question in questions:
+        message = Message(
+            id=str(uuid.uuid4()), text=question, created_at=datetime.now(timezone.utc), sender='human', type='text'
+        )
+        messages = history + [message]
+        for _ in range(args.runs):
+            with bypass_llm_cache():
+                results['blocking'].append(blocking(messages))
+                results['streamed'].append(streamed(messages))
+        print(f'{question}')
+        print_stats('blocking', results['blocking'][-args.runs:])
+        print_stats('streamed', results['streamed'][-args.runs:])
+
+    print('\nall')
+    for name, values in results.items():
+        print_stats(name, values)
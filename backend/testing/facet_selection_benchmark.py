@@ -0,0 +1,51 @@
+import argparse
+import json
+import sys
+import time
+
+sys.path.append('..')
+
+import database.redis_db as redis_db
+from utils.llm import num_tokens_from_string, select_structured_filters, generate_embedding
+from utils.retrieval.facets import select_candidate_facets, facet_categories
+
+# Size of the select_structured_filters prompt and the filters chosen for a user, with every value in the
+# users:{uid}:filters:* sets (before) vs the facet index candidates (after).
+# python facet_selection_benchmark.py --uid <uid> [--questions questions.json] [--llm]
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--uid', required=True)
+parser.add_argument('--questions', help='json list of questions')
+parser.add_argument('--llm', action='store_true', help='also compare the filters the LLM picks')
+args = parser.parse_args()
+
+default_questions = [
+    'What did I talk about with my manager last week?',
+    'Which books were recommended to me?',
+    'What are my plans for the trip?',
+    'What did we decide about the project deadline?',
+]
+
+
+def prompt_tokens(filters: dict) -> int:
+    return num_tokens_from_string(json.dumps(filters, indent=2))
+
+
+if __name__ == '__main__':
+    questions = json.load(open(args.questions)) if args.questions else default_questions
+    everything = {category: redis_db.get_filter_category_items(args.uid, category) for category in facet_categories}
+    print('values', {category: len(values) for category, values in everything.items()})
+    print(f'before: {prompt_tokens(everything)} filter tokens per question')
+
+    for question in questions:
+        start = time.time()
+        candidates = select_candidate_facets(args.uid, question, generate_embedding(question))
+        elapsed = (time.time() - start) * 1000
+        print(f'\n{question}\n  after: {prompt_tokens(candidates)} filter tokens, selected in {elapsed:.1f} ms')
+        if args.llm:
+            before = select_structured_filters(question, everything)
+            after = select_structured_filters(question, candidates)
+            for category in facet_categories:
+                kept = set(before.get(category, [])) & set(after.get(category, []))
+                print(f'  {category:<9} before {before.get(category, [])}  after {after.get(category, [])}  '
+                      f'kept {len(kept)}/{len(before.get(category, []))}')
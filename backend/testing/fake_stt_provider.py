@@ -0,0 +1,126 @@
+import argparse
+import asyncio
+import json
+import random
+from urllib.parse import parse_qs, urlparse
+
+import websockets
+
+# Local websocket server speaking enough of the Deepgram, Soniox and Speechmatics streaming protocols to run
+# /v2/listen, the STT connection pool and failover against it (see stt_pool_benchmark.py), without provider
+# credentials or costs.
+#
+# python fake_stt_provider.py --port 8765 --connect-delay 0.3 --fail-rate 0.1
+# DEEPGRAM_API_URL=http://localhost:8765 SONIOX_WS_URI=ws://localhost:8765/transcribe-websocket
+# SPEECHMATICS_WS_URI=ws://localhost:8765/v2
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--port', type=int, default=8765)
+parser.add_argument('--connect-delay', type=float, default=0.0, help='seconds before accepting a connection')
+parser.add_argument('--fail-rate', type=float, default=0.0, help='ratio of connections rejected')
+parser.add_argument('--word-seconds', type=float, default=0.5, help='audio seconds per fake word')
+args = parser.parse_args()
+
+
+def _words(sample_rate: int, received_bytes: int, sent_words: int):
+    """Fake words for the audio received so far, `word_seconds` each."""
+    total = int(received_bytes / (sample_rate * 2) / args.word_seconds)
+    for i in range(sent_words, total):
+        yield i, i * args.word_seconds, args.word_seconds
+
+
+async def deepgram(websocket):
+    query = parse_qs(urlparse(websocket.path).query)
+    sample_rate = int(query.get('sample_rate', ['16000'])[0])
+    received, sent_words = 0, 0
+    async for message in websocket:
+        if isinstance(message, str):
+            if json.loads(message).get('type') == 'CloseStream':
+                await websocket.close()
+            continue
+        received += len(message)
+        words = [
+            {'word': f'word{i}', 'punctuated_word': f'word{i}', 'start': start, 'end': start + duration,
+             'confidence': 0.9, 'speaker': 0, 'speaker_confidence': 0.9}
+            for i, start, duration in _words(sample_rate, received, sent_words)
+        ]
+        if not words:
+            continue
+        sent_words += len(words)
+        await websocket.send(json.dumps({
+            'type': 'Results', 'channel_index': [0, 1], 'start': words[0]['start'],
+            'duration': words[-1]['end'] - words[0]['start'], 'is_final': True, 'speech_final': True,
+            'from_finalize': False,
+            'channel': {'alternatives': [{
+                'transcript': ' '.join(w['word'] for w in words), 'confidence': 0.9, 'words': words,
+            }]},
+            'metadata': {'request_id': 'fake', 'model_uuid': 'fake',
+                         'model_info': {'name': 'fake', 'version': 'fake', 'arch': 'fake'}},
+        }))
+
+
+async def soniox(websocket):
+    request = json.loads(await websocket.recv())
+    sample_rate = request.get('sample_rate_hertz', 16000)
+    received, sent_words = 0, 0
+    async for message in websocket:
+        if isinstance(message, str):
+            continue
+        received += len(message)
+        words = [
+            {'t': f' word{i}', 's': int(start * 1000), 'd': int(duration * 1000), 'spk': 1}
+            for i, start, duration in _words(sample_rate, received, sent_words)
+        ]
+        sent_words += len(words)
+        await websocket.send(json.dumps({'fw': words, 'nfw': [], 'spks': []}))
+
+
+async def speechmatics(websocket):
+    request = json.loads(await websocket.recv())
+    sample_rate = request['audio_format']['sample_rate']
+    await websocket.send(json.dumps({'message': 'RecognitionStarted', 'id': 'fake'}))
+    received, sent_words, seq_no = 0, 0, 0
+    async for message in websocket:
+        if isinstance(message, str):
+            if json.loads(message).get('message') == 'EndOfStream':
+                await websocket.send(json.dumps({'message': 'EndOfTranscript'}))
+            continue
+        received += len(message)
+        seq_no += 1
+        await websocket.send(json.dumps({'message': 'AudioAdded', 'seq_no': seq_no}))
+        results = [
+            {'type': 'word', 'start_time': start, 'end_time': start + duration,
+             'alternatives': [{'content': f'word{i}', 'confidence': 0.9, 'speaker': 'S1'}]}
+            for i, start, duration in _words(sample_rate, received, sent_words)
+        ]
+        if results:
+            sent_words += len(results)
+            await websocket.send(json.dumps({'message': 'AddTranscript', 'results': results}))
+
+
+async def handler(websocket):
+    await asyncio.sleep(args.connect_delay)
+    if random.random() < args.fail_rate:
+        await websocket.close(1011, 'fake failure')
+        return
+    try:
+        if websocket.path.startswith('/v1/listen'):
+            await deepgram(websocket)
+        elif websocket.path.startswith('/transcribe-websocket'):
+            await soniox(websocket)
+        elif websocket.path.startswith('/v2'):
+            await speechmatics(websocket)
+        else:
+            await websocket.close(1008, f'unknown path {websocket.path}')
+    except websockets.exceptions.ConnectionClosed:
+        pass
+
+
+async def main():
+    async with websockets.serve(handler, 'localhost', args.port):
+        print(f'fake STT provider listening on ws://localhost:{args.port}')
+        await asyncio.Future()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,110 @@
+import argparse
+import json
+import sys
+import time
+from datetime import datetime
+from difflib import SequenceMatcher
+
+from langchain_community.callbacks import get_openai_callback
+
+sys.path.append('..')
+
+from models.memory import Memory
+from models.transcript_segment import TranscriptSegment
+from utils.llm import should_discard_memory, get_transcript_structure, retrieve_metadata_fields_from_transcript, \
+    new_facts_extractor, trends_extractor, get_fused_extraction, save_extracted_information
+
+# Token usage, wall time and output agreement of the fused extraction call vs the current calls, per memory.
+# python fused_extraction_benchmark.py --uid <test uid> [--corpus fixtures/memories.json] [--tz UTC]
+#
+# The uid facts are used as context, and the extracted filters are added to it, use a test user.
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--uid', required=True)
+parser.add_argument('--corpus', default='fixtures/memories.json')
+parser.add_argument('--tz', default='UTC')
+args = parser.parse_args()
+
+
+def jaccard(a, b) -> float:
+    a, b = set(x.lower().strip() for x in a), set(x.lower().strip() for x in b)
+    if not a and not b:
+        return 1.0
+    return len(a & b) / len(a | b)
+
+
+def similarity(a: str, b: str) -> float:
+    return SequenceMatcher(None, a.lower(), b.lower()).ratio()
+
+
+def multi_call(memory: Memory, started_at: datetime):
+    transcript = memory.get_transcript(False)
+    discard = should_discard_memory(transcript)
+    structured = get_transcript_structure(transcript, started_at, memory.language, args.tz) if not discard else None
+    metadata = retrieve_metadata_fields_from_transcript(
+        args.uid, started_at, [s.dict() for s in memory.transcript_segments]
+    )
+    facts = new_facts_extractor(args.uid, memory.transcript_segments)
+    trends = trends_extractor(memory)
+    return discard, structured, metadata, facts, trends
+
+
+def fused_call(memory: Memory, started_at: datetime):
+    fused = get_fused_extraction(args.uid, memory.transcript_segments, started_at, memory.language, args.tz)
+    metadata = save_extracted_information(args.uid, fused.information)
+    return fused.discard, fused.structured if not fused.discard else None, metadata, fused.facts, fused.trends
+
+
+def run(name, fn, memory, started_at):
+    with get_openai_callback() as cb:
+        start = time.time()
+        result = fn(memory, started_at)
+        elapsed = time.time() - start
+    return result, {'name': name, 'seconds': elapsed, 'calls': cb.successful_requests,
+                    'prompt_tokens': cb.prompt_tokens, 'completion_tokens': cb.completion_tokens,
+                    'cost': cb.total_cost}
+
+
+def agreement(a, b) -> dict:
+    (a_discard, a_structured, a_metadata, a_facts, a_trends) = a
+    (b_discard, b_structured, b_metadata, b_facts, b_trends) = b
+    result = {'discard': a_discard == b_discard}
+    if a_structured and b_structured:
+        result['category'] = a_structured.category == b_structured.category
+        result['title'] = round(similarity(a_structured.title, b_structured.title), 2)
+        result['action_items'] = (len(a_structured.action_items), len(b_structured.action_items))
+        result['events'] = (len(a_structured.events), len(b_structured.events))
+    for key in ['people', 'topics', 'entities', 'dates']:
+        result[key] = round(jaccard(a_metadata[key], b_metadata[key]), 2)
+    result['facts'] = (len(a_facts), len(b_facts))
+    result['trends'] = round(jaccard([f'{t.category.value}:{t.topic}' for t in a_trends],
+                                     [f'{t.category.value}:{t.topic}' for t in b_trends]), 2)
+    return result
+
+
+if __name__ == '__main__':
+    corpus = json.load(open(args.corpus))
+    totals = {'multi': {}, 'fused': {}}
+    for item in corpus:
+        segments = [TranscriptSegment(**s) for s in item['transcript_segments']]
+        started_at = datetime.fromisoformat(item['started_at'])
+        memory = Memory(
+            id=item['id'], created_at=started_at, started_at=started_at, finished_at=started_at,
+            transcript_segments=segments, language=item.get('language', 'en'), structured={},
+        )
+
+        multi, multi_stats = run('multi', multi_call, memory, started_at)
+        fused, fused_stats = run('fused', fused_call, memory, started_at)
+        print(f'\n{item["id"]} ({len(segments)} segments)')
+        for stats in [multi_stats, fused_stats]:
+            print(f'  {stats["name"]:<6} {stats["seconds"]:6.2f}s  {stats["calls"]} calls  '
+                  f'{stats["prompt_tokens"]:6d} prompt  {stats["completion_tokens"]:5d} completion  '
+                  f'${stats["cost"]:.4f}')
+            for key in ['seconds', 'calls', 'prompt_tokens', 'completion_tokens', 'cost']:
+                totals[stats['name']][key] = totals[stats['name']].get(key, 0) + stats[key]
+        print('  agreement', agreement(multi, fused))
+
+    print('\ntotal')
+    for name, stats in totals.items():
+        print(f'  {name:<6} {stats["seconds"]:6.2f}s  {stats["calls"]} calls  {stats["prompt_tokens"]:6d} prompt  '
+              f'{stats["completion_tokens"]:5d} completion  ${stats["cost"]:.4f}')
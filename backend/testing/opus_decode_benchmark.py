@@ -0,0 +1,44 @@
+import sys
+import time
+
+import numpy as np
+import opuslib
+
+sys.path.append('..')
+
+from utils.audio import get_codec
+
+# Opus decode throughput on a single core, frames per second, opuslib.Decoder vs the OpusCodec ring buffer.
+# python opus_decode_benchmark.py [sample_rate] [frames]
+
+sample_rate = int(sys.argv[1]) if len(sys.argv) > 1 else 16000
+n_frames = int(sys.argv[2]) if len(sys.argv) > 2 else 50000
+frame_size = sample_rate // 100  # 10 ms, what the devices send
+
+
+def encode_packets():
+    t = np.arange(frame_size * n_frames) / sample_rate
+    audio = (3000 * np.sin(2 * np.pi * 220 * t) * (0.6 + 0.4 * np.sin(2 * np.pi * 3 * t))).astype(np.int16)
+    encoder = opuslib.Encoder(sample_rate, 1, opuslib.APPLICATION_VOIP)
+    pcm = audio.tobytes()
+    return [encoder.encode(pcm[i:i + frame_size * 2], frame_size) for i in range(0, len(pcm), frame_size * 2)]
+
+
+def run(name, decode, packets):
+    start = time.process_time()
+    total = 0
+    for packet in packets:
+        total += len(decode(packet))
+    elapsed = time.process_time() - start
+    print(f'{name:<20} {len(packets) / elapsed:10.0f} frames/s/core  {total} pcm bytes')
+
+
+if __name__ == '__main__':
+    packets = encode_packets()
+    print(f'{len(packets)} opus packets of 10 ms at {sample_rate}Hz')
+
+    decoder = opuslib.Decoder(sample_rate, 1)
+    run('opuslib.Decoder', lambda packet: decoder.decode(bytes(packet), frame_size=frame_size), packets)
+
+    codec = get_codec('opus', sample_rate, 1)
+    run('OpusCodec', codec.decode, packets)
@@ -0,0 +1,102 @@
+import argparse
+import contextvars
+import json
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from difflib import SequenceMatcher
+
+from langchain_community.callbacks import get_openai_callback
+
+sys.path.append('..')
+
+from models.memory import Memory
+from models.plugin import Plugin
+from models.transcript_segment import TranscriptSegment
+from utils.llm import get_plugin_result, get_plugin_batches, get_plugins_results
+from utils.llm_cache import bypass_llm_cache
+
+# Token usage, wall time and output agreement of batched plugin prompts vs one call per plugin, per memory. Calls
+# run concurrently as the memory stages do, and skip the LLM cache.
+# python plugin_batch_benchmark.py [--plugins 8] [--corpus fixtures/memories.json]
+#                                  [--catalog ../../community-plugins.json]
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--plugins', type=int, default=8)
+parser.add_argument('--corpus', default='fixtures/memories.json')
+parser.add_argument('--catalog', default='../../community-plugins.json')
+args = parser.parse_args()
+
+
+def concurrently(fn, items):
+    context = contextvars.copy_context()
+    with ThreadPoolExecutor(max_workers=len(items)) as executor:
+        return list(executor.map(lambda item: context.copy().run(fn, item), items))
+
+
+def per_plugin(transcript: str, plugins):
+    results = concurrently(lambda plugin: get_plugin_result(transcript, plugin), plugins)
+    return {plugin.id: result for plugin, result in zip(plugins, results)}
+
+
+def batched(transcript: str, plugins):
+    results = {}
+    for batch_results in concurrently(lambda batch: get_plugins_results(transcript, batch),
+                                      get_plugin_batches(transcript, plugins)):
+        results.update(batch_results)
+    return results
+
+
+def run(name, fn, transcript, plugins):
+    with get_openai_callback() as cb, bypass_llm_cache():
+        start = time.time()
+        result = fn(transcript, plugins)
+        elapsed = time.time() - start
+    return result, {'name': name, 'seconds': elapsed, 'calls': cb.successful_requests,
+                    'prompt_tokens': cb.prompt_tokens, 'completion_tokens': cb.completion_tokens,
+                    'cost': cb.total_cost}
+
+
+def agreement(a: dict, b: dict, plugins) -> dict:
+    both_empty_or_not = sum(1 for p in plugins if bool(a.get(p.id)) == bool(b.get(p.id)))
+    similarities = [SequenceMatcher(None, a[p.id], b[p.id]).ratio() for p in plugins if a.get(p.id) and b.get(p.id)]
+    return {
+        'answered': f'{both_empty_or_not}/{len(plugins)}',
+        'similarity': round(sum(similarities) / len(similarities), 2) if similarities else None,
+        'length': (sum(len(v) for v in a.values()), sum(len(v) for v in b.values())),
+    }
+
+
+def print_stats(stats):
+    print(f'  {stats["name"]:<10} {stats["seconds"]:6.2f}s  {stats["calls"]} calls  '
+          f'{stats["prompt_tokens"]:6d} prompt  {stats["completion_tokens"]:5d} completion  ${stats["cost"]:.4f}')
+
+
+if __name__ == '__main__':
+    catalog = [Plugin(**p) for p in json.load(open(args.catalog)) if not p.get('deleted')]
+    plugins = [p for p in catalog if p.works_with_memories() and p.memory_prompt][:args.plugins]
+    print(f'{len(plugins)} plugins:', ', '.join(p.id for p in plugins))
+
+    corpus = json.load(open(args.corpus))
+    totals = {'per_plugin': {}, 'batched': {}}
+    for item in corpus:
+        started_at = datetime.fromisoformat(item['started_at'])
+        memory = Memory(
+            id=item['id'], created_at=started_at, started_at=started_at, finished_at=started_at,
+            transcript_segments=[TranscriptSegment(**s) for s in item['transcript_segments']], structured={},
+        )
+        transcript = memory.get_transcript(False, compact=True)
+
+        single, single_stats = run('per_plugin', per_plugin, transcript, plugins)
+        batch, batch_stats = run('batched', batched, transcript, plugins)
+        print(f'\n{item["id"]} ({len(memory.transcript_segments)} segments)')
+        for stats in [single_stats, batch_stats]:
+            print_stats(stats)
+            for key in ['seconds', 'calls', 'prompt_tokens', 'completion_tokens', 'cost']:
+                totals[stats['name']][key] = totals[stats['name']].get(key, 0) + stats[key]
+        print('  agreement', agreement(single, batch, plugins))
+
+    print('\ntotal')
+    for name, stats in totals.items():
+        print_stats({'name': name, **stats})
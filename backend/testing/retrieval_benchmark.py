@@ -0,0 +1,150 @@
+import argparse
+import json
+import shutil
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+import numpy as np
+
+sys.path.append('..')
+
+import database.vector_db as vector_db
+from database.vector_store import LocalVectorStore
+
+# Response payload size and latency of query_vectors_by_metadata, the previous single query (top_k=10000 with
+# metadata, re-scored in Python) vs the current two-stage retrieval, for a heavy user, on the local vector store.
+# python retrieval_benchmark.py [--memories 5000] [--dim 768] [--queries 200]
+#
+# Memory facets are read from Redis when REDIS_DB_* is configured, else from the index metadata and the local cache.
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--memories', type=int, default=5000)
+parser.add_argument('--dim', type=int, default=768)
+parser.add_argument('--queries', type=int, default=200)
+args = parser.parse_args()
+
+uid = 'benchmarkuser'
+topics = [f'topic {i}' for i in range(200)]
+people = [f'person {i}' for i in range(100)]
+entities = [f'entity {i}' for i in range(150)]
+
+
+class RecordingStore:
+    """Passes queries through, recording the size of each response as it would be sent over the wire."""
+
+    def __init__(self, store):
+        self.store = store
+        self.payload = 0
+
+    def query(self, **kwargs):
+        result = self.store.query(**kwargs)
+        self.payload += len(json.dumps(result))
+        return result
+
+    def __getattr__(self, name):
+        return getattr(self.store, name)
+
+
+def previous_query_vectors_by_metadata(
+        uid: str, vector, dates_filter, people, topics, entities, dates
+):
+    index = vector_db.index
+    filter_data = {'$and': [{'uid': {'$eq': uid}}]}
+    if people or topics or entities or dates:
+        filter_data['$and'].append({'$or': [
+            {'people': {'$in': people}}, {'topics': {'$in': topics}}, {'entities': {'$in': entities}},
+        ]})
+    if dates_filter and dates_filter[0] and dates_filter[1]:
+        filter_data['$and'].append(
+            {'created_at': {'$gte': int(dates_filter[0].timestamp()), '$lte': int(dates_filter[1].timestamp())}}
+        )
+    xc = index.query(vector=vector, filter=filter_data, namespace="ns1", include_values=False,
+                     include_metadata=True, top_k=10000)
+    if not xc['matches']:
+        if len(filter_data['$and']) == 3:
+            filter_data['$and'].pop(1)
+            xc = index.query(vector=vector, filter=filter_data, namespace="ns1", include_values=False,
+                             include_metadata=True, top_k=20)
+        else:
+            return []
+    memory_id_to_matches = defaultdict(int)
+    for item in xc['matches']:
+        metadata = item['metadata']
+        memory_id = metadata['memory_id']
+        for topic in topics:
+            if topic in metadata.get('topics', []):
+                memory_id_to_matches[memory_id] += 1
+        for entity in entities:
+            if entity in metadata.get('entities', []):
+                memory_id_to_matches[memory_id] += 1
+        for person in people:
+            if person in metadata.get('people', []):  # was people_mentioned, which is never set
+                memory_id_to_matches[memory_id] += 1
+    memories_id = [item['id'].replace(f'{uid}-', '') for item in xc['matches']]
+    memories_id.sort(key=lambda x: memory_id_to_matches[x], reverse=True)
+    return memories_id[:5]
+
+
+def build_corpus(rng, store):
+    start = datetime(2024, 1, 1)
+    centers = rng.normal(size=(32, args.dim))
+    vectors = []
+    for i in range(args.memories):
+        vector = centers[i % len(centers)] + rng.normal(scale=0.7, size=args.dim)
+        vectors.append({'id': f'{uid}-memory{i}', 'values': (vector / np.linalg.norm(vector)).tolist(), 'metadata': {
+            'uid': uid, 'memory_id': f'memory{i}', 'created_at': int((start + timedelta(hours=i)).timestamp()),
+            'topics': list(rng.choice(topics, 4, replace=False)), 'people': list(rng.choice(people, 2, replace=False)),
+            'entities': list(rng.choice(entities, 3, replace=False)), 'dates': [],
+        }})
+    for i in range(0, len(vectors), 500):
+        store.upsert(vectors[i:i + 500], 'ns1')
+    return centers, start
+
+
+def random_query(rng, centers, start):
+    vector = centers[rng.integers(0, len(centers))] + rng.normal(scale=0.7, size=args.dim)
+    dates = [None, None]
+    if rng.random() < 0.3:
+        begin = start + timedelta(hours=int(rng.integers(0, args.memories)))
+        dates = [begin, begin + timedelta(days=14)]
+    return dict(
+        vector=(vector / np.linalg.norm(vector)).tolist(), dates_filter=dates, dates=[],
+        people=[str(p) for p in rng.choice(people, int(rng.integers(0, 2)), replace=False)],
+        topics=[str(t) for t in rng.choice(topics, int(rng.integers(1, 3)), replace=False)],
+        entities=[str(e) for e in rng.choice(entities, int(rng.integers(0, 2)), replace=False)],
+    )
+
+
+def run(name, fn, queries):
+    store = vector_db.index
+    latencies, payloads, results = [], [], []
+    for query in queries:
+        store.payload = 0
+        start = time.time()
+        results.append(fn(uid, **query))
+        latencies.append((time.time() - start) * 1000)
+        payloads.append(store.payload)
+    latencies = np.array(latencies)
+    print(f'  {name:<9} p50 {np.percentile(latencies, 50):8.2f} ms  p95 {np.percentile(latencies, 95):8.2f} ms  '
+          f'payload avg {np.mean(payloads) / 1024:9.1f} KB  max {np.max(payloads) / 1024:9.1f} KB')
+    return results
+
+
+if __name__ == '__main__':
+    rng = np.random.default_rng(3)
+    path = tempfile.mkdtemp(prefix='vectors')
+    try:
+        vector_db.index = RecordingStore(LocalVectorStore(path))
+        centers, start = build_corpus(rng, vector_db.index)
+        queries = [random_query(rng, centers, start) for _ in range(args.queries)]
+        print(f'{args.memories} memories, dim {args.dim}, {args.queries} queries')
+
+        previous = run('previous', previous_query_vectors_by_metadata, queries)
+        current = run('two-stage', vector_db.query_vectors_by_metadata, queries)
+        overlap = [len(set(a) & set(b)) / len(a) for a, b in zip(previous, current) if a]
+        print(f'  top 5 overlap with previous {np.mean(overlap):.2f}')
+    finally:
+        shutil.rmtree(path)
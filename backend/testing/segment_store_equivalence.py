@@ -0,0 +1,65 @@
+import argparse
+import copy
+import random
+import sys
+
+sys.path.append('..')
+
+from models.transcript_segment import TranscriptSegment, TranscriptSegmentStore
+
+# Property check of TranscriptSegmentStore against TranscriptSegment.combine_segments, on random sessions: after every
+# update both have the same segments, and applying the deltas to a copy rebuilds them.
+# python segment_store_equivalence.py [--sessions 2000] [--seed 1]
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--sessions', type=int, default=2000)
+parser.add_argument('--seed', type=int, default=1)
+args = parser.parse_args()
+
+tokens = ['hello', 'so', 'we', 'ship', 'it', ',', '.', '?', ' ', '  ', '   ', 'ok', 'the', 'plan']
+
+
+def random_text() -> str:
+    return ''.join(random.choice(tokens) + random.choice(['', ' ', '  ']) for _ in range(random.randint(0, 8)))
+
+
+def random_segments(count: int, start: float) -> list:
+    segments = []
+    for _ in range(count):
+        start += random.choice([0, 0.5, 3, 20, 40])
+        end = start + random.uniform(0, 10)
+        speaker = random.randint(0, 2)
+        segments.append(TranscriptSegment(
+            text=random_text(), speaker=f'SPEAKER_0{speaker}', is_user=random.random() < 0.3, start=start, end=end,
+        ))
+        start = end
+    return segments
+
+
+def check_session():
+    initial = random_segments(random.randint(0, 4), 0)
+    expected = copy.deepcopy(initial)
+    store = TranscriptSegmentStore(copy.deepcopy(initial))
+    mirror = [s.dict() for s in store.segments]
+    version = store.version
+
+    for _ in range(random.randint(1, 12)):
+        start = expected[-1].end if expected else 0
+        new_segments = random_segments(random.choice([0, 1, 1, 2, 5]), start)
+        delta_seconds = random.choice([0, 0, 5])
+
+        expected = TranscriptSegment.combine_segments(expected, copy.deepcopy(new_segments), delta_seconds)
+        store.add(copy.deepcopy(new_segments), delta_seconds)
+        assert [s.dict() for s in store.segments] == [s.dict() for s in expected], 'segments differ'
+
+        index, changed = store.delta(version)
+        mirror[index:] = [s.dict() for s in changed]
+        version = store.version
+        assert mirror == [s.dict() for s in expected], 'delta does not rebuild the segments'
+
+
+if __name__ == '__main__':
+    random.seed(args.seed)
+    for i in range(args.sessions):
+        check_session()
+    print(f'{args.sessions} sessions, TranscriptSegmentStore matches combine_segments')
@@ -0,0 +1,63 @@
+import sys
+import time
+
+import numpy as np
+import webrtcvad
+
+sys.path.append('..')
+
+from utils.stt.speech_gate import SpeechGate
+
+# Compares the per packet cost of the previous /v2/listen `_has_speech` with SpeechGate.
+# python speech_gate_benchmark.py [sample_rate] [seconds]
+
+sample_rate = int(sys.argv[1]) if len(sys.argv) > 1 else 16000
+seconds = int(sys.argv[2]) if len(sys.argv) > 2 else 600
+packet_bytes = 322 if sample_rate == 16000 else 162  # not frame aligned on purpose, like devices send
+
+
+def generate_audio():
+    # 3s speech-like (modulated tones) / 7s silence with a low noise floor, repeated.
+    rng = np.random.default_rng(0)
+    t = np.arange(sample_rate * seconds) / sample_rate
+    audio = rng.normal(0, 20, len(t))
+    envelope = (t % 10) < 3
+    voiced = 3000 * np.sin(2 * np.pi * 180 * t) * (0.6 + 0.4 * np.sin(2 * np.pi * 4 * t))
+    audio += voiced * envelope
+    return np.clip(audio, -32768, 32767).astype(np.int16).tobytes()
+
+
+w_vad = webrtcvad.Vad()
+w_vad.set_mode(1)
+
+
+def _has_speech(data, sample_rate):
+    sample_size = 320 if sample_rate == 16000 else 160
+    offset = 0
+    while offset < len(data):
+        sample = data[offset:offset + sample_size]
+        if len(sample) < sample_size:
+            sample = sample + bytes([0x00] * (sample_size - len(sample) % sample_size))
+        has_speech = w_vad.is_speech(sample, sample_rate)
+        if has_speech:
+            return True
+        offset += sample_size
+    return False
+
+
+def run(name, has_speech):
+    packets = [audio[i:i + packet_bytes] for i in range(0, len(audio), packet_bytes)]
+    start = time.perf_counter()
+    sent = sum(1 for packet in packets if has_speech(packet))
+    elapsed = time.perf_counter() - start
+    print(f'{name:<24} {elapsed * 1000:8.1f} ms  {elapsed / len(packets) * 1e6:6.2f} us/packet  '
+          f'sent {sent}/{len(packets)} packets')
+
+
+if __name__ == '__main__':
+    audio = generate_audio()
+    print(f'{seconds}s of audio at {sample_rate}Hz, {packet_bytes} bytes packets')
+    run('_has_speech', lambda packet: _has_speech(packet, sample_rate))
+    run('SpeechGate(webrtcvad)', SpeechGate(sample_rate, backend='webrtcvad').process)
+    run('SpeechGate(energy)', SpeechGate(sample_rate, backend='energy').process)
+    run('SpeechGate(no hangover)', SpeechGate(sample_rate, hangover_ms=0, attack_frames=1).process)
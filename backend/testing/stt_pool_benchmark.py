@@ -0,0 +1,96 @@
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.append('..')
+
+from utils.other import metrics
+from utils.stt.failover import STTProviderRouter
+
+# Sessions through the STT connection pool and the provider router, against fake_stt_provider.py: time to start and
+# to the first segment, and how many provider connections were opened per session, warmed but never used included.
+# Run with --fail-rate on the fake provider to see failovers.
+#
+# python fake_stt_provider.py --port 8765 --connect-delay 0.3
+# DEEPGRAM_API_URL=http://localhost:8765 SONIOX_WS_URI=ws://localhost:8765/transcribe-websocket \
+#   SONIOX_API_KEY=fake DEEPGRAM_API_KEY=fake python stt_pool_benchmark.py [--sessions 30] [--interval 2]
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--providers', default='soniox,deepgram')
+parser.add_argument('--language', default='en')
+parser.add_argument('--sessions', type=int, default=30)
+parser.add_argument('--interval', type=float, default=2, help='seconds between sessions starting')
+parser.add_argument('--seconds', type=float, default=10, help='audio seconds per session')
+args = parser.parse_args()
+
+sample_rate = 16000
+chunk_seconds = 0.1
+
+
+def tone(seconds: float) -> bytes:
+    t = np.arange(int(seconds * sample_rate)) / sample_rate
+    return (np.sin(2 * np.pi * 220 * t) * 8000).astype(np.int16).tobytes()
+
+
+async def session(results: list):
+    first_segment = []
+    start = time.time()
+
+    def stream_transcript(segments):
+        if not first_segment:
+            first_segment.append(time.time() - start)
+
+    router = STTProviderRouter(stream_transcript, args.language, sample_rate, providers=args.providers.split(','))
+    try:
+        await router.start()
+        started = time.time() - start
+        chunk = tone(chunk_seconds)
+        for _ in range(int(args.seconds / chunk_seconds)):
+            await router.send(chunk)
+            await asyncio.sleep(chunk_seconds)
+        results.append({'start': started, 'first_segment': first_segment[0] if first_segment else None})
+    except Exception as e:
+        print(f'session failed: {e}')
+        results.append({'start': None, 'first_segment': None})
+    finally:
+        await router.close()
+
+
+def print_stats(name, values):
+    values = np.array([v for v in values if v is not None])
+    if not len(values):
+        print(f'  {name:<14} none')
+        return
+    print(f'  {name:<14} p50 {np.percentile(values, 50):5.2f}s  p95 {np.percentile(values, 95):5.2f}s')
+
+
+async def main():
+    results = []
+    tasks = []
+    for _ in range(args.sessions):
+        tasks.append(asyncio.create_task(session(results)))
+        await asyncio.sleep(args.interval)
+    await asyncio.gather(*tasks)
+
+    counters = metrics.snapshot()['counters']
+    print(f'{args.sessions} sessions, one every {args.interval}s, {args.seconds}s each, providers {args.providers}')
+    print_stats('start', [r['start'] for r in results])
+    print_stats('first segment', [r['first_segment'] for r in results])
+    print(f'  failed {sum(r["start"] is None for r in results)}  '
+          f'no segment {sum(r["start"] is not None and r["first_segment"] is None for r in results)}')
+    for provider in args.providers.split(','):
+        connections = metrics.snapshot()['histograms'].get(f'stt_connect_seconds:{provider}', {}).get('count', 0)
+        print(f'  {provider:<12} connections {connections} ({connections / args.sessions:.2f} per session)  ' +
+              '  '.join(f'{name} {counters.get(f"stt_{name}:{provider}", 0):.0f}'
+                        for name in ['pool_hit', 'pool_miss', 'pool_warmed', 'pool_expired', 'router_failover',
+                                     'router_hedge_won']))
+
+
+if __name__ == '__main__':
+    if not os.getenv('SONIOX_WS_URI') and not os.getenv('DEEPGRAM_API_URL'):
+        sys.exit('point the providers to fake_stt_provider.py, see the comment at the top')
+    asyncio.run(main())
@@ -0,0 +1,81 @@
+import argparse
+import random
+import sys
+import time
+from datetime import datetime, timezone
+
+sys.path.append('..')
+
+from models.memory import Memory
+from models.transcript_segment import TranscriptSegment
+
+# Rendering time of transcripts of N segments, the previous quadratic implementation vs the current one, and the
+# memoized Memory.get_transcript.
+# python transcript_render_benchmark.py [--segments 10000] [--previous]
+#
+# --previous also runs the previous implementation, it takes minutes at 10k segments.
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--segments', type=int, default=10000)
+parser.add_argument('--previous', action='store_true')
+args = parser.parse_args()
+
+words = 'so we should probably ship the new sync flow before the weekend and then look at the battery numbers'.split()
+
+
+def previous_segments_as_string(segments, include_timestamps=False, user_name: str = None):
+    if not user_name:
+        user_name = 'User'
+    transcript = ''
+    include_timestamps = include_timestamps and previous_can_display_seconds(segments)
+    for segment in segments:
+        segment_text = segment.text.strip()
+        timestamp_str = f'[{segment.get_timestamp_string()}] ' if include_timestamps else ''
+        transcript += f'{timestamp_str}{user_name if segment.is_user else f"Speaker {segment.speaker_id}"}: {segment_text}\n\n'
+    return transcript.strip()
+
+
+def previous_can_display_seconds(segments):
+    for i in range(len(segments)):
+        for j in range(i + 1, len(segments)):
+            if segments[i].start > segments[j].end or segments[i].end > segments[j].start:
+                return False
+    return True
+
+
+def build_segments(count: int):
+    segments, start = [], 0.0
+    for _ in range(count):
+        duration = random.uniform(1, 8)
+        speaker = random.randint(0, 3)
+        segments.append(TranscriptSegment(
+            text=' '.join(random.choices(words, k=random.randint(4, 30))), speaker=f'SPEAKER_0{speaker}',
+            is_user=speaker == 0, start=start, end=start + duration,
+        ))
+        start += duration + random.uniform(0, 2)
+    return segments
+
+
+def timed(name, fn, repeat=1):
+    start = time.time()
+    for _ in range(repeat):
+        result = fn()
+    print(f'  {name:<32} {(time.time() - start) / repeat * 1000:10.2f} ms')
+    return result
+
+
+if __name__ == '__main__':
+    random.seed(7)
+    segments = build_segments(args.segments)
+    now = datetime.now(timezone.utc)
+    memory = Memory(id='benchmark', created_at=now, started_at=now, finished_at=now, structured={},
+                    transcript_segments=segments)
+
+    print(f'{args.segments} segments')
+    current = timed('segments_as_string', lambda: TranscriptSegment.segments_as_string(segments, True), 5)
+    if args.previous:
+        previous = timed('previous segments_as_string', lambda: previous_segments_as_string(segments, True))
+        print('  same output:', previous == current)
+    timed('segments_as_string compact', lambda: TranscriptSegment.segments_as_string(segments, compact=True), 5)
+    timed('get_transcript first call', lambda: memory.get_transcript(False))
+    timed('get_transcript memoized', lambda: memory.get_transcript(False), 100)
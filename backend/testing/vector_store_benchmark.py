@@ -0,0 +1,120 @@
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.append('..')
+
+from database.vector_store import LocalVectorStore, PineconeVectorStore, VectorStore, matches_filter
+
+# Recall@k and query latency of the vector stores on a synthetic corpus, against exact float64 search.
+# python vector_store_benchmark.py [--vectors 100000] [--users 10] [--dim 768] [--queries 200] [--k 5]
+#                                  [--pinecone] (uses PINECONE_API_KEY / PINECONE_INDEX_NAME, namespace benchmark)
+#
+# The corpus is clustered, as memories of a user are, and has the metadata query_vectors_by_metadata filters on.
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--vectors', type=int, default=100000)
+parser.add_argument('--users', type=int, default=10)
+parser.add_argument('--dim', type=int, default=768)
+parser.add_argument('--queries', type=int, default=200)
+parser.add_argument('--k', type=int, default=5)
+parser.add_argument('--pinecone', action='store_true')
+args = parser.parse_args()
+
+topics = [f'topic {i}' for i in range(50)]
+people = [f'person {i}' for i in range(30)]
+
+
+def build_corpus(rng):
+    centers = rng.normal(size=(64, args.dim)).astype(np.float32)
+    labels = rng.integers(0, len(centers), args.vectors)
+    vectors = centers[labels] + rng.normal(scale=0.6, size=(args.vectors, args.dim)).astype(np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    items = []
+    for i in range(args.vectors):
+        uid = f'user{i % args.users}'
+        items.append({'id': f'{uid}-memory{i}', 'values': vectors[i], 'metadata': {
+            'uid': uid, 'memory_id': f'memory{i}', 'created_at': 1700000000 + i * 60,
+            'topics': list(rng.choice(topics, 3, replace=False)), 'people': list(rng.choice(people, 2, replace=False)),
+        }})
+    return items, vectors, centers
+
+
+def random_filter(rng, uid: str) -> dict:
+    if rng.random() < 0.5:
+        return {'uid': uid}
+    start = 1700000000 + int(rng.integers(0, args.vectors // 2)) * 60
+    return {'$and': [
+        {'uid': {'$eq': uid}},
+        {'$or': [{'people': {'$in': [str(rng.choice(people))]}}, {'topics': {'$in': [str(rng.choice(topics))]}}]},
+        {'created_at': {'$gte': start, '$lte': start + args.vectors * 30}},
+    ]}
+
+
+def exact_top_k(items, vectors64, query, filter) -> list:
+    candidates = [i for i, item in enumerate(items) if matches_filter(item['metadata'], filter)]
+    if not candidates:
+        return []
+    scores = vectors64[candidates] @ query
+    return [items[candidates[i]]['id'] for i in np.argsort(-scores)[:args.k]]
+
+
+def load(store: VectorStore, items, namespace: str):
+    start = time.time()
+    for i in range(0, len(items), 500):
+        store.upsert([{**item, 'values': item['values'].tolist()} for item in items[i:i + 500]], namespace)
+    print(f'  loaded {len(items)} vectors in {time.time() - start:.1f}s')
+
+
+def evaluate(name: str, store: VectorStore, namespace: str, queries, truths):
+    latencies, recalls = [], []
+    for (query, filter), truth in zip(queries, truths):
+        start = time.time()
+        result = store.query(vector=query.tolist(), top_k=args.k, namespace=namespace, filter=filter)
+        latencies.append((time.time() - start) * 1000)
+        found = [m['id'] for m in result['matches']]
+        if truth:
+            recalls.append(len(set(found) & set(truth)) / len(truth))
+    latencies = np.array(latencies)
+    print(f'  {name:<10} recall@{args.k} {np.mean(recalls):.3f}  p50 {np.percentile(latencies, 50):7.2f} ms  '
+          f'p95 {np.percentile(latencies, 95):7.2f} ms  p99 {np.percentile(latencies, 99):7.2f} ms')
+
+
+if __name__ == '__main__':
+    rng = np.random.default_rng(7)
+    items, vectors, centers = build_corpus(rng)
+    vectors64 = vectors.astype(np.float64)
+    print(f'{args.vectors} vectors, {args.users} users, dim {args.dim}')
+
+    queries = []
+    for _ in range(args.queries):
+        query = centers[rng.integers(0, len(centers))] + rng.normal(scale=0.6, size=args.dim)
+        queries.append((query / np.linalg.norm(query), random_filter(rng, f'user{rng.integers(0, args.users)}')))
+    truths = [exact_top_k(items, vectors64, query, filter) for query, filter in queries]
+
+    path = tempfile.mkdtemp(prefix='vectors')
+    try:
+        print('local')
+        local = LocalVectorStore(path)
+        load(local, items, 'benchmark')
+        evaluate('local', local, 'benchmark', queries, truths)
+        evaluate('reopened', LocalVectorStore(path), 'benchmark', queries, truths)
+    finally:
+        shutil.rmtree(path)
+
+    if args.pinecone:
+        from pinecone import Pinecone
+
+        print('pinecone')
+        pinecone = PineconeVectorStore(
+            Pinecone(api_key=os.getenv('PINECONE_API_KEY')).Index(os.getenv('PINECONE_INDEX_NAME'))
+        )
+        load(pinecone, items, 'benchmark')
+        time.sleep(10)  # upserts are eventually consistent
+        evaluate('pinecone', pinecone, 'benchmark', queries, truths)
+        pinecone.index.delete(delete_all=True, namespace='benchmark')
@@ -1,7 +1,10 @@
+import ctypes
 import wave
+from abc import ABC, abstractmethod
 
+import opuslib
+import opuslib.api.decoder
 from pydub import AudioSegment
-from pyogg import OpusDecoder
 
 
 def merge_wav_files(dest_file_path: str, source_files: [str], silent_seconds: [int]):
@@ -17,65 +20,106 @@ def merge_wav_files(dest_file_path: str, source_files: [str], silent_seconds: [i
     combined_sounds.export(dest_file_path, format="wav")
 
 
-# frames is 2darray
-def create_wav_from_bytes(
-        file_path: str, frames: [], codec: str, frame_rate: int = 16000, channels: int = 1, sample_width: int = 2
-):
-    # opus
-    if codec == "opus":
-        # Create an Opus decoder
-        opus_decoder = OpusDecoder()
-        opus_decoder.set_channels(channels)
-        opus_decoder.set_sampling_frequency(frame_rate)
+# ********************************
+# ************ CODECS ************
+# ********************************
 
-        wave_write = wave.open(file_path, "wb")
-        # Save the wav's specification
-        wave_write.setnchannels(channels)
-        wave_write.setframerate(frame_rate)
-        wave_write.setsampwidth(sample_width)
+class Codec(ABC):
+    """
+    Decodes the audio packets sent by the devices into pcm16.
 
-        encoded_packets = []
-        for frame in frames:
-            encoded_packets.append(memoryview(bytearray(frame)))
+    The returned memoryviews may point to a buffer that is reused by later calls (see OpusCodec), consumers
+    should use or copy them before decoding more packets.
+    """
 
-        for encoded_packet in encoded_packets:
-            decoded_pcm = opus_decoder.decode(encoded_packet)
+    name: str = None
 
-            # Save the decoded PCM as a new wav file
-            wave_write.writeframes(decoded_pcm)
+    def __init__(self, sample_rate: int = 16000, channels: int = 1):
+        self.sample_rate = sample_rate
+        self.channels = channels
 
-        wave_write.close()
+    @abstractmethod
+    def decode(self, packet) -> memoryview:
+        pass
 
-        return
+    def decode_frames(self, packets):
+        for packet in packets:
+            yield self.decode(packet)
 
-    # pcm16
-    if codec == "pcm16":
-        wave_write = wave.open(file_path, "wb")
-        # Save the wav's specification
-        wave_write.setnchannels(channels)
-        wave_write.setframerate(frame_rate)
-        wave_write.setsampwidth(sample_width)
 
-        for frame in frames:
-            decoded_pcm = frame
-            wave_write.writeframes(decoded_pcm)
+class PCMCodec(Codec):
+    """pcm8 and pcm16 are already pcm16 samples (at 8kHz and 16kHz), nothing to decode."""
 
-        wave_write.close()
-        return
+    def __init__(self, name: str, sample_rate: int = 16000, channels: int = 1):
+        super().__init__(sample_rate, channels)
+        self.name = name
 
-    # pcm8
-    if codec == "pcm8":
-        wave_write = wave.open(file_path, "wb")
-        # Save the wav's specification
-        wave_write.setnchannels(channels)
-        wave_write.setframerate(frame_rate)
-        wave_write.setsampwidth(sample_width)
+    def decode(self, packet) -> memoryview:
+        return memoryview(packet).cast('B')
 
-        for frame in frames:
-            decoded_pcm = frame
-            wave_write.writeframes(decoded_pcm)
 
-        wave_write.close()
-        return
+class OpusCodec(Codec):
+    """
+    Opus decoder writing into a preallocated ring of `slots` pcm buffers, instead of allocating a new
+    array and bytes object per packet like `opuslib.Decoder.decode` does.
+    """
+
+    name = 'opus'
+
+    def __init__(self, sample_rate: int = 16000, channels: int = 1, slots: int = 64):
+        super().__init__(sample_rate, channels)
+        self._decoder = opuslib.Decoder(sample_rate, channels)
+
+        # Opus packets hold up to 120 ms of audio.
+        self.max_frame_size = sample_rate * 120 // 1000
+        self.slot_bytes = self.max_frame_size * channels * 2
+        self.slots = slots
+        self._ring = bytearray(self.slot_bytes * slots)
+        self._ring_view = memoryview(self._ring)
+        ring_samples = (ctypes.c_int16 * (len(self._ring) // 2)).from_buffer(self._ring)
+        self._pointers = [
+            ctypes.cast(ctypes.byref(ring_samples, i * self.slot_bytes), opuslib.api.c_int16_pointer)
+            for i in range(slots)
+        ]
+        self._ring_samples = ring_samples
+        self._slot = 0
+
+    def decode(self, packet) -> memoryview:
+        if not isinstance(packet, bytes):
+            packet = bytes(packet)
+        slot = self._slot
+        self._slot = (slot + 1) % self.slots
 
+        result = opuslib.api.decoder.libopus_decode(
+            self._decoder._state, packet, len(packet), self._pointers[slot], self.max_frame_size, 0
+        )
+        if result < 0:
+            raise opuslib.OpusError(result)
+
+        start = slot * self.slot_bytes
+        return self._ring_view[start:start + result * self.channels * 2]
+
+
+def get_codec(codec: str, sample_rate: int = 16000, channels: int = 1) -> Codec:
+    if codec == 'opus':
+        return OpusCodec(sample_rate, channels)
+    if codec in ('pcm8', 'pcm16'):
+        return PCMCodec(codec, sample_rate, channels)
     raise Exception(f"codec {codec} is not supported")
+
+
+# frames is 2darray
+def create_wav_from_bytes(
+        file_path: str, frames: [], codec: str, frame_rate: int = 16000, channels: int = 1, sample_width: int = 2
+):
+    decoder = get_codec(codec, frame_rate, channels)
+    wave_write = wave.open(file_path, "wb")
+    # Save the wav's specification
+    wave_write.setnchannels(channels)
+    wave_write.setframerate(frame_rate)
+    wave_write.setsampwidth(sample_width)
+
+    for decoded_pcm in decoder.decode_frames(frames):
+        wave_write.writeframes(decoded_pcm)
+
+    wave_write.close()
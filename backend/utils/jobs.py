@@ -0,0 +1,149 @@
+import os
+import random
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone, timedelta
+from typing import Callable, Dict, Optional
+
+import database.jobs as jobs_db
+from models.job import Job, JobType
+from utils.llm_cache import bypass_llm_cache, llm_cache_bypassed
+from utils.llm_scheduler import llm_priority, LLMPriority
+from utils.other import metrics
+
+# Background work goes through the Redis queue and runs in the worker app (worker/main.py), when disabled it runs
+# in this process instead, which is handy locally without a worker running.
+job_queue_enabled = os.getenv('JOB_QUEUE_ENABLED', 'false') == 'true'
+# Jobs a worker container runs at a time.
+job_worker_concurrency = int(os.getenv('JOB_WORKER_CONCURRENCY', 16))
+# Seconds a job can run before it's considered lost and handed to another worker.
+job_lease_seconds = int(os.getenv('JOB_LEASE_SECONDS', 600))
+
+_handlers: Dict[JobType, Callable[[Job], None]] = {}
+_local_executor = None
+
+
+def job_handler(job_type: JobType):
+    """Registers the function running `job_type` jobs, it raises to have the job retried."""
+
+    def decorator(func):
+        _handlers[job_type] = func
+        return func
+
+    return decorator
+
+
+def enqueue_job(
+        job_type: JobType, uid: Optional[str] = None, memory_id: Optional[str] = None, payload: Optional[dict] = None,
+        delay_seconds: float = 0, idempotency_key: Optional[str] = None, max_attempts: int = 5,
+) -> Optional[str]:
+    now = datetime.now(timezone.utc)
+    payload = payload or {}
+    if llm_cache_bypassed():
+        payload['bypass_llm_cache'] = True
+    job = Job(
+        id=str(uuid.uuid4()), type=job_type, uid=uid, memory_id=memory_id, payload=payload,
+        idempotency_key=idempotency_key, max_attempts=max_attempts,
+        created_at=now, run_at=now + timedelta(seconds=delay_seconds),
+    )
+    if not job_queue_enabled:
+        _run_locally(job, delay_seconds)
+        return job.id
+
+    job_id = jobs_db.enqueue_job(job)
+    metrics.incr(f'jobs_enqueued:{job_type.value}' if job_id else f'jobs_deduplicated:{job_type.value}')
+    return job_id
+
+
+def enqueue_memory_job(
+        job_type: JobType, uid: str, memory_id: str, payload: Optional[dict] = None, delay_seconds: float = 0,
+) -> Optional[str]:
+    return enqueue_job(
+        job_type, uid=uid, memory_id=memory_id, payload=payload, delay_seconds=delay_seconds,
+        idempotency_key=f'{memory_id}:{job_type.value}',
+    )
+
+
+def _run_locally(job: Job, delay_seconds: float):
+    global _local_executor
+    if _local_executor is None:
+        _local_executor = ThreadPoolExecutor(max_workers=job_worker_concurrency, thread_name_prefix='local-job')
+    if delay_seconds:
+        timer = threading.Timer(delay_seconds, _local_executor.submit, args=(run_job, job, False))
+        timer.daemon = True
+        timer.start()
+    else:
+        _local_executor.submit(run_job, job, False)
+
+
+def _retry_delay_seconds(attempts: int) -> float:
+    return min(10 * 2 ** (attempts - 1), 600) + random.random() * 5
+
+
+def run_job(job: Job, queued: bool = True):
+    handler = _handlers.get(job.type)
+    start = time.time()
+    try:
+        if handler is None:
+            raise Exception(f'No handler for {job.type}, is its module imported by the worker?')
+        with llm_priority(LLMPriority.enrichment, job.uid):
+            if job.payload.get('bypass_llm_cache'):
+                with bypass_llm_cache():
+                    handler(job)
+            else:
+                handler(job)
+        metrics.incr(f'jobs_completed:{job.type.value}')
+        metrics.observe(f'jobs_seconds:{job.type.value}', time.time() - start)
+        metrics.observe(f'jobs_latency_seconds:{job.type.value}',
+                        (datetime.now(timezone.utc) - job.run_at).total_seconds())
+        if queued:
+            jobs_db.complete_job(job)
+    except Exception as e:
+        job.attempts += 1
+        job.last_error = str(e)
+        print(f'run_job {job.type.value} {job.id} attempt {job.attempts} failed: {e}')
+        if not queued:
+            return
+        if job.attempts >= job.max_attempts:
+            metrics.incr(f'jobs_dead:{job.type.value}')
+            jobs_db.fail_job(job)
+        else:
+            metrics.incr(f'jobs_retried:{job.type.value}')
+            job.run_at = datetime.now(timezone.utc) + timedelta(seconds=_retry_delay_seconds(job.attempts))
+            jobs_db.retry_job(job)
+
+
+def run_worker(concurrency: int = job_worker_concurrency, max_seconds: Optional[float] = None, poll_seconds: float = 1):
+    """Claims and runs jobs, at most `concurrency` at a time, stops claiming after `max_seconds` and drains."""
+    executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='job')
+    running = set()
+    lock = threading.Lock()
+    start = time.time()
+
+    def _done(future):
+        with lock:
+            running.discard(future)
+
+    print('run_worker started, concurrency', concurrency, 'handlers', [t.value for t in _handlers])
+    while max_seconds is None or time.time() - start < max_seconds:
+        with lock:
+            free = concurrency - len(running)
+        jobs = []
+        if free > 0:
+            try:
+                jobs = jobs_db.claim_jobs(free, job_lease_seconds)
+            except Exception as e:
+                print(f'run_worker could not claim jobs: {e}')
+        for job in jobs:
+            future = executor.submit(run_job, job)
+            with lock:
+                running.add(future)
+            future.add_done_callback(_done)
+        metrics.gauge('jobs_running', len(running))
+        if not jobs:
+            time.sleep(poll_seconds)
+
+    executor.shutdown(wait=True)
+    print('run_worker stopped after', round(time.time() - start), 'seconds')
@@ -1,15 +1,22 @@
+import asyncio
+import contextvars
 import json
+import os
+import queue
 import re
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime
-from typing import List, Optional
+from typing import Dict, Generator, List, Optional, Tuple
 
 import tiktoken
+from langchain_core.embeddings import Embeddings
 from langchain_core.output_parsers import PydanticOutputParser
 from langchain_core.prompts import ChatPromptTemplate
-from langchain_openai import ChatOpenAI, OpenAIEmbeddings
+from langchain_openai import OpenAIEmbeddings
 from pydantic import BaseModel, Field, ValidationError
 
-from database.redis_db import add_filter_category_item
 from models.chat import Message
 from models.facts import Fact
 from models.memory import Structured, MemoryPhoto, CategoryEnum, Memory
@@ -17,10 +24,105 @@ from models.plugin import Plugin
 from models.transcript_segment import TranscriptSegment
 from models.trend import TrendEnum, ceo_options, company_options, software_product_options, hardware_product_options, \
     ai_product_options, TrendType
+from utils.llm_cache import llm_cache, CachedEmbeddings, LRU, cache_key, llm_cache_bypassed
+from utils.llm_scheduler import ScheduledChatOpenAI
 from utils.memories.facts import get_prompt_facts
-
-llm_mini = ChatOpenAI(model='gpt-4o-mini')
-embeddings = OpenAIEmbeddings(model="text-embedding-3-large")
+from utils.other import metrics
+
+# Embedding requests from all threads and coroutines are sent together, a batch goes out when it has
+# `max_batch_size` texts or `max_wait_ms` after its first text.
+embedding_batch_max_size = int(os.getenv('EMBEDDING_BATCH_MAX_SIZE', 128))
+embedding_batch_max_wait_ms = float(os.getenv('EMBEDDING_BATCH_MAX_WAIT_MS', 5))
+embedding_batch_concurrency = int(os.getenv('EMBEDDING_BATCH_CONCURRENCY', 4))
+embedding_timeout_seconds = float(os.getenv('EMBEDDING_TIMEOUT_SECONDS', 30))
+
+
+class EmbeddingBroker(Embeddings):
+    """Micro-batches `embed_documents` calls across callers into few API requests, and scatters the vectors back."""
+
+    def __init__(self, underlying: Embeddings, max_batch_size: int = embedding_batch_max_size,
+                 max_wait_ms: float = embedding_batch_max_wait_ms, concurrency: int = embedding_batch_concurrency,
+                 timeout: float = embedding_timeout_seconds):
+        self.underlying = underlying
+        self.max_batch_size = max_batch_size
+        self.max_wait_seconds = max_wait_ms / 1000
+        self.timeout = timeout
+        self._queue = queue.Queue()
+        self._executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='embeddings')
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def _submit(self, texts: List[str]) -> Future:
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._collect, daemon=True, name='embedding-broker')
+                self._thread.start()
+        future = Future()
+        self._queue.put((texts, future))
+        return future
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        if not texts:
+            return []
+        return self._submit(texts).result(timeout=self.timeout)
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        if not texts:
+            return []
+        return await asyncio.wait_for(asyncio.wrap_future(self._submit(texts)), self.timeout)
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+    async def aembed_query(self, text: str) -> List[float]:
+        return (await self.aembed_documents([text]))[0]
+
+    def _collect(self):
+        while True:
+            requests = [self._queue.get()]
+            count = len(requests[0][0])
+            deadline = time.time() + self.max_wait_seconds
+            while count < self.max_batch_size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    request = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                requests.append(request)
+                count += len(request[0])
+            self._executor.submit(self._send, requests)
+
+    def _send(self, requests: List[Tuple[List[str], Future]]):
+        texts = [text for request_texts, _ in requests for text in request_texts]
+        start = time.time()
+        try:
+            vectors = []
+            for i in range(0, len(texts), self.max_batch_size):
+                vectors += self.underlying.embed_documents(texts[i:i + self.max_batch_size])
+        except Exception as e:
+            print(f'EmbeddingBroker batch of {len(texts)} failed: {e}')
+            metrics.incr('embedding_batch_errors')
+            for _, future in requests:
+                future.set_exception(e)
+            return
+
+        metrics.observe('embedding_batch_size', len(texts))
+        metrics.observe('embedding_batch_seconds', time.time() - start)
+        offset = 0
+        for request_texts, future in requests:
+            future.set_result(vectors[offset:offset + len(request_texts)])
+            offset += len(request_texts)
+
+
+llm_mini = ScheduledChatOpenAI(model='gpt-4o-mini')
+# memory processing calls get the same input again on reprocess, postprocess, sync and crons, chat calls are not cached
+llm_mini_cached = ScheduledChatOpenAI(model='gpt-4o-mini', cache=llm_cache)
+llm_cached = ScheduledChatOpenAI(model='gpt-4o', cache=llm_cache)
+embeddings = CachedEmbeddings(
+    EmbeddingBroker(OpenAIEmbeddings(model="text-embedding-3-large")), model="text-embedding-3-large", dimensions=3072
+)
 parser = PydanticOutputParser(pydantic_object=Structured)
 
 encoding = tiktoken.encoding_for_model('gpt-4')
@@ -32,7 +134,105 @@ def num_tokens_from_string(string: str) -> int:
     return num_tokens
 
 
-# TODO: include caching layer, redis
+# *************************************************
+# ************* TRANSCRIPT COMPACTION **************
+# *************************************************
+
+# Oversize transcripts are split in chunks of this size, each summarized on its own (map), and the summaries are
+# joined, summarized again if still over budget (reduce). Chunking and the chunk prompt don't depend on the consumer,
+# so every consumer of a memory shares the same chunk summaries.
+transcript_chunk_tokens = 3000
+transcript_chunk_summary_words = 400
+_chunk_summaries = LRU(256)
+# chunk summaries being requested, concurrent consumers of the same memory (plugins) wait for the first request
+_chunk_in_flight: Dict[str, Future] = {}
+_chunk_in_flight_lock = threading.Lock()
+
+
+def _split_transcript(transcript: str, chunk_tokens: int) -> List[str]:
+    chunks, current, current_tokens = [], [], 0
+    for paragraph in transcript.split('\n\n'):
+        tokens = encoding.encode(paragraph)
+        if len(tokens) > chunk_tokens:
+            # a single turn longer than a chunk, split it by tokens
+            parts = [encoding.decode(tokens[i:i + chunk_tokens]) for i in range(0, len(tokens), chunk_tokens)]
+        else:
+            parts = [paragraph]
+        for part in parts:
+            part_tokens = num_tokens_from_string(part)
+            if current and current_tokens + part_tokens > chunk_tokens:
+                chunks.append('\n\n'.join(current))
+                current, current_tokens = [], 0
+            current.append(part)
+            current_tokens += part_tokens
+    if current:
+        chunks.append('\n\n'.join(current))
+    return chunks
+
+
+def _summarize_transcript_chunk(chunk: str) -> str:
+    key = cache_key('transcript_chunk', chunk)
+    bypassed = llm_cache_bypassed()
+    with _chunk_in_flight_lock:
+        if not bypassed and (summary := _chunk_summaries.get(key)) is not None:
+            return summary
+        future = _chunk_in_flight.get(key)
+        requesting = future is None
+        if requesting:
+            future = _chunk_in_flight[key] = Future()
+    if not requesting:
+        return future.result()
+
+    prompt = f'''
+    You will be given a part of a conversation transcript.
+    Condense it into notes of at most {transcript_chunk_summary_words} words, in the same language, keeping who said what (keep the speaker labels), names, places, numbers, dates, commitments, decisions, opinions and anything said about the speakers themselves. Leave out small talk.
+
+    Transcript part:
+    ```
+    {chunk}
+    ```
+    '''.replace('    ', '').strip()
+    try:
+        summary = llm_mini_cached.invoke(prompt).content.strip()
+        _chunk_summaries.set(key, summary)
+        future.set_result(summary)
+        return summary
+    except Exception as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with _chunk_in_flight_lock:
+            _chunk_in_flight.pop(key, None)
+
+
+def fit_transcript_to_budget(transcript: str, token_budget: int, depth: int = 0) -> str:
+    """Returns `transcript` if it has at most `token_budget` tokens, else a map-reduce summary of it within budget."""
+    tokens = num_tokens_from_string(transcript)
+    if tokens <= token_budget:
+        return transcript
+
+    chunks = _split_transcript(transcript, transcript_chunk_tokens)
+    if len(chunks) == 1 or depth == 3:
+        metrics.incr('transcript_compaction:truncated')
+        return encoding.decode(encoding.encode(transcript)[:token_budget])
+
+    start = time.time()
+    context = contextvars.copy_context()
+    with ThreadPoolExecutor(max_workers=min(len(chunks), 8), thread_name_prefix='transcript-chunk') as executor:
+        futures = [executor.submit(context.copy().run, _summarize_transcript_chunk, chunk) for chunk in chunks]
+        summaries = [future.result() for future in futures]
+    metrics.incr('transcript_compaction:summarized')
+    metrics.observe('transcript_compaction_seconds', time.time() - start)
+    metrics.observe('transcript_compaction_chunks', len(chunks))
+
+    summary = '\n\n'.join(f'[Part {i + 1}/{len(chunks)}] {text}' for i, text in enumerate(summaries))
+    return fit_transcript_to_budget(summary, token_budget, depth + 1)
+
+
+def compact_transcript(segments: List[TranscriptSegment], token_budget: int, user_name: str = None) -> str:
+    """The transcript of `segments` with filler removed and same speaker turns merged, summarized if over budget."""
+    transcript = TranscriptSegment.segments_as_string(segments, user_name=user_name, compact=True)
+    return fit_transcript_to_budget(transcript, token_budget)
 
 
 # **********************************************
@@ -61,7 +261,7 @@ def should_discard_memory(transcript: str) -> bool:
     
     {format_instructions}'''.replace('    ', '').strip()
     ])
-    chain = prompt | llm_mini | parser
+    chain = prompt | llm_mini_cached | parser
     try:
         response: DiscardMemory = chain.invoke({
             'transcript': transcript.strip(),
@@ -74,7 +274,11 @@ def should_discard_memory(transcript: str) -> bool:
         return False
 
 
+transcript_structure_token_budget = 12000
+
+
 def get_transcript_structure(transcript: str, started_at: datetime, language_code: str, tz: str) -> Structured:
+    transcript = fit_transcript_to_budget(transcript, transcript_structure_token_budget)
     prompt = ChatPromptTemplate.from_messages([(
         'system',
         '''You are an expert conversation analyzer. Your task is to analyze the conversation and provide structure and clarity to the recording transcription of a conversation.
@@ -90,7 +294,7 @@ def get_transcript_structure(transcript: str, started_at: datetime, language_cod
 
         {format_instructions}'''.replace('    ', '').strip()
     )])
-    chain = prompt | ChatOpenAI(model='gpt-4o') | parser
+    chain = prompt | llm_cached | parser
 
     response = chain.invoke({
         'transcript': transcript.strip(),
@@ -100,14 +304,22 @@ def get_transcript_structure(transcript: str, started_at: datetime, language_cod
         'tz': tz,
     })
 
-    for event in (response.events or []):
+    return _clean_structure(response)
+
+
+def _clean_structure(structured: Structured) -> Structured:
+    for event in (structured.events or []):
         if event.duration > 180:
             event.duration = 180
         event.created = False
-    return response
+    return structured
+
+
+plugin_result_token_budget = 6000
 
 
 def get_plugin_result(transcript: str, plugin: Plugin) -> str:
+    transcript = fit_transcript_to_budget(transcript, plugin_result_token_budget)
     prompt = f'''
     Your are an AI with the following characteristics:
     Name: ${plugin.name}, 
@@ -123,13 +335,108 @@ def get_plugin_result(transcript: str, plugin: Plugin) -> str:
     Make sure to be concise and clear.
     '''
 
-    response = llm_mini.invoke(prompt)
-    content = response.content.replace('```json', '').replace('```', '')
+    response = llm_mini_cached.invoke(prompt)
+    return _clean_plugin_result(response.content)
+
+
+def _clean_plugin_result(content: str) -> str:
+    content = content.replace('```json', '').replace('```', '')
     if len(content) < 5:
         return ''
     return content
 
 
+# Opt-in, memory prompt plugins are asked together, one structured output call per batch instead of one call each,
+# the transcript is paid once per batch. A batch is at most `plugin_batch_token_budget` prompt tokens.
+plugin_batching_enabled = os.getenv('PLUGIN_BATCHING_ENABLED', 'false') == 'true'
+plugin_batch_token_budget = int(os.getenv('PLUGIN_BATCH_TOKEN_BUDGET', 10000))
+plugin_batch_max_size = int(os.getenv('PLUGIN_BATCH_MAX_SIZE', 6))
+
+
+class PluginOutput(BaseModel):
+    plugin_id: str = Field(description="The id of the plugin")
+    content: str = Field(
+        description="The plugin response in plain text, empty if the conversation has nothing to do with its task"
+    )
+
+
+class PluginsOutput(BaseModel):
+    results: List[PluginOutput] = Field(description="One result per plugin")
+
+
+def _plugin_description(plugin: Plugin) -> str:
+    return f'Plugin id: {plugin.id}\nName: {plugin.name}\nDescription: {plugin.description}\nTask: {plugin.memory_prompt}'
+
+
+def get_plugin_batches(transcript: str, plugins: List[Plugin]) -> List[List[Plugin]]:
+    """Packs `plugins` in order into batches within the token budget, a plugin that doesn't fit with others is alone."""
+    transcript_tokens = num_tokens_from_string(fit_transcript_to_budget(transcript, plugin_result_token_budget))
+    batches, current, tokens = [], [], transcript_tokens
+    for plugin in plugins:
+        plugin_tokens = num_tokens_from_string(_plugin_description(plugin))
+        if current and (tokens + plugin_tokens > plugin_batch_token_budget or len(current) == plugin_batch_max_size):
+            batches.append(current)
+            current, tokens = [], transcript_tokens
+        current.append(plugin)
+        tokens += plugin_tokens
+    if current:
+        batches.append(current)
+    return batches
+
+
+def get_plugins_results(transcript: str, plugins: List[Plugin]) -> Dict[str, str]:
+    """
+    Results of several plugins in one call, by plugin id, as `get_plugin_result` would give them. The plugins missing
+    from the response, or all of them if it can't be parsed, are asked on their own. Plugins failing are left out.
+    """
+    if len(plugins) == 1:
+        return {plugins[0].id: get_plugin_result(transcript, plugins[0])}
+
+    transcript = fit_transcript_to_budget(transcript, plugin_result_token_budget)
+    plugins_str = '\n\n'.join(_plugin_description(plugin) for plugin in plugins)
+    prompt = f'''
+    You will be given a conversation and a list of AI plugins, each with its own characteristics and task.
+    For each plugin, act as that plugin and perform its task on the conversation, independently of the other plugins.
+
+    Note: It is possible that the conversation you are given, has nothing to do with the task of a plugin, \
+    in that case, output an empty string for it. (For example, you are given a business conversation, but the task is medical analysis)
+
+    Each response should be in plain text, without markdown.
+    Make sure to be concise and clear.
+
+    Plugins:
+    {plugins_str}
+
+    Conversation: ```{transcript.strip()}```
+    '''.replace('    ', '').strip()
+
+    ids = {plugin.id for plugin in plugins}
+    results = {}
+    try:
+        response: PluginsOutput = llm_mini_cached.with_structured_output(PluginsOutput).invoke(prompt)
+        results = {r.plugin_id: _clean_plugin_result(r.content) for r in response.results if r.plugin_id in ids}
+    except Exception as e:
+        print(f'Error getting batched plugins results: {e}')
+        metrics.incr('plugin_batch_errors')
+
+    missing = [plugin for plugin in plugins if plugin.id not in results]
+    if not missing:
+        return results
+
+    # asked concurrently, one after another they could take longer than the batch stage timeout
+    metrics.incr('plugin_batch_fallbacks', len(missing))
+    context = contextvars.copy_context()
+    with ThreadPoolExecutor(max_workers=len(missing), thread_name_prefix='plugin-fallback') as executor:
+        futures = {plugin.id: executor.submit(context.copy().run, get_plugin_result, transcript, plugin)
+                   for plugin in missing}
+        for plugin_id, future in futures.items():
+            try:
+                results[plugin_id] = future.result()
+            except Exception as e:
+                print(f'Error getting plugin {plugin_id} result: {e}')
+    return results
+
+
 # **************************************
 # ************* OPENGLASS **************
 # **************************************
@@ -146,7 +453,7 @@ def summarize_open_glass(photos: List[MemoryPhoto]) -> Structured:
     
       Photos Descriptions: ```{photos_str}```
       '''.replace('    ', '').strip()
-    return llm_mini.with_structured_output(Structured).invoke(prompt)
+    return llm_mini_cached.with_structured_output(Structured).invoke(prompt)
 
 
 # **************************************************
@@ -163,7 +470,7 @@ def summarize_experience_text(text: str) -> Structured:
     
       Text: ```{text}```
       '''.replace('    ', '').strip()
-    return llm_mini.with_structured_output(Structured).invoke(prompt)
+    return llm_mini_cached.with_structured_output(Structured).invoke(prompt)
 
 
 def get_memory_summary(uid: str, memories: List[Memory]) -> str:
@@ -187,7 +494,7 @@ def get_memory_summary(uid: str, memories: List[Memory]) -> str:
     ```
     """.replace('    ', '').strip()
     # print(prompt)
-    return llm_mini.invoke(prompt).content
+    return llm_mini_cached.invoke(prompt).content
 
 
 def generate_embedding(content: str) -> List[float]:
@@ -325,12 +632,12 @@ def chunk_extraction(segments: List[TranscriptSegment], topics: List[str]) -> st
 
     Topics: {topics}
     '''
-    with_parser = llm_mini.with_structured_output(SummaryOutput)
+    with_parser = llm_mini_cached.with_structured_output(SummaryOutput)
     response: SummaryOutput = with_parser.invoke(prompt)
     return response.summary
 
 
-def answer_simple_message(uid: str, messages: List[Message], plugin: Optional[Plugin] = None) -> str:
+def _simple_message_prompt(uid: str, messages: List[Message], plugin: Optional[Plugin] = None) -> str:
     conversation_history = Message.get_messages_as_string(
         messages, use_user_name_if_available=True, use_plugin_name_if_available=True
     )
@@ -353,10 +660,22 @@ def answer_simple_message(uid: str, messages: List[Message], plugin: Optional[Pl
     Answer:
     """.replace('    ', '').strip()
     print(prompt)
-    return llm_mini.invoke(prompt).content
+    return prompt
 
 
-def qa_rag(uid: str, question: str, context: str, plugin: Optional[Plugin] = None) -> str:
+def answer_simple_message(uid: str, messages: List[Message], plugin: Optional[Plugin] = None) -> str:
+    return llm_mini.invoke(_simple_message_prompt(uid, messages, plugin)).content
+
+
+def answer_simple_message_stream(
+        uid: str, messages: List[Message], plugin: Optional[Plugin] = None
+) -> Generator[str, None, None]:
+    for chunk in llm_mini.stream(_simple_message_prompt(uid, messages, plugin)):
+        if chunk.content:
+            yield chunk.content
+
+
+def _qa_rag_prompt(uid: str, question: str, context: str, plugin: Optional[Plugin] = None) -> str:
     user_name, facts_str = get_prompt_facts(uid)
 
     plugin_info = ""
@@ -385,7 +704,19 @@ def qa_rag(uid: str, question: str, context: str, plugin: Optional[Plugin] = Non
     Answer:
     """.replace('    ', '').strip()
     print('QA Using context:', context)
-    return llm_mini.invoke(prompt).content
+    return prompt
+
+
+def qa_rag(uid: str, question: str, context: str, plugin: Optional[Plugin] = None) -> str:
+    return llm_mini.invoke(_qa_rag_prompt(uid, question, context, plugin)).content
+
+
+def qa_rag_stream(
+        uid: str, question: str, context: str, plugin: Optional[Plugin] = None
+) -> Generator[str, None, None]:
+    for chunk in llm_mini.stream(_qa_rag_prompt(uid, question, context, plugin)):
+        if chunk.content:
+            yield chunk.content
 
 
 # **************************************************
@@ -408,7 +739,7 @@ def retrieve_memory_context_params(memory: Memory) -> List[str]:
     '''.replace('    ', '').strip()
 
     try:
-        with_parser = llm_mini.with_structured_output(TopicsContext)
+        with_parser = llm_mini_cached.with_structured_output(TopicsContext)
         response: TopicsContext = with_parser.invoke(prompt)
         return response.topics
     except Exception as e:
@@ -456,10 +787,13 @@ class Facts(BaseModel):
     )
 
 
+new_facts_token_budget = 6000
+
+
 def new_facts_extractor(uid: str, segments: List[TranscriptSegment]) -> List[Fact]:
     user_name, facts_str = get_prompt_facts(uid)
 
-    content = TranscriptSegment.segments_as_string(segments, user_name=user_name)
+    content = compact_transcript(segments, new_facts_token_budget, user_name=user_name)
     if not content or len(content) < 100:  # less than 100 chars, probably nothing
         return []
     # TODO: later, focus a lot on user said things, rn is hard because of speech profile accuracy
@@ -490,7 +824,7 @@ def new_facts_extractor(uid: str, segments: List[TranscriptSegment]) -> List[Fac
     '''.replace('    ', '').strip()
 
     try:
-        with_parser = llm_mini.with_structured_output(Facts)
+        with_parser = llm_mini_cached.with_structured_output(Facts)
         response: Facts = with_parser.invoke(prompt)
         # for fact in response:
         #     fact.content = fact.content.replace(user_name, '').replace('The User', '').replace('User', '').strip()
@@ -515,8 +849,21 @@ class ExpectedOutput(BaseModel):
     items: List[Item] = Field(default=[], description="List of items.")
 
 
+def _filter_trend_items(items: List[Item]) -> List[Item]:
+    filtered = []
+    for item in items:
+        if item.topic not in [e for e in (
+                ceo_options + company_options + software_product_options + hardware_product_options + ai_product_options)]:
+            continue
+        filtered.append(item)
+    return filtered
+
+
+trends_token_budget = 4000
+
+
 def trends_extractor(memory: Memory) -> List[Item]:
-    transcript = memory.get_transcript(False)
+    transcript = compact_transcript(memory.transcript_segments, trends_token_budget)
     if len(transcript) == 0:
         return []
 
@@ -542,15 +889,9 @@ def trends_extractor(memory: Memory) -> List[Item]:
     {transcript}
     '''.replace('    ', '').strip()
     try:
-        with_parser = llm_mini.with_structured_output(ExpectedOutput)
+        with_parser = llm_mini_cached.with_structured_output(ExpectedOutput)
         response: ExpectedOutput = with_parser.invoke(prompt)
-        filtered = []
-        for item in response.items:
-            if item.topic not in [e for e in (
-                    ceo_options + company_options + software_product_options + hardware_product_options + ai_product_options)]:
-                continue
-            filtered.append(item)
-        return filtered
+        return _filter_trend_items(response.items)
 
     except Exception as e:
         print(f'Error determining memory discard: {e}')
@@ -636,12 +977,16 @@ def extract_question_from_conversation(messages: List[Message]) -> str:
     return llm_mini.with_structured_output(OutputQuestion).invoke(prompt).question
 
 
+metadata_fields_token_budget = 6000
+
+
 def retrieve_metadata_fields_from_transcript(
         uid: str, created_at: datetime, transcript_segment: List[dict]
 ) -> ExtractedInformation:
     transcript = ''
     for segment in transcript_segment:
         transcript += f'{segment["text"].strip()}\n\n'
+    transcript = fit_transcript_to_budget(transcript.strip(), metadata_fields_token_budget)
 
     # TODO: ask it to use max 2 words? to have more standardization possibilities
     prompt = f'''
@@ -665,10 +1010,15 @@ def retrieve_metadata_fields_from_transcript(
     ```
     '''.replace('    ', '')
     try:
-        result: ExtractedInformation = llm_mini.with_structured_output(ExtractedInformation).invoke(prompt)
+        result: ExtractedInformation = llm_mini_cached.with_structured_output(ExtractedInformation).invoke(prompt)
     except Exception as e:
         print('e', e)
         return {'people': [], 'topics': [], 'entities': [], 'dates': []}
+    return save_extracted_information(uid, result)
+
+
+def save_extracted_information(uid: str, result: ExtractedInformation) -> dict:
+    """Normalizes the extracted people/topics/entities/dates into vector metadata."""
 
     def normalize_filter(value: str) -> str:
         # Convert to lowercase and strip whitespace
@@ -692,7 +1042,7 @@ def retrieve_metadata_fields_from_transcript(
     metadata = {
         'people': [normalize_filter(p) for p in result.people],
         'topics': [normalize_filter(t) for t in result.topics],
-        'entities': [normalize_filter(e) for e in result.topics],
+        'entities': [normalize_filter(e) for e in result.entities],
         'dates': []
     }
     # 'dates': [date.strftime('%Y-%m-%d') for date in result.dates],
@@ -705,15 +1055,6 @@ def retrieve_metadata_fields_from_transcript(
         except Exception as e:
             print(f'Error parsing date: {e}')
 
-    for p in metadata['people']:
-        add_filter_category_item(uid, 'people', p)
-    for t in metadata['topics']:
-        add_filter_category_item(uid, 'topics', t)
-    for e in metadata['entities']:
-        add_filter_category_item(uid, 'entities', e)
-    for d in metadata['dates']:
-        add_filter_category_item(uid, 'dates', d)
-
     return metadata
 
 
@@ -741,3 +1082,71 @@ def select_structured_filters(question: str, filters_available: dict) -> dict:
         return response.dict()
     except ValidationError:
         return {}
+
+
+# **********************************************
+# ************* FUSED EXTRACTION ***************
+# **********************************************
+
+# Opt-in, one gpt-4o call per memory instead of discard + structure + metadata + facts (+ trends) calls.
+fused_extraction_enabled = os.getenv('FUSED_EXTRACTION_ENABLED', 'false') == 'true'
+fused_extraction_token_budget = 12000
+
+
+class FusedExtraction(BaseModel):
+    discard: bool = Field(description="If the conversation is not worth storing as a memory")
+    structured: Structured = Field(description="The structure of the conversation")
+    information: ExtractedInformation = Field(description="People, topics, entities and dates mentioned")
+    facts: List[Fact] = Field(
+        default=[], max_items=3, description="List of new user facts, preferences, interests, or topics."
+    )
+    trends: List[Item] = Field(default=[], description="Trend topics of the conversation, only from the options.")
+
+
+def get_fused_extraction(
+        uid: str, segments: List[TranscriptSegment], started_at: datetime, language_code: str, tz: str
+) -> FusedExtraction:
+    user_name, facts_str = get_prompt_facts(uid)
+    transcript = compact_transcript(segments, fused_extraction_token_budget, user_name=user_name)
+
+    prompt = f'''
+    You are an expert conversation analyzer. You will be given the transcript of a conversation {user_name} had or listened to, it has about 20% word error rate and diarization is also made poorly, infer and fix the transcript errors first.
+    The conversation language is {language_code}. Use the same language {language_code} for the structure.
+
+    Fill every part of the output:
+
+    discard: true if there are no interesting topics, facts, or information worth storing as a memory.
+
+    structured:
+    - For the title, use the main topic of the conversation.
+    - For the overview, condense the conversation into a summary with the main topics discussed, make sure to capture the key points and important details from the conversation.
+    - For the action items, include a list of commitments, specific tasks or actionable steps from the conversation that the user is planning to do or has to do on that specific day or in future. Remember the speaker is busy so this has to be very efficient and concise, otherwise they might miss some critical tasks. Specify which speaker is responsible for each action item.
+    - For the category, classify the conversation into one of the available categories.
+    - For Calendar Events, include a list of events extracted from the conversation, that the user must have on his calendar. For date context, this conversation happened on {started_at.isoformat()}. {tz} is the user's timezone, convert it to UTC and respond in UTC.
+
+    information: the people, topics, entities and dates (YYYY-MM-DD) mentioned. Today is {started_at.strftime('%Y-%m-%d')}, "tomorrow" is the next day, "next week" is the next monday. Do not include dates greater than 2025.
+
+    facts: from 0 up to 3 **new** facts, preferences, and interests about {user_name}, not repetitive or similar to the existing ones, breadth is preferred over depth. Use a format of "{user_name} likes to play tennis on weekends.", and don't use "her", "his", "he", "she". Existing facts: {facts_str}
+
+    trends: the topics of the conversation within the categories {str([e.value for e in TrendEnum]).strip("[]")}, if the perception is positive "best" or negative "worst". The topic must be one of these options:
+    - ceo_options: {", ".join(ceo_options)}
+    - company_options: {", ".join(company_options)}
+    - software_product_options: {", ".join(software_product_options)}
+    - hardware_product_options: {", ".join(hardware_product_options)}
+    - ai_product_options: {", ".join(ai_product_options)}
+
+    Transcript:
+    ```
+    {transcript.strip()}
+    ```
+    '''.replace('    ', '').strip()
+
+    response: FusedExtraction = llm_cached.with_structured_output(FusedExtraction).invoke(prompt)
+    # same as should_discard_memory, longer conversations are always kept
+    if len(transcript.split(' ')) > 100:
+        response.discard = False
+    response.structured = _clean_structure(response.structured)
+    response.trends = _filter_trend_items(response.trends)
+    if len(transcript) < 100:  # as new_facts_extractor, probably nothing
+        response.facts = []
+    return response
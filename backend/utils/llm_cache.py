@@ -0,0 +1,199 @@
+import contextvars
+import hashlib
+import os
+import threading
+from array import array
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, List, Optional, Sequence
+
+from langchain_core.caches import BaseCache
+from langchain_core.embeddings import Embeddings
+from langchain_core.load import dumps, loads
+from langchain_core.outputs import Generation
+
+from database import redis_db
+from utils.other import metrics
+
+# Bump when the prompts or the way their outputs are used change, older cached responses are ignored.
+prompt_version = 1
+llm_cache_ttl_seconds = int(os.getenv('LLM_CACHE_TTL_SECONDS', 60 * 60 * 24 * 7))
+llm_cache_lru_size = int(os.getenv('LLM_CACHE_LRU_SIZE', 1024))
+embeddings_cache_lru_size = int(os.getenv('EMBEDDINGS_CACHE_LRU_SIZE', 4096))
+
+_bypass = contextvars.ContextVar('llm_cache_bypass', default=False)
+
+
+@contextmanager
+def bypass_llm_cache():
+    """Calls inside get a fresh response, which replaces the cached one, used when the user forces a reprocess."""
+    token = _bypass.set(True)
+    try:
+        yield
+    finally:
+        _bypass.reset(token)
+
+
+def llm_cache_bypassed() -> bool:
+    return _bypass.get()
+
+
+def _normalize(text: str) -> str:
+    return ' '.join(text.split())
+
+
+def cache_key(*parts: str) -> str:
+    content = '\x1f'.join([str(prompt_version)] + [_normalize(p) for p in parts])
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+
+class LRU:
+    def __init__(self, size: int):
+        self.size = size
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._data:
+                return None
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class TwoTierLLMCache(BaseCache):
+    """
+    LangChain cache for the pipeline models, keyed by prompt version, model parameters (llm_string, which includes
+    the structured output schema) and the normalized prompt. In-process LRU first, then Redis with a TTL.
+    """
+
+    def __init__(self, lru_size: int = llm_cache_lru_size, ttl: int = llm_cache_ttl_seconds):
+        self.lru = LRU(lru_size)
+        self.ttl = ttl
+
+    def lookup(self, prompt: str, llm_string: str) -> Optional[Sequence[Generation]]:
+        if _bypass.get():
+            metrics.incr('llm_cache_bypass')
+            return None
+        key = cache_key(llm_string, prompt)
+        if (generations := self.lru.get(key)) is not None:
+            metrics.incr('llm_cache_hit:lru')
+            return generations
+        if data := redis_db.get_llm_cache(key):
+            try:
+                generations = [loads(g) for g in data]
+                self.lru.set(key, generations)
+                metrics.incr('llm_cache_hit:redis')
+                return generations
+            except Exception as e:
+                print(f'TwoTierLLMCache could not load {key}: {e}')
+        metrics.incr('llm_cache_miss')
+        return None
+
+    def update(self, prompt: str, llm_string: str, return_val: Sequence[Generation]) -> None:
+        # answered by the degraded model, see ScheduledChatOpenAI
+        if any(getattr(g, 'message', None) and g.message.response_metadata.get('degraded') for g in return_val):
+            return
+        key = cache_key(llm_string, prompt)
+        self.lru.set(key, return_val)
+        redis_db.set_llm_cache(key, [dumps(g) for g in return_val], self.ttl)
+
+    def clear(self, **kwargs: Any) -> None:
+        self.lru.clear()
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Wraps an embeddings model so the same text is embedded once: duplicates in a call, texts embedded before (LRU,
+    then Redis), and texts being embedded right now by another thread are all served without calling the API.
+    Empty texts get a zero vector.
+    """
+
+    def __init__(self, underlying: Embeddings, model: str, dimensions: int, lru_size: int = embeddings_cache_lru_size,
+                 ttl: int = llm_cache_ttl_seconds):
+        self.underlying = underlying
+        self.model = model
+        self.dimensions = dimensions
+        self.lru = LRU(lru_size)
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._in_flight = {}
+
+    def _key(self, text: str) -> str:
+        return cache_key('embedding', self.model, text)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys = [self._key(text) for text in texts]
+        vectors = {}
+        for text, key in zip(texts, keys):
+            if not text.strip():
+                vectors[key] = [0.0] * self.dimensions
+            elif (vector := self.lru.get(key)) is not None:
+                metrics.incr('embeddings_cache_hit:lru')
+                vectors[key] = vector
+
+        missing = list(dict.fromkeys(k for k in keys if k not in vectors))
+        if missing:
+            for key, data in zip(missing, redis_db.get_embeddings_cache(missing) or [None] * len(missing)):
+                if data:
+                    vectors[key] = array('f', data).tolist()
+                    self.lru.set(key, vectors[key])
+                    metrics.incr('embeddings_cache_hit:redis')
+
+        texts_by_key = dict(zip(keys, texts))
+        missing = [k for k in dict.fromkeys(keys) if k not in vectors]
+        if missing:
+            vectors.update(self._embed_single_flight(missing, texts_by_key))
+        return [vectors[key] for key in keys]
+
+    def _embed_single_flight(self, keys: List[str], texts_by_key: dict) -> dict:
+        # texts another thread is already embedding are waited for instead of requested again
+        own, others = [], []
+        with self._lock:
+            for key in keys:
+                if key in self._in_flight:
+                    others.append((key, self._in_flight[key]))
+                else:
+                    self._in_flight[key] = threading.Event()
+                    own.append(key)
+
+        vectors = {}
+        try:
+            if own:
+                metrics.incr('embeddings_cache_miss', len(own))
+                result = self.underlying.embed_documents([texts_by_key[k] for k in own])
+                for key, vector in zip(own, result):
+                    vectors[key] = vector
+                    self.lru.set(key, vector)
+                redis_db.set_embeddings_cache(
+                    {key: array('f', vectors[key]).tobytes() for key in own}, self.ttl
+                )
+        finally:
+            with self._lock:
+                for key in own:
+                    self._in_flight.pop(key).set()
+
+        for key, event in others:
+            event.wait(60)
+            metrics.incr('embeddings_cache_hit:in_flight')
+            vector = self.lru.get(key)
+            # the other thread failed, or its result was already evicted
+            vectors[key] = vector if vector is not None else self.underlying.embed_documents([texts_by_key[key]])[0]
+        return vectors
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+
+llm_cache = TwoTierLLMCache()
@@ -0,0 +1,243 @@
+import asyncio
+import contextvars
+import heapq
+import itertools
+import os
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import contextmanager, asynccontextmanager
+from enum import Enum
+from typing import Dict, Optional
+
+from langchain_openai import ChatOpenAI
+
+from utils.other import metrics
+
+
+class LLMPriority(str, Enum):
+    # in priority order
+    interactive = 'interactive'
+    memory_creation = 'memory_creation'
+    enrichment = 'enrichment'
+    summaries = 'summaries'
+
+
+_priority_order = {priority: i for i, priority in enumerate(LLMPriority)}
+
+# OpenAI requests in flight at a time in this process, the rest wait, served by priority.
+llm_max_concurrency = int(os.getenv('LLM_MAX_CONCURRENCY', 64))
+# Requests per minute of each priority and of each uid, 0 is unlimited.
+llm_requests_per_minute = {
+    LLMPriority.interactive: int(os.getenv('LLM_INTERACTIVE_REQUESTS_PER_MINUTE', 0)),
+    LLMPriority.memory_creation: int(os.getenv('LLM_MEMORY_CREATION_REQUESTS_PER_MINUTE', 0)),
+    LLMPriority.enrichment: int(os.getenv('LLM_ENRICHMENT_REQUESTS_PER_MINUTE', 600)),
+    LLMPriority.summaries: int(os.getenv('LLM_SUMMARIES_REQUESTS_PER_MINUTE', 120)),
+}
+llm_user_requests_per_minute = int(os.getenv('LLM_USER_REQUESTS_PER_MINUTE', 120))
+# With this many requests waiting, enrichment and summaries requests are sent to the degraded model.
+llm_degrade_queue_depth = int(os.getenv('LLM_DEGRADE_QUEUE_DEPTH', 20))
+degraded_model = 'gpt-4o-mini'
+_degradable = {LLMPriority.enrichment, LLMPriority.summaries}
+
+_priority = contextvars.ContextVar('llm_priority', default=LLMPriority.memory_creation)
+_uid = contextvars.ContextVar('llm_uid', default=None)
+
+
+@contextmanager
+def llm_priority(priority: LLMPriority, uid: Optional[str] = None):
+    """LLM requests made inside, by this thread or the ones it starts with its context, are scheduled as `priority`."""
+    priority_token = _priority.set(priority)
+    uid_token = _uid.set(uid)
+    try:
+        yield
+    finally:
+        _uid.reset(uid_token)
+        _priority.reset(priority_token)
+
+
+class TokenBucket:
+    def __init__(self, per_minute: int):
+        self.rate = per_minute / 60
+        self.capacity = max(per_minute / 4, 1)  # bursts of 15 seconds of requests
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def available(self, now: float) -> bool:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return self.tokens >= 1
+
+    def take(self):
+        self.tokens -= 1
+
+    def full(self) -> bool:
+        return self.tokens >= self.capacity
+
+
+class _Grant:
+    def __init__(self, priority: LLMPriority, uid: Optional[str]):
+        self.priority = priority
+        self.uid = uid
+        self.future = Future()
+        self.enqueued_at = time.time()
+        self.degraded = False
+
+
+class LLMScheduler:
+    """
+    Hands out request slots, at most `max_concurrency` at a time, to the highest priority waiting request whose
+    priority and uid token buckets have a token, oldest first within a priority.
+    """
+
+    def __init__(self, max_concurrency: int = llm_max_concurrency, requests_per_minute: dict = None,
+                 user_requests_per_minute: int = llm_user_requests_per_minute,
+                 degrade_queue_depth: int = llm_degrade_queue_depth):
+        self.max_concurrency = max_concurrency
+        self.user_requests_per_minute = user_requests_per_minute
+        self.degrade_queue_depth = degrade_queue_depth
+        requests_per_minute = requests_per_minute or llm_requests_per_minute
+        self._buckets = {priority: TokenBucket(rpm) for priority, rpm in requests_per_minute.items() if rpm}
+        self._user_buckets: Dict[str, TokenBucket] = {}
+        self._waiting = []
+        self._sequence = itertools.count()
+        self._in_flight = 0
+        self._throttled = False
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def _bucket(self, uid: Optional[str]) -> Optional[TokenBucket]:
+        if not uid or not self.user_requests_per_minute:
+            return None
+        if uid not in self._user_buckets:
+            if len(self._user_buckets) > 10000:
+                self._user_buckets = {k: v for k, v in self._user_buckets.items() if not v.full()}
+            self._user_buckets[uid] = TokenBucket(self.user_requests_per_minute)
+        return self._user_buckets[uid]
+
+    def _dispatch(self):
+        # with the condition held
+        now = time.monotonic()
+        skipped = []
+        while self._waiting and self._in_flight < self.max_concurrency:
+            entry = heapq.heappop(self._waiting)
+            grant = entry[2]
+            if grant.future.done():  # abandoned
+                continue
+            buckets = [b for b in [self._buckets.get(grant.priority), self._bucket(grant.uid)] if b]
+            if not all(bucket.available(now) for bucket in buckets):
+                skipped.append(entry)
+                continue
+            # asyncio.wrap_future cancels it from the event loop without the condition, once running it can't be
+            if not grant.future.set_running_or_notify_cancel():
+                continue
+            for bucket in buckets:
+                bucket.take()
+            self._in_flight += 1
+            grant.degraded = (grant.priority in _degradable
+                              and len(self._waiting) + len(skipped) >= self.degrade_queue_depth)
+            grant.future.set_result(True)
+        for entry in skipped:
+            heapq.heappush(self._waiting, entry)
+
+        # buckets refill with time, the dispatcher thread retries while requests are held by them
+        self._throttled = bool(skipped)
+        if self._throttled:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True, name='llm-scheduler')
+                self._thread.start()
+            self._condition.notify()
+        metrics.gauge('llm_queue_depth', len(self._waiting))
+        metrics.gauge('llm_in_flight', self._in_flight)
+
+    def _run(self):
+        with self._condition:
+            while True:
+                self._condition.wait(timeout=0.05 if self._throttled else None)
+                self._dispatch()
+
+    def _enqueue(self) -> _Grant:
+        grant = _Grant(_priority.get(), _uid.get())
+        with self._condition:
+            heapq.heappush(self._waiting, (_priority_order[grant.priority], next(self._sequence), grant))
+            self._dispatch()
+        return grant
+
+    def _granted(self, grant: _Grant):
+        metrics.observe(f'llm_queue_seconds:{grant.priority.value}', time.time() - grant.enqueued_at)
+        metrics.incr(f'llm_requests:{grant.priority.value}')
+        if grant.degraded:
+            metrics.incr(f'llm_degraded:{grant.priority.value}')
+
+    def _release(self, grant: _Grant):
+        with self._condition:
+            # not granted yet, it's skipped when reached, else its slot is freed
+            if grant.future.cancel():
+                return
+            self._in_flight -= 1
+            self._dispatch()
+
+    @contextmanager
+    def slot(self):
+        grant = self._enqueue()
+        try:
+            grant.future.result()
+            self._granted(grant)
+            yield grant
+        finally:
+            self._release(grant)
+
+    @asynccontextmanager
+    async def aslot(self):
+        grant = self._enqueue()
+        try:
+            await asyncio.wrap_future(grant.future)
+            self._granted(grant)
+            yield grant
+        finally:
+            self._release(grant)
+
+
+llm_scheduler = LLMScheduler()
+
+
+class ScheduledChatOpenAI(ChatOpenAI):
+    """
+    ChatOpenAI whose requests go through `llm_scheduler` at the priority of the caller, see `llm_priority`. Cache hits
+    don't, the cache is checked before. Degraded responses are marked so they are not cached as this model's.
+    """
+
+    def _degrade(self, grant: _Grant, kwargs: dict) -> dict:
+        if grant.degraded and self.model_name != degraded_model:
+            return {**kwargs, 'model': degraded_model}
+        return kwargs
+
+    @staticmethod
+    def _mark_degraded(grant: _Grant, result):
+        if grant.degraded:
+            for generation in result.generations:
+                generation.message.response_metadata['degraded'] = True
+        return result
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        with llm_scheduler.slot() as grant:
+            result = super()._generate(messages, stop=stop, run_manager=run_manager, **self._degrade(grant, kwargs))
+        return self._mark_degraded(grant, result)
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        async with llm_scheduler.aslot() as grant:
+            result = await super()._agenerate(
+                messages, stop=stop, run_manager=run_manager, **self._degrade(grant, kwargs)
+            )
+        return self._mark_degraded(grant, result)
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        with llm_scheduler.slot() as grant:
+            yield from super()._stream(messages, stop=stop, run_manager=run_manager, **self._degrade(grant, kwargs))
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+        async with llm_scheduler.aslot() as grant:
+            async for chunk in super()._astream(
+                    messages, stop=stop, run_manager=run_manager, **self._degrade(grant, kwargs)
+            ):
+                yield chunk
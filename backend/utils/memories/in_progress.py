@@ -0,0 +1,166 @@
+import os
+import threading
+import time
+import uuid
+from datetime import datetime, timezone, timedelta
+from typing import List, Optional, Dict
+
+import database.memories as memories_db
+from database import redis_db
+from models.memory import Memory, MemoryStatus, Structured
+from models.transcript_segment import TranscriptSegment, TranscriptSegmentStore
+
+# Max seconds of transcript that can be lost if the container dies between two flushes.
+flush_interval_seconds = float(os.getenv('IN_PROGRESS_MEMORY_FLUSH_SECONDS', 5))
+
+# Active buffers in this process, so readers of the in progress memory can see the latest segments.
+_buffers: Dict[str, 'InProgressMemoryBuffer'] = {}
+_buffers_lock = threading.Lock()
+
+
+def retrieve_in_progress_memory(uid):
+    with _buffers_lock:
+        buffer = _buffers.get(uid)
+    if buffer and buffer.memory is not None:
+        buffer.flush()
+
+    memory_id = redis_db.get_in_progress_memory_id(uid)
+    existing = None
+
+    if memory_id:
+        existing = memories_db.get_memory(uid, memory_id)
+        if existing and existing['status'] != 'in_progress':
+            existing = None
+
+    if not existing:
+        existing = memories_db.get_in_progress_memory(uid)
+    return existing
+
+
+class InProgressMemoryBuffer:
+    """
+    Write-behind buffer that owns the in progress memory of a /v2/listen session.
+
+    Segments are combined in memory, and the merged document is written to Firestore at most every
+    `flush_interval_seconds`, and when the session ends, instead of on every batch of segments received.
+    """
+
+    def __init__(self, uid: str, language: str, interval_seconds: float = flush_interval_seconds):
+        self.uid = uid
+        self.language = language
+        self.interval_seconds = interval_seconds
+
+        self.memory: Optional[Memory] = None
+        self._store: Optional[TranscriptSegmentStore] = None
+        # serialized segments as of `_serialized_version`, only the changed tail is serialized again on flush
+        self._segment_dicts: List[dict] = []
+        self._serialized_version = 0
+        self._dirty = False
+        self._last_flush = time.time()
+        self._lock = threading.RLock()
+        self._flush_lock = threading.Lock()
+
+        with _buffers_lock:
+            _buffers[uid] = self
+
+    @property
+    def finished_at(self) -> Optional[datetime]:
+        return self.memory.finished_at if self.memory else None
+
+    def add_segments(self, segments: List[dict], finished_at: datetime) -> Memory:
+        with self._lock:
+            if self.memory is None:
+                self.memory = self._get_or_create_in_progress_memory(segments, finished_at)
+            else:
+                self._store.add([TranscriptSegment(**segment) for segment in segments])
+                self.memory.invalidate_transcript()
+                self.memory.finished_at = finished_at
+                self._dirty = True
+            return self.memory
+
+    def _set_store(self, memory: Memory):
+        self._store = TranscriptSegmentStore(memory.transcript_segments)
+        self._segment_dicts = []
+        self._serialized_version = -1
+
+    def _get_or_create_in_progress_memory(self, segments: List[dict], finished_at: datetime) -> Memory:
+        if existing := retrieve_in_progress_memory(self.uid):
+            memory = Memory(**existing)
+            self._set_store(memory)
+            self._store.add([TranscriptSegment(**segment) for segment in segments])
+            memory.invalidate_transcript()
+            memory.finished_at = finished_at
+            self._dirty = True
+            redis_db.set_in_progress_memory_id(self.uid, memory.id)
+            return memory
+
+        started_at = datetime.now(timezone.utc) - timedelta(seconds=segments[0]['end'] - segments[0]['start'])
+        memory = Memory(
+            id=str(uuid.uuid4()),
+            uid=self.uid,
+            structured=Structured(),
+            language=self.language,
+            created_at=started_at,
+            started_at=started_at,
+            finished_at=finished_at,
+            transcript_segments=[TranscriptSegment(**segment) for segment in segments],
+            status=MemoryStatus.in_progress,
+        )
+        print('_get_in_progress_memory new', memory)
+        self._set_store(memory)
+        # The document is created right away, so other connections can find it, only updates are deferred.
+        memories_db.upsert_memory(self.uid, memory_data=memory.dict())
+        redis_db.set_in_progress_memory_id(self.uid, memory.id)
+        self._last_flush = time.time()
+        return memory
+
+    def should_flush(self) -> bool:
+        return self._dirty and time.time() - self._last_flush >= self.interval_seconds
+
+    def flush(self) -> bool:
+        """Writes the merged in progress memory to Firestore if there are pending changes."""
+        with self._flush_lock:
+            return self._flush()
+
+    def _flush(self) -> bool:
+        with self._lock:
+            if not self.memory or not self._dirty:
+                return False
+            memory_id = self.memory.id
+            start, changed = self._store.delta(self._serialized_version)
+            self._segment_dicts[start:] = [s.dict() for s in changed]
+            self._serialized_version = self._store.version
+            data = {
+                'transcript_segments': list(self._segment_dicts),
+                'finished_at': self.memory.finished_at,
+            }
+            self._dirty = False
+            self._last_flush = time.time()
+
+        try:
+            memories_db.update_memory(self.uid, memory_id, data)
+            redis_db.set_in_progress_memory_id(self.uid, memory_id)
+        except Exception as e:
+            print(f'InProgressMemoryBuffer flush failed {memory_id}: {e}')
+            with self._lock:
+                if self.memory and self.memory.id == memory_id:
+                    self._dirty = True
+            return False
+        return True
+
+    def detach(self) -> Optional[Memory]:
+        """Flushes and hands over the buffered memory, next segments received will start a new memory."""
+        with self._flush_lock:
+            self._flush()
+            with self._lock:
+                memory = self.memory
+                self.memory = None
+                self._store = None
+                self._dirty = False
+                return memory
+
+    def close(self):
+        self.flush()
+        with _buffers_lock:
+            if _buffers.get(self.uid) is self:
+                del _buffers[self.uid]
@@ -1,16 +1,15 @@
 import asyncio
 import os
-import threading
-import time
 
 from pydub import AudioSegment
 
 import database.memories as memories_db
 from database.users import get_user_store_recording_permission
+from models.job import JobType
 from models.memory import *
+from utils.jobs import enqueue_job
 from utils.memories.process_memory import process_memory, process_user_emotion
-from utils.other.storage import upload_postprocessing_audio, \
-    delete_postprocessing_audio, upload_memory_recording
+from utils.other.storage import upload_postprocessing_audio, upload_memory_recording
 from utils.stt.pre_recorded import fal_whisperx, fal_postprocessing
 from utils.stt.speech_profile import get_speech_profile_matching_predictions
 from utils.stt.vad import vad_is_empty
@@ -57,7 +56,8 @@ def postprocess_memory(memory_id: str, file_path: str, uid: str, emotional_feedb
     try:
         aseg = AudioSegment.from_wav(file_path)
         signed_url = upload_postprocessing_audio(file_path)
-        threading.Thread(target=_delete_postprocessing_audio, args=(file_path,)).start()
+        # hume reads the audio from the signed url after this returns
+        enqueue_job(JobType.delete_postprocessing_audio, uid=uid, payload={'file_path': file_path}, delay_seconds=300)
 
         if aseg.frame_rate == 16000 and get_user_store_recording_permission(uid):
             upload_memory_recording(file_path, uid, memory_id)
@@ -105,6 +105,9 @@ def postprocess_memory(memory_id: str, file_path: str, uid: str, emotional_feedb
         print(e)
         memories_db.set_postprocessing_status(uid, memory.id, PostProcessingStatus.failed, fail_reason=str(e))
         return 500, str(e)
+    finally:
+        if os.path.exists(file_path):
+            os.remove(file_path)
 
     memories_db.set_postprocessing_status(uid, memory.id, PostProcessingStatus.completed)
     # result.postprocessing = MemoryPostProcessing(
@@ -120,12 +123,6 @@ def _get_memory_by_id(uid: str, memory_id: str) -> dict:
     return memory
 
 
-def _delete_postprocessing_audio(file_path):
-    time.sleep(300)  # 5 min
-    delete_postprocessing_audio(file_path)
-    os.remove(file_path)
-
-
 async def _process_user_emotion(uid: str, language_code: str, memory: Memory, urls: [str]):
     if not any(segment.is_user for segment in memory.transcript_segments):
         print(f"_process_user_emotion skipped for {memory.id}")
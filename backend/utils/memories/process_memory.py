@@ -1,6 +1,5 @@
 import datetime
 import random
-import threading
 import uuid
 from datetime import timezone
 from typing import Union, Tuple
@@ -14,18 +13,24 @@ import database.tasks as tasks_db
 import database.trends as trends_db
 from database.plugins import record_plugin_usage
 from database.vector_db import upsert_vector2, update_vector_metadata
-from models.facts import FactDB
+from models.facts import Fact, FactDB
+from models.job import Job, JobType
 from models.memory import *
 from models.plugin import Plugin, UsageHistoryType
 from models.task import Task, TaskStatus, TaskAction, TaskActionProvider
 from models.trend import Trend
+from utils.jobs import job_handler, enqueue_memory_job
 from utils.llm import obtain_emotional_message, retrieve_metadata_fields_from_transcript
 from utils.llm import summarize_open_glass, get_transcript_structure, generate_embedding, \
     get_plugin_result, should_discard_memory, summarize_experience_text, new_facts_extractor, \
-    trends_extractor
+    trends_extractor, fused_extraction_enabled, get_fused_extraction, FusedExtraction, ExtractedInformation, \
+    save_extracted_information, plugin_batching_enabled, get_plugin_batches, get_plugins_results
+from utils.llm_scheduler import llm_priority, LLMPriority
+from utils.memories.stages import Stage, StageGraph
 from utils.notifications import send_notification
 from utils.other.hume import get_hume, HumeJobCallbackModel, HumeJobModelPredictionResponseModel
 from utils.plugins import get_plugins_data
+from utils.retrieval.facets import index_memory_facets
 from utils.retrieval.rag import retrieve_rag_memory_context
 from utils.webhooks import memory_created_webhook
 
@@ -33,35 +38,49 @@ from utils.webhooks import memory_created_webhook
 def _get_structured(
         uid: str, language_code: str, memory: Union[Memory, CreateMemory, WorkflowCreateMemory],
         force_process: bool = False, retries: int = 1
-) -> Tuple[Structured, bool]:
+) -> Tuple[Structured, bool, Optional[FusedExtraction]]:
     try:
         tz = notification_db.get_user_time_zone(uid)
         if memory.source == MemorySource.workflow:
             if memory.text_source == WorkflowMemorySource.audio:
                 structured = get_transcript_structure(memory.text, memory.started_at, language_code, tz)
-                return structured, False
+                return structured, False, None
 
             if memory.text_source == WorkflowMemorySource.other:
                 structured = summarize_experience_text(memory.text)
-                return structured, False
+                return structured, False, None
 
             # not workflow memory source support
             raise HTTPException(status_code=400, detail='Invalid workflow memory source')
 
         # from OpenGlass
         if memory.photos:
-            return summarize_open_glass(memory.photos), False
+            return summarize_open_glass(memory.photos), False, None
 
         # from Friend
+        if fused_extraction_enabled:
+            fused = get_fused_extraction(
+                uid, memory.transcript_segments, memory.started_at, language_code, tz
+            )
+            if fused.discard and not force_process:
+                return Structured(emoji=random.choice(['🧠', '🎉'])), True, fused
+            return fused.structured, False, fused
+
         if force_process:
             # reprocess endpoint
-            return get_transcript_structure(memory.get_transcript(False), memory.started_at, language_code, tz), False
+            structured = get_transcript_structure(
+                memory.get_transcript(False, compact=True), memory.started_at, language_code, tz
+            )
+            return structured, False, None
 
         discarded = should_discard_memory(memory.get_transcript(False))
         if discarded:
-            return Structured(emoji=random.choice(['🧠', '🎉'])), True
+            return Structured(emoji=random.choice(['🧠', '🎉'])), True, None
 
-        return get_transcript_structure(memory.get_transcript(False), memory.started_at, language_code, tz), False
+        structured = get_transcript_structure(
+            memory.get_transcript(False, compact=True), memory.started_at, language_code, tz
+        )
+        return structured, False, None
     except Exception as e:
         print(e)
         if retries == 2:
@@ -101,29 +120,34 @@ def _get_memory_obj(uid: str, structured: Structured, memory: Union[Memory, Crea
     return memory
 
 
-def _trigger_plugins(uid: str, memory: Memory, is_reprocess: bool = False):
+def _get_memory_plugins(uid: str) -> List[Plugin]:
     plugins: List[Plugin] = get_plugins_data(uid, include_reviews=False)
-    filtered_plugins = [plugin for plugin in plugins if plugin.works_with_memories() and plugin.enabled]
-    memory.plugins_results = []
-    threads = []
+    return [plugin for plugin in plugins if plugin.works_with_memories() and plugin.enabled]
+
+
+# plugin stages return their results, applied to the memory by the save stage, a stage given up on changes nothing
 
-    def execute_plugin(plugin):
-        if result := get_plugin_result(memory.get_transcript(False), plugin).strip():
-            memory.plugins_results.append(PluginResult(plugin_id=plugin.id, content=result))
-            if not is_reprocess:
-                record_plugin_usage(uid, plugin.id, UsageHistoryType.memory_created_prompt, memory_id=memory.id)
+def _execute_plugin(memory: Memory, plugin: Plugin) -> List[Tuple[Plugin, str]]:
+    return [(plugin, get_plugin_result(memory.get_transcript(False, compact=True), plugin))]
 
-    for plugin in filtered_plugins:
-        threads.append(threading.Thread(target=execute_plugin, args=(plugin,)))
 
-    [t.start() for t in threads]
-    [t.join() for t in threads]
+def _execute_plugins_batch(memory: Memory, plugins: List[Plugin]) -> List[Tuple[Plugin, str]]:
+    results = get_plugins_results(memory.get_transcript(False, compact=True), plugins)
+    return [(plugin, results.get(plugin.id, '')) for plugin in plugins]
 
 
-def _extract_facts(uid: str, memory: Memory):
+def _add_plugin_result(uid: str, memory: Memory, plugin: Plugin, result: str, is_reprocess: bool):
+    if result := result.strip():
+        memory.plugins_results.append(PluginResult(plugin_id=plugin.id, content=result))
+        if not is_reprocess:
+            record_plugin_usage(uid, plugin.id, UsageHistoryType.memory_created_prompt, memory_id=memory.id)
+
+
+def _extract_facts(uid: str, memory: Memory, new_facts: Optional[List[Fact]] = None):
     # TODO: maybe instead (once they can edit them) we should not tie it this hard
     facts_db.delete_facts_for_memory(uid, memory.id)
-    new_facts = new_facts_extractor(uid, memory.transcript_segments)
+    if new_facts is None:
+        new_facts = new_facts_extractor(uid, memory.transcript_segments)
     parsed_facts = []
     for fact in new_facts:
         parsed_facts.append(FactDB.from_fact(fact, uid, memory.id, memory.structured.category))
@@ -137,12 +161,17 @@ def _extract_trends(memory: Memory):
     trends_db.save_trends(memory, parsed)
 
 
-def save_structured_vector(uid: str, memory: Memory, update_only: bool = False):
-    vector = generate_embedding(str(memory.structured)) if not update_only else None
-
+def _get_vector_metadata(uid: str, memory: Memory) -> dict:
     segments = [t.dict() for t in memory.transcript_segments]
     metadata = retrieve_metadata_fields_from_transcript(uid, memory.created_at, segments)
     metadata['created_at'] = int(memory.created_at.timestamp())
+    index_memory_facets(uid, memory.id, metadata)
+    return metadata
+
+
+def save_structured_vector(uid: str, memory: Memory, update_only: bool = False):
+    vector = generate_embedding(str(memory.structured)) if not update_only else None
+    metadata = _get_vector_metadata(uid, memory)
     if not update_only:
         print('save_structured_vector creating vector')
         upsert_vector2(uid, memory, vector, metadata)
@@ -151,23 +180,71 @@ def save_structured_vector(uid: str, memory: Memory, update_only: bool = False):
         update_vector_metadata(uid, memory.id, metadata)
 
 
+def _get_memory_stages(uid: str, memory: Memory, discarded: bool, is_reprocess: bool) -> List[Stage]:
+    """What the response waits for after the memory is structured, the rest runs as jobs once it's saved."""
+    stages = []
+    plugin_stages = []
+    if not discarded:
+        plugins = _get_memory_plugins(uid)
+        if plugin_batching_enabled and len(plugins) > 1:
+            for i, batch in enumerate(get_plugin_batches(memory.get_transcript(False, compact=True), plugins)):
+                name = f'plugins:batch:{i}'
+                plugin_stages.append(name)
+                stages.append(Stage(
+                    name, lambda _, b=batch: _execute_plugins_batch(memory, b),
+                    blocking=True, timeout=90, required=False,
+                ))
+            plugins = []
+        for plugin in plugins:
+            name = f'plugin:{plugin.id}'
+            plugin_stages.append(name)
+            stages.append(Stage(
+                name, lambda _, p=plugin: _execute_plugin(memory, p),
+                blocking=True, timeout=60, required=False,  # a failing plugin is left out of the results
+            ))
+
+    def _save(inputs):
+        if not discarded:
+            memory.plugins_results = []
+        for name in plugin_stages:
+            for plugin, result in inputs.get(name) or []:
+                _add_plugin_result(uid, memory, plugin, result, is_reprocess)
+        memory.status = MemoryStatus.completed
+        memories_db.upsert_memory(uid, memory.dict())
+
+    stages.append(Stage('save', _save, depends_on=plugin_stages, blocking=True, timeout=30, retries=2))
+    return stages
+
+
 def process_memory(
         uid: str, language_code: str, memory: Union[Memory, CreateMemory, WorkflowCreateMemory],
         force_process: bool = False, is_reprocess: bool = False
 ) -> Memory:
-    structured, discarded = _get_structured(uid, language_code, memory, force_process)
-    memory = _get_memory_obj(uid, structured, memory)
+    with llm_priority(LLMPriority.memory_creation, uid):
+        return _process_memory(uid, language_code, memory, force_process, is_reprocess)
 
-    if not discarded:
-        _trigger_plugins(uid, memory, is_reprocess=is_reprocess)
-        threading.Thread(target=save_structured_vector, args=(uid, memory,)).start() if not is_reprocess else None
-        threading.Thread(target=_extract_facts, args=(uid, memory)).start()
 
-    memory.status = MemoryStatus.completed
-    memories_db.upsert_memory(uid, memory.dict())
+def _process_memory(
+        uid: str, language_code: str, memory: Union[Memory, CreateMemory, WorkflowCreateMemory],
+        force_process: bool, is_reprocess: bool
+) -> Memory:
+    structured, discarded, fused = _get_structured(uid, language_code, memory, force_process)
+    memory = _get_memory_obj(uid, structured, memory)
+
+    graph = StageGraph('process_memory', _get_memory_stages(uid, memory, discarded, is_reprocess))
+    graph.run()
+    if 'save' in graph.errors:
+        raise graph.errors['save']
 
+    if not discarded:
+        # with fused extraction, metadata and facts came with the structure, the jobs don't ask the llm again
+        if not is_reprocess:
+            payload = {'information': fused.information.dict()} if fused else None
+            enqueue_memory_job(JobType.memory_vector, uid, memory.id, payload=payload)
+        payload = {'facts': [fact.dict() for fact in fused.facts]} if fused else None
+        enqueue_memory_job(JobType.memory_facts, uid, memory.id, payload=payload)
     if not is_reprocess:
-        threading.Thread(target=memory_created_webhook, args=(uid, memory,)).start()
+        enqueue_memory_job(JobType.memory_created_webhook, uid, memory.id)
 
     # TODO: trigger external integrations here too
 
@@ -333,3 +410,54 @@ def process_user_expression_measurement_callback(provider: str, request_id: str,
     send_notification(token, title, message, None)
 
     return
+
+
+# **********************************
+# ************* JOBS ***************
+# **********************************
+
+def _get_job_memory(job: Job) -> Optional[Memory]:
+    memory_data = memories_db.get_memory(job.uid, job.memory_id)
+    if not memory_data or memory_data.get('deleted'):
+        print(f'{job.type.value} skipped, memory {job.memory_id} not found')
+        return None
+    return Memory(**memory_data)
+
+
+def _get_job_vector_metadata(job: Job, memory: Memory) -> dict:
+    if 'information' not in job.payload:
+        return _get_vector_metadata(job.uid, memory)
+    metadata = save_extracted_information(job.uid, ExtractedInformation(**job.payload['information']))
+    metadata['created_at'] = int(memory.created_at.timestamp())
+    index_memory_facets(job.uid, memory.id, metadata)
+    return metadata
+
+
+@job_handler(JobType.memory_vector)
+def _memory_vector_job(job: Job):
+    if not (memory := _get_job_memory(job)):
+        return
+    graph = StageGraph('memory_vector', [
+        Stage('embedding', lambda _: generate_embedding(str(memory.structured)), blocking=True, retries=1),
+        Stage('metadata', lambda _: _get_job_vector_metadata(job, memory), blocking=True),
+        Stage(
+            'vector', lambda r: upsert_vector2(job.uid, memory, r['embedding'], r['metadata']),
+            depends_on=['embedding', 'metadata'], blocking=True,
+        ),
+    ])
+    graph.run()
+    if graph.errors:
+        raise next(iter(graph.errors.values()))
+
+
+@job_handler(JobType.memory_facts)
+def _memory_facts_job(job: Job):
+    if memory := _get_job_memory(job):
+        facts = [Fact(**fact) for fact in job.payload['facts']] if 'facts' in job.payload else None
+        _extract_facts(job.uid, memory, facts)
+
+
+@job_handler(JobType.memory_created_webhook)
+def _memory_created_webhook_job(job: Job):
+    if memory := _get_job_memory(job):
+        memory_created_webhook(job.uid, memory)
@@ -0,0 +1,199 @@
+import contextvars
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Any, Callable, Dict, List, Optional
+
+from utils.other import metrics
+
+# Threads shared by every memory being processed in the container, stages queue when they are all busy.
+stage_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv('MEMORY_STAGE_WORKERS', 32)), thread_name_prefix='memory-stage'
+)
+
+
+class Stage:
+    """
+    A step of memory processing. `fn` gets the results of the stages it depends on, by name.
+
+    Blocking stages are waited for before the API responds, deferred ones keep running after. A stage only runs
+    once its dependencies are done, and is skipped if a required one failed, a stage that isn't required gives its
+    dependents None instead. `timeout` is per attempt, counted from when the stage starts running. Python threads
+    can't be interrupted, a blocking stage over its timeouts is given up on (its late result ignored) rather than
+    stopped, a late attempt that returns is still a success.
+    """
+
+    def __init__(self, name: str, fn: Callable[[Dict[str, Any]], Any], depends_on: Optional[List[str]] = None,
+                 blocking: bool = False, timeout: float = 120, retries: int = 0, required: bool = True):
+        self.name = name
+        self.fn = fn
+        self.depends_on = depends_on or []
+        self.blocking = blocking
+        self.timeout = timeout
+        self.retries = retries
+        self.required = required
+
+
+class StageTimeoutError(Exception):
+    pass
+
+
+class StageGraph:
+    def __init__(self, name: str, stages: List[Stage], executor: ThreadPoolExecutor = stage_executor):
+        self.name = name
+        self.stages = {stage.name: stage for stage in stages}
+        self.executor = executor
+        for stage in stages:
+            missing = [d for d in stage.depends_on if d not in self.stages]
+            if missing:
+                raise ValueError(f'Stage {stage.name} depends on unknown stages {missing}')
+
+        self.results: Dict[str, Any] = {}
+        self.errors: Dict[str, Exception] = {}
+        self.timings: Dict[str, float] = {}
+        self.skipped: List[str] = []
+        self._lock = threading.Lock()
+        self._futures = {}
+        self._stage_started_at: Dict[str, float] = {}
+        self._started_at = None
+        self._logged = False
+        self._context = contextvars.copy_context()
+
+    def _attempts(self, stage: Stage, inputs: Dict[str, Any]):
+        # the timeout counts from here, not from the submit, the stage may have queued for a worker
+        start = time.time()
+        self._stage_started_at[stage.name] = start
+        for attempt in range(stage.retries + 1):
+            attempt_start = time.time()
+            try:
+                result = stage.fn(inputs)
+                # a result is kept even if late, running it again would repeat its side effects
+                if time.time() - attempt_start > stage.timeout:
+                    print(f'StageGraph {self.name} {stage.name} took longer than {stage.timeout}s')
+                    metrics.incr(f'memory_stage_slow:{stage.name}')
+                return result
+            except Exception as e:
+                if attempt == stage.retries:
+                    raise
+                print(f'StageGraph {self.name} {stage.name} attempt {attempt + 1} failed: {e}')
+                metrics.incr(f'memory_stage_retries:{stage.name}')
+                time.sleep(min(0.5 * 2 ** attempt, 4))
+            finally:
+                self.timings[stage.name] = time.time() - start
+
+    def _submit_ready_locked(self) -> List[Stage]:
+        # with the lock held, by whoever records a result, so its dependents are submitted before anyone sees it
+        ready = []
+        for stage in self.stages.values():
+            if stage.name in self._futures or stage.name in self.skipped:
+                continue
+            failed = [d for d in stage.depends_on if d in self.errors or d in self.skipped]
+            if any(self.stages[d].required for d in failed):
+                self.skipped.append(stage.name)
+                continue
+            if not all(d in self.results or d in failed for d in stage.depends_on):
+                continue
+            inputs = {d: self.results.get(d) for d in stage.depends_on}
+            # stages see the context vars of the caller, like the llm cache bypass
+            context = self._context.copy()
+            self._futures[stage.name] = self.executor.submit(context.run, self._attempts, stage, inputs)
+            ready.append(stage)
+        return ready
+
+    def _add_callbacks(self, stages: List[Stage]):
+        # outside the lock, the callback runs right away if the stage is already done
+        for stage in stages:
+            self._futures[stage.name].add_done_callback(lambda f, s=stage: self._on_done(s, f))
+
+    def _submit_ready(self):
+        with self._lock:
+            ready = self._submit_ready_locked()
+        self._add_callbacks(ready)
+
+    def _on_done(self, stage: Stage, future):
+        with self._lock:
+            if stage.name in self.results or stage.name in self.errors:
+                return  # already given up on by the blocking wait
+            error = future.exception()
+            if error is None:
+                self.results[stage.name] = future.result()
+            else:
+                self.errors[stage.name] = error
+            ready = self._submit_ready_locked()
+        self._add_callbacks(ready)
+        self._record(stage, error)
+        self._log_if_finished()
+
+    def _record(self, stage: Stage, error: Optional[Exception]):
+        status = 'ok' if error is None else 'timeout' if isinstance(error, StageTimeoutError) else 'error'
+        if error is not None:
+            print(f'StageGraph {self.name} {stage.name} failed: {error}')
+        metrics.incr(f'memory_stage_{status}:{stage.name}')
+        if stage.name in self.timings:
+            metrics.observe(f'memory_stage_seconds:{stage.name}', self.timings[stage.name])
+
+    def _log_if_finished(self):
+        with self._lock:
+            done = len(self.results) + len(self.errors) + len(self.skipped)
+            if done < len(self.stages) or self._logged:
+                return
+            self._logged = True
+        total = time.time() - self._started_at
+        timings = {name: round(seconds, 3) for name, seconds in list(self.timings.items())}
+        print('StageGraph', self.name, 'finished in', round(total, 3), timings,
+              'errors:', list(self.errors.keys()), 'skipped:', self.skipped)
+        metrics.observe(f'memory_stage_graph_seconds:{self.name}', total)
+
+    def _deadline(self, name: str) -> float:
+        stage = self.stages[name]
+        started_at = self._stage_started_at.get(name)
+        if started_at is None:
+            return float('inf')  # still queued
+        # every attempt can take up to the timeout, plus the backoff between them
+        return started_at + stage.timeout * (stage.retries + 1) + 4 * stage.retries + 1
+
+    def _blocking_pending(self) -> List[str]:
+        return [
+            name for name, stage in self.stages.items()
+            if stage.blocking and name not in self.results and name not in self.errors and name not in self.skipped
+        ]
+
+    def run(self) -> Dict[str, Any]:
+        """Starts every stage and returns the blocking results once they are done, deferred stages keep going."""
+        self._started_at = time.time()
+        self._submit_ready()
+
+        while pending := self._blocking_pending():
+            # blocking stages can depend on deferred ones, wait on whatever is running
+            with self._lock:
+                running = [name for name in self._futures if name not in self.results and name not in self.errors]
+                if not running:
+                    # results are recorded with their dependents submitted, what's pending depends on itself
+                    for name in self._blocking_pending():
+                        self.errors[name] = ValueError(f'{name} depends on stages that never run')
+            if not running:
+                continue
+            # queued stages get their deadline once they start, which no future completing would tell
+            timeout = min(self._deadline(name) for name in running) - time.time()
+            if any(name not in self._stage_started_at for name in running):
+                timeout = min(timeout, 0.5)
+            wait([self._futures[name] for name in running], timeout=max(timeout, 0), return_when=FIRST_COMPLETED)
+
+            for name in running:
+                stage, future = self.stages[name], self._futures[name]
+                if future.done():
+                    self._on_done(stage, future)  # the done callback may not have run yet
+                elif time.time() > self._deadline(name):
+                    error = StageTimeoutError(f'{name} did not finish in {stage.timeout}s')
+                    with self._lock:
+                        self.errors[name] = error
+                        self.timings[name] = time.time() - self._stage_started_at[name]
+                        ready = self._submit_ready_locked()
+                    self._add_callbacks(ready)
+                    self._record(stage, error)
+
+        self.timings['blocking'] = time.time() - self._started_at
+        metrics.observe(f'memory_stage_blocking_seconds:{self.name}', self.timings['blocking'])
+        self._log_if_finished()
+        return self.results
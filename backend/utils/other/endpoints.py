@@ -29,6 +29,12 @@ def get_current_user_uid(authorization: str = Header(None)):
         raise HTTPException(status_code=401, detail="Invalid authorization token")
 
 
+def verify_admin_key(authorization: str = Header(None)):
+    # internal endpoints, closed when ADMIN_KEY isn't set
+    if not os.getenv('ADMIN_KEY') or authorization != os.getenv('ADMIN_KEY'):
+        raise HTTPException(status_code=401, detail="Invalid authorization token")
+
+
 cached = {}
 
 
@@ -0,0 +1,108 @@
+import asyncio
+import os
+import time
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+import httpx
+
+from utils.other import metrics
+
+# Connections kept to plugin and developer webhook hosts, shared by every session in the container.
+fanout_max_connections = int(os.getenv('REALTIME_FANOUT_MAX_CONNECTIONS', 200))
+# Requests in flight to a single target (plugin or webhook type) across all users.
+fanout_target_concurrency = int(os.getenv('REALTIME_FANOUT_TARGET_CONCURRENCY', 32))
+# Segments waiting for a slow target before the oldest are dropped.
+fanout_max_pending_segments = int(os.getenv('REALTIME_FANOUT_MAX_PENDING_SEGMENTS', 500))
+
+_client: Optional[httpx.AsyncClient] = None
+
+
+def get_http_client() -> httpx.AsyncClient:
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=fanout_max_connections, max_keepalive_connections=50),
+            timeout=httpx.Timeout(30, connect=5),
+        )
+    return _client
+
+
+class _Delivery:
+    def __init__(self):
+        self.pending: List[dict] = []
+        self.task: Optional[asyncio.Task] = None
+
+
+class RealtimeFanout:
+    """
+    Posts realtime transcript segments to many targets (plugins, developer webhooks) from the event loop.
+
+    - One pooled `httpx.AsyncClient` for all targets, no thread per request.
+    - Per target concurrency limit, so a slow plugin can't take every connection.
+    - Per request deadline, including the time waiting for the target to have a free slot.
+    - Coalescing per (uid, target): while a request is in flight, new segments are queued and sent together in
+      the next request, so a target gets at most one request at a time per user.
+    """
+
+    def __init__(self, target_concurrency: int = fanout_target_concurrency,
+                 max_pending_segments: int = fanout_max_pending_segments):
+        self.target_concurrency = target_concurrency
+        self.max_pending_segments = max_pending_segments
+        self._semaphores: Dict[str, asyncio.Semaphore] = {}
+        self._deliveries: Dict[Tuple[str, str], _Delivery] = {}
+
+    def submit(
+            self, uid: str, target: str, url: str, segments: List[dict], deadline: float,
+            on_response: Optional[Callable[[httpx.Response], Awaitable[None]]] = None,
+    ):
+        key = (uid, target)
+        delivery = self._deliveries.get(key)
+        if delivery is None:
+            delivery = self._deliveries[key] = _Delivery()
+        delivery.pending.extend(segments)
+        if len(delivery.pending) > self.max_pending_segments:
+            dropped = len(delivery.pending) - self.max_pending_segments
+            del delivery.pending[:dropped]
+            metrics.incr(f'realtime_fanout_dropped_segments:{target}', dropped)
+        if delivery.task is None:
+            delivery.task = asyncio.create_task(self._deliver(key, url, deadline, on_response))
+
+    async def _deliver(self, key: Tuple[str, str], url: str, deadline: float, on_response):
+        uid, target = key
+        delivery = self._deliveries[key]
+        try:
+            while delivery.pending:
+                segments, delivery.pending = delivery.pending, []
+                response = await self._post(target, url, {'session_id': uid, 'segments': segments}, deadline)
+                if response is not None and on_response:
+                    try:
+                        await on_response(response)
+                    except Exception as e:
+                        print(f'RealtimeFanout {target} response handling failed: {e}')
+        finally:
+            self._deliveries.pop(key, None)
+
+    async def _post(self, target: str, url: str, payload: dict, deadline: float) -> Optional[httpx.Response]:
+        semaphore = self._semaphores.get(target)
+        if semaphore is None:
+            semaphore = self._semaphores[target] = asyncio.Semaphore(self.target_concurrency)
+
+        async def _request():
+            async with semaphore:
+                return await get_http_client().post(url, json=payload, timeout=deadline)
+
+        start = time.time()
+        try:
+            response = await asyncio.wait_for(_request(), deadline)
+            metrics.observe(f'realtime_fanout_seconds:{target}', time.time() - start)
+            return response
+        except asyncio.TimeoutError:
+            print(f'RealtimeFanout {target} missed the {deadline}s deadline')
+            metrics.incr(f'realtime_fanout_timeouts:{target}')
+        except Exception as e:
+            print(f'RealtimeFanout {target} request failed: {e}')
+            metrics.incr(f'realtime_fanout_errors:{target}')
+        return None
+
+
+realtime_fanout = RealtimeFanout()
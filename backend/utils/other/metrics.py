@@ -0,0 +1,87 @@
+import threading
+import time
+from collections import deque
+from typing import Dict
+
+# In-process metrics, each Modal container keeps its own, they are logged and exposed through /metrics.
+
+_lock = threading.Lock()
+_counters: Dict[str, float] = {}
+_gauges: Dict[str, float] = {}
+_histograms: Dict[str, 'Histogram'] = {}
+
+
+class Histogram:
+    """Keeps the last `size` observations, enough to read p50/p95/p99 of recent traffic."""
+
+    def __init__(self, size: int = 1024):
+        self.values = deque(maxlen=size)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, value: float):
+        self.values.append(value)
+        self.count += 1
+        self.total += value
+
+    def percentile(self, p: float) -> float:
+        if not self.values:
+            return 0.0
+        values = sorted(self.values)
+        return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+    def summary(self) -> dict:
+        return {
+            'count': self.count,
+            'avg': self.total / self.count if self.count else 0.0,
+            'p50': self.percentile(50),
+            'p95': self.percentile(95),
+            'p99': self.percentile(99),
+            'max': max(self.values) if self.values else 0.0,
+        }
+
+
+def incr(name: str, value: float = 1):
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def gauge(name: str, value: float):
+    with _lock:
+        _gauges[name] = value
+
+
+def gauge_add(name: str, value: float):
+    with _lock:
+        _gauges[name] = _gauges.get(name, 0) + value
+
+
+def observe(name: str, value: float):
+    with _lock:
+        if name not in _histograms:
+            _histograms[name] = Histogram()
+        _histograms[name].observe(value)
+
+
+class timer:
+    """Context manager observing the elapsed seconds into the `name` histogram."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *args):
+        observe(self.name, time.time() - self.start)
+
+
+def snapshot() -> dict:
+    with _lock:
+        return {
+            'counters': dict(_counters),
+            'gauges': dict(_gauges),
+            'histograms': {name: h.summary() for name, h in _histograms.items()},
+        }
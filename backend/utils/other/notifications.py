@@ -1,6 +1,5 @@
 import asyncio
 import concurrent.futures
-import threading
 from datetime import datetime
 from datetime import time
 
@@ -9,10 +8,12 @@ import pytz
 import database.chat as chat_db
 import database.memories as memories_db
 import database.notifications as notification_db
+from models.job import JobType
 from models.notification_message import NotificationMessage
+from utils.jobs import enqueue_job
 from utils.llm import get_memory_summary
+from utils.llm_scheduler import llm_priority, LLMPriority
 from utils.notifications import send_notification, send_bulk_notification
-from utils.webhooks import day_summary_webhook
 
 
 async def start_cron_job():
@@ -59,7 +60,8 @@ def _send_summary_notification(user_data: tuple):
     if not memories:
         return
     else:
-        summary = get_memory_summary(uid, memories)
+        with llm_priority(LLMPriority.summaries, uid):
+            summary = get_memory_summary(uid, memories)
 
     ai_message = NotificationMessage(
         text=summary,
@@ -68,7 +70,7 @@ def _send_summary_notification(user_data: tuple):
         notification_type='daily_summary',
     )
     chat_db.add_summary_message(summary, uid)
-    threading.Thread(target=day_summary_webhook, args=(uid, summary)).start()
+    enqueue_job(JobType.day_summary_webhook, uid=uid, payload={'summary': summary})
     send_notification(fcm_token, daily_summary_title, summary, NotificationMessage.get_message_as_dict(ai_message))
 
 
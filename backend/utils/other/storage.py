@@ -3,10 +3,14 @@ import json
 import os
 from typing import List
 
+from google.api_core.exceptions import NotFound
 from google.cloud import storage
 from google.oauth2 import service_account
 
-from database.redis_db import cache_signed_url, get_cached_signed_url
+from database.redis_db import cache_signed_url, get_cached_signed_url, set_speech_profile_generation, \
+    get_speech_profile_generation
+from models.job import Job, JobType
+from utils.jobs import job_handler
 
 if os.environ.get('SERVICE_ACCOUNT_JSON'):
     service_account_info = json.loads(os.environ["SERVICE_ACCOUNT_JSON"])
@@ -29,6 +33,7 @@ def upload_profile_audio(file_path: str, uid: str):
     path = f'{uid}/speech_profile.wav'
     blob = bucket.blob(path)
     blob.upload_from_filename(file_path)
+    set_speech_profile_generation(uid, blob.generation)
     return f'https://storage.googleapis.com/{speech_profiles_bucket}/{path}'
 
 
@@ -52,6 +57,25 @@ def get_profile_audio_if_exists(uid: str, download: bool = True) -> str:
     return None
 
 
+def get_profile_audio_generation(uid: str) -> int:
+    """GCS generation of the user speech profile, 0 if there is none, cached to skip the metadata request."""
+    generation = get_speech_profile_generation(uid)
+    if generation is not None:
+        return generation
+
+    bucket = storage_client.bucket(speech_profiles_bucket)
+    blob = bucket.get_blob(f'{uid}/speech_profile.wav')
+    generation = blob.generation if blob else 0
+    set_speech_profile_generation(uid, generation, ttl=60 * 60 * 24 if generation else 60 * 10)
+    return generation
+
+
+def download_profile_audio(uid: str, generation: int, file_path: str):
+    bucket = storage_client.bucket(speech_profiles_bucket)
+    blob = bucket.blob(f'{uid}/speech_profile.wav', generation=generation)
+    blob.download_to_filename(file_path)
+
+
 def upload_additional_profile_audio(file_path: str, uid: str) -> None:
     bucket = storage_client.bucket(speech_profiles_bucket)
     path = f'{uid}/additional_profile_recordings/{file_path.split("/")[-1]}'
@@ -151,6 +175,14 @@ def delete_postprocessing_audio(file_path: str):
     blob.delete()
 
 
+@job_handler(JobType.delete_postprocessing_audio)
+def _delete_postprocessing_audio_job(job: Job):
+    try:
+        delete_postprocessing_audio(job.payload['file_path'])
+    except NotFound:
+        pass  # deleted by a previous attempt
+
+
 # ***********************************
 # ************* SDCARD **************
 # ***********************************
@@ -223,6 +255,14 @@ def delete_syncing_temporal_file(file_path: str):
     blob.delete()
 
 
+@job_handler(JobType.delete_syncing_temporal_file)
+def _delete_syncing_temporal_file_job(job: Job):
+    try:
+        delete_syncing_temporal_file(job.payload['file_path'])
+    except NotFound:
+        pass
+
+
 # **********************************
 # ************* UTILS **************
 # **********************************
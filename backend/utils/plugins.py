@@ -1,5 +1,8 @@
+import asyncio
+import os
 import threading
-from typing import List, Optional
+import time
+from typing import Dict, List, Optional
 
 import requests
 
@@ -7,11 +10,14 @@ import database.notifications as notification_db
 from database.chat import add_plugin_message
 from database.plugins import record_plugin_usage
 from database.redis_db import get_enabled_plugins, get_plugin_reviews, get_plugin_installs_count, get_generic_cache, \
-    set_generic_cache
+    set_generic_cache, get_realtime_targets_data
 from models.memory import Memory, MemorySource
 from models.notification_message import NotificationMessage
 from models.plugin import Plugin, UsageHistoryType
+from models.users import WebhookType
 from utils.notifications import send_notification
+from utils.other import metrics
+from utils.other.fanout import realtime_fanout
 from utils.other.endpoints import timeit
 
 
@@ -35,17 +41,22 @@ def weighted_rating(plugin):
     return (v / (v + m) * R) + (m / (v + m) * C)
 
 
-def get_plugins_data(uid: str, include_reviews: bool = False) -> List[Plugin]:
-    # print('get_plugins_data', uid, include_reviews)
+def get_plugins_catalog() -> List[dict]:
     if data := get_generic_cache('get_plugins_data'):
         print('get_plugins_data from cache')
-        pass
-    else:
-        response = requests.get('https://raw.githubusercontent.com/BasedHardware/Omi/main/community-plugins.json')
-        if response.status_code != 200:
-            return []
-        data = response.json()
-        set_generic_cache('get_plugins_data', data, 60 * 10)  # 10 minutes cached
+        return data
+
+    response = requests.get('https://raw.githubusercontent.com/BasedHardware/Omi/main/community-plugins.json')
+    if response.status_code != 200:
+        return []
+    data = response.json()
+    set_generic_cache('get_plugins_data', data, 60 * 10)  # 10 minutes cached
+    return data
+
+
+def get_plugins_data(uid: str, include_reviews: bool = False) -> List[Plugin]:
+    # print('get_plugins_data', uid, include_reviews)
+    data = get_plugins_catalog()
 
     user_enabled = set(get_enabled_plugins(uid))
     # print('get_plugins_data, user_enabled', user_enabled)
@@ -129,64 +140,110 @@ def trigger_external_integrations(uid: str, memory: Memory) -> list:
     return messages
 
 
-async def trigger_realtime_integrations(uid: str, segments: list[dict]):
-    """REALTIME STREAMING"""
-    # TODO: don't retrieve token before knowing if to notify
-    token = notification_db.get_token_only(uid)
-    _trigger_realtime_integrations(uid, token, segments)
+# ***********************************
+# ********* REALTIME FAN-OUT ********
+# ***********************************
 
+# Seconds a user's enabled realtime plugins and webhook are reused before reading them again.
+realtime_targets_cache_seconds = float(os.getenv('REALTIME_TARGETS_CACHE_SECONDS', 30))
+# Seconds a plugin has to answer a realtime transcript request, including waiting for a free connection.
+plugin_realtime_deadline_seconds = float(os.getenv('PLUGIN_REALTIME_DEADLINE_SECONDS', 10))
 
-def _trigger_realtime_integrations(uid: str, token: str, segments: List[dict]) -> dict:
-    plugins: List[Plugin] = get_plugins_data(uid, include_reviews=False)
-    filtered_plugins = [
-        plugin for plugin in plugins if
-        plugin.triggers_realtime() and plugin.enabled and not plugin.deleted
-    ]
-    if not filtered_plugins:
-        return {}
+_token_not_loaded = object()
 
-    threads = []
-    results = {}
 
-    def _single(plugin: Plugin):
-        if not plugin.external_integration.webhook_url:
-            return
+class RealtimeTargets:
+    """What a user's transcript batches are sent to, read once per `realtime_targets_cache_seconds`."""
 
-        url = plugin.external_integration.webhook_url
-        if '?' in url:
-            url += '&uid=' + uid
-        else:
-            url += '?uid=' + uid
+    def __init__(self, plugins: List[Plugin], webhook_url: Optional[str]):
+        self.plugins = plugins
+        self.webhook_url = webhook_url
+        self._token = _token_not_loaded
 
-        try:
-            response = requests.post(url, json={"session_id": uid, "segments": segments}, timeout=30)
-            if response.status_code != 200:
-                print('trigger_realtime_integrations', plugin.id, 'result:', response.content)
-                return
-
-            response_data = response.json()
-            if not response_data:
-                return
-            message = response_data.get('message', '')
-            print('Plugin', plugin.id, 'response:', message)
-            if message and len(message) > 5:
-                send_plugin_notification(token, plugin.name, plugin.id, message)
-                results[plugin.id] = message
-        except Exception as e:
-            print(f"Plugin integration error: {e}")
-            return
+    async def get_token(self, uid: str) -> Optional[str]:
+        # only needed when a plugin has something to say
+        if self._token is _token_not_loaded:
+            loop = asyncio.get_running_loop()
+            self._token = await loop.run_in_executor(None, notification_db.get_token_only, uid)
+        return self._token
 
-    for plugin in filtered_plugins:
-        threads.append(threading.Thread(target=_single, args=(plugin,)))
 
-    [t.start() for t in threads]
-    [t.join() for t in threads]
-    messages = []
-    for key, message in results.items():
-        if not message:
+_realtime_targets: Dict[str, tuple] = {}
+
+
+def _load_realtime_targets(uid: str) -> RealtimeTargets:
+    enabled, data, webhook_enabled, webhook_url = get_realtime_targets_data(uid, WebhookType.realtime_transcript)
+    if data is None:
+        data = get_plugins_catalog()
+    enabled = set(enabled)
+    plugins = []
+    for plugin in data:
+        if plugin['id'] not in enabled:
             continue
-        messages.append(add_plugin_message(message, key, uid))
-    return messages
+        plugin = Plugin(**{**plugin, 'enabled': True})
+        if plugin.triggers_realtime() and not plugin.deleted and plugin.external_integration.webhook_url:
+            plugins.append(plugin)
+    return RealtimeTargets(plugins, webhook_url if webhook_enabled and webhook_url else None)
+
+
+async def get_realtime_targets(uid: str) -> RealtimeTargets:
+    """Cached per container, concurrent callers on a miss share the same read."""
+    now = time.time()
+    cached = _realtime_targets.get(uid)
+    if cached and cached[0] > now:
+        metrics.incr('realtime_targets_cache_hit')
+        return await cached[1]
+
+    metrics.incr('realtime_targets_cache_miss')
+    if len(_realtime_targets) > 10000:
+        for key in [k for k, v in _realtime_targets.items() if v[0] <= now]:
+            _realtime_targets.pop(key, None)
+    future = asyncio.get_running_loop().run_in_executor(None, _load_realtime_targets, uid)
+    _realtime_targets[uid] = (now + realtime_targets_cache_seconds, future)
+    try:
+        return await future
+    except Exception:
+        _realtime_targets.pop(uid, None)
+        raise
+
+
+def _with_uid(url: str, uid: str) -> str:
+    return url + ('&uid=' if '?' in url else '?uid=') + uid
+
+
+async def trigger_realtime_integrations(uid: str, segments: list[dict]):
+    """REALTIME STREAMING"""
+    try:
+        targets = await get_realtime_targets(uid)
+    except Exception as e:
+        print(f'trigger_realtime_integrations could not read targets: {e}')
+        return
+
+    for plugin in targets.plugins:
+        realtime_fanout.submit(
+            uid, plugin.id, _with_uid(plugin.external_integration.webhook_url, uid), segments,
+            plugin_realtime_deadline_seconds, _plugin_response_handler(uid, plugin, targets),
+        )
+
+
+def _plugin_response_handler(uid: str, plugin: Plugin, targets: RealtimeTargets):
+    async def on_response(response):
+        if response.status_code != 200:
+            print('trigger_realtime_integrations', plugin.id, 'result:', response.content)
+            return
+
+        response_data = response.json()
+        if not response_data:
+            return
+        message = response_data.get('message', '')
+        print('Plugin', plugin.id, 'response:', message)
+        if message and len(message) > 5:
+            token = await targets.get_token(uid)
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, send_plugin_notification, token, plugin.name, plugin.id, message)
+            await loop.run_in_executor(None, add_plugin_message, message, plugin.id, uid)
+
+    return on_response
 
 
 def send_plugin_notification(token: str, plugin_name: str, plugin_id: str, message: str):
@@ -1,5 +1,7 @@
 import uuid
 import os
+import struct
+from collections import OrderedDict, deque
 from datetime import datetime, timezone, timedelta
 from enum import Enum
 
@@ -18,6 +20,8 @@ from models.message_event import MemoryEvent, MessageEvent
 from utils.memories.location import get_google_maps_location
 from utils.memories.process_memory import process_memory
 from utils.plugins import trigger_external_integrations, trigger_realtime_integrations
+from utils.other import metrics
+from utils.stt.pool import connect_with_backoff
 from utils.stt.streaming import *
 from utils.webhooks import send_audio_bytes_developer_webhook, realtime_transcript_webhook, \
     get_audio_bytes_webhook_seconds
@@ -39,9 +43,179 @@ async def connect_to_audio_bytes_pusher(uid: str, sample_rate: int = 8000):
     try:
         print("Connecting to Pusher audio bytes trigger WebSocket...")
         ws_host = PusherAPI.replace("http", "ws")
-        socket = await websockets.connect(f"{ws_host}/v1/trigger/audio-bytes/listen?uid={uid}&sample_rate={sample_rate}")
+        socket = await websockets.connect(
+            f"{ws_host}/v1/trigger/audio-bytes/listen?uid={uid}&sample_rate={sample_rate}&ack=true"
+        )
         print("Connected to Pusher audio bytes trigger WebSocket.")
         return socket
     except Exception as e:
         print(f"Exception in connect_to_audio_bytes_pusher: {e}")
         raise
+
+
+# Flush as soon as `flush_size` is queued, or `flush_seconds` after the first queued item.
+pusher_transcript_flush_seconds = float(os.getenv('PUSHER_TRANSCRIPT_FLUSH_SECONDS', 0.05))
+pusher_audio_flush_seconds = float(os.getenv('PUSHER_AUDIO_FLUSH_SECONDS', 0.5))
+# Segments / audio seconds kept, queued or sent but not acked, before dropping the oldest.
+pusher_max_pending_segments = int(os.getenv('PUSHER_MAX_PENDING_SEGMENTS', 1000))
+pusher_max_pending_audio_seconds = int(os.getenv('PUSHER_MAX_PENDING_AUDIO_SECONDS', 60))
+
+
+def encode_transcript_batch(batch_id: int, items: list):
+    return json.dumps({'batch_id': batch_id, 'segments': [segment for segments in items for segment in segments]})
+
+
+def encode_audio_bytes_batch(batch_id: int, items: list):
+    return struct.pack('<Q', batch_id) + b''.join(items)
+
+
+class PusherForwarder:
+    """
+    Forwards a session transcript or audio to the pusher, in batches.
+
+    Items are queued by `send`, and sent by `run` as soon as `flush_size` is reached, or `flush_seconds` after
+    the first one was queued. Each batch has an increasing id that the pusher acks, batches not acked yet are
+    sent again after reconnecting. Queued and unacked items are bounded by `max_pending`, the oldest are
+    dropped first.
+    """
+
+    def __init__(self, name: str, connect, encode, flush_size: int, flush_seconds: float, max_pending: int,
+                 size_of=len):
+        self.name = name
+        self.connect = connect
+        self.encode = encode
+        self.flush_size = flush_size
+        self.flush_seconds = flush_seconds
+        self.max_pending = max_pending
+        self.size_of = size_of
+
+        self._cond = asyncio.Condition()
+        self._queue = deque()
+        self._queued_size = 0
+        self._unacked = OrderedDict()  # batch_id -> (message, size)
+        self._unacked_size = 0
+        self._batch_id = 0
+        self._closed = False
+        self._ws = None
+        self._reader_task = None
+        self._task = None
+        self.dropped = 0
+
+    def start(self):
+        self._task = asyncio.create_task(self.run())
+
+    async def send(self, item):
+        if self._closed:
+            return
+        # memoryviews of immutable bytes are kept as is, others (decoder buffers) are reused by their owner
+        if isinstance(item, memoryview) and not isinstance(item.obj, bytes):
+            item = bytes(item)
+        size = self.size_of(item)
+        async with self._cond:
+            self._queue.append((item, size))
+            self._queued_size += size
+            self._drop_oldest()
+            self._cond.notify()
+
+    def _drop_oldest(self):
+        while self._queued_size + self._unacked_size > self.max_pending:
+            if self._unacked:
+                _, (_, size) = self._unacked.popitem(last=False)
+                self._unacked_size -= size
+            elif len(self._queue) > 1:
+                _, size = self._queue.popleft()
+                self._queued_size -= size
+            else:
+                break
+            self.dropped += size
+            metrics.incr(f'pusher_dropped:{self.name}', size)
+
+    async def run(self):
+        while True:
+            async with self._cond:
+                await self._cond.wait_for(lambda: self._queue or self._closed)
+                if not self._queue:
+                    break
+                if self._queued_size < self.flush_size and not self._closed:
+                    try:
+                        await asyncio.wait_for(
+                            self._cond.wait_for(lambda: self._queued_size >= self.flush_size or self._closed),
+                            self.flush_seconds,
+                        )
+                    except asyncio.TimeoutError:
+                        pass
+                items = [item for item, _ in self._queue]
+                size = self._queued_size
+                self._queue.clear()
+                self._queued_size = 0
+
+            self._batch_id += 1
+            self._unacked[self._batch_id] = (self.encode(self._batch_id, items), size)
+            self._unacked_size += size
+            metrics.observe(f'pusher_batch_size:{self.name}', size)
+            await self._deliver(self._batch_id)
+
+    async def _deliver(self, batch_id: int):
+        if self._ws is not None:
+            try:
+                await self._ws.send(self._unacked[batch_id][0])
+                return
+            except KeyError:
+                return  # dropped
+            except websockets.exceptions.ConnectionClosed as e:
+                print(f"Pusher {self.name} Connection closed: {e}")
+        await self._reconnect()
+
+    async def _reconnect(self):
+        if self._reader_task:
+            self._reader_task.cancel()
+        self._ws, self._reader_task = None, None
+        try:
+            self._ws = await connect_with_backoff('pusher', self.connect)
+        except Exception as e:
+            print(f"Pusher {self.name} failed to connect: {e}")
+            return
+        self._reader_task = asyncio.create_task(self._read_acks(self._ws))
+
+        # everything not acked, in order
+        for batch_id in list(self._unacked.keys()):
+            message = self._unacked.get(batch_id)
+            if message is None:
+                continue
+            try:
+                await self._ws.send(message[0])
+            except websockets.exceptions.ConnectionClosed as e:
+                print(f"Pusher {self.name} Connection closed resending: {e}")
+                self._ws = None
+                return
+
+    async def _read_acks(self, ws):
+        try:
+            async for message in ws:
+                data = json.loads(message)
+                if data.get('type') != 'ack':
+                    continue
+                while self._unacked and next(iter(self._unacked)) <= data['batch_id']:
+                    _, (_, size) = self._unacked.popitem(last=False)
+                    self._unacked_size -= size
+        except websockets.exceptions.ConnectionClosed:
+            pass
+        except Exception as e:
+            print(f"Pusher {self.name} ack reader failed: {e}")
+
+    async def close(self, code: int = 1000, timeout: float = 5):
+        """Sends what is still queued, and closes the connection."""
+        async with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        if self._task:
+            try:
+                await asyncio.wait_for(self._task, timeout)
+            except Exception as e:
+                print(f"Pusher {self.name} failed to flush: {e}")
+        if self._reader_task:
+            self._reader_task.cancel()
+        if self._ws:
+            await self._ws.close(code)
+        if self.dropped:
+            print(f"Pusher {self.name} dropped {self.dropped}")
@@ -0,0 +1,148 @@
+import math
+import os
+import re
+import time
+from array import array
+from typing import Dict, List, Optional
+
+import numpy as np
+
+import database.redis_db as redis_db
+from utils.llm import embeddings
+from utils.llm_cache import LRU
+from utils.other import metrics
+
+# Per user index of the people, topics and entities of their memories, with how many memories mention each value and
+# when it was last seen. Values are embedded once (shared by all users), so the few that can relate to a question are
+# picked before the LLM chooses among them, and the filters prompt stays the same size however many memories one has.
+
+facet_categories = ['people', 'topics', 'entities']
+# Candidates per category given to select_structured_filters.
+facet_candidates = int(os.getenv('FACET_CANDIDATES', 30))
+# text-embedding-3 vectors can be shortened by keeping their first dimensions, plenty to compare short values.
+facet_dimensions = 256
+recency_days = 90
+
+_indexes = LRU(int(os.getenv('FACET_INDEX_CACHE_SIZE', 200)))
+_vectors = LRU(20000)
+
+
+class _CategoryIndex:
+    def __init__(self, entries: dict, matrix: np.ndarray):
+        self.values = list(entries)
+        self.counts = np.array([entries[v][0] for v in self.values], dtype=np.float32)
+        self.seen = np.array([entries[v][1] for v in self.values], dtype=np.float64)
+        self.matrix = matrix
+
+
+def _shorten(vector) -> np.ndarray:
+    vector = np.asarray(vector[:facet_dimensions], dtype=np.float32)
+    return vector / (np.linalg.norm(vector) or 1)
+
+
+def _facet_vectors(values: List[str]) -> np.ndarray:
+    """Vectors of `values` (in process, then Redis, else embedded and stored), one row each."""
+    vectors = {v: vector for v in values if (vector := _vectors.get(v)) is not None}
+    missing = [v for v in values if v not in vectors]
+    if missing:
+        for value, data in zip(missing, redis_db.get_facet_vectors(missing) or [None] * len(missing)):
+            if data:
+                vectors[value] = np.frombuffer(data, dtype=np.float32)
+                _vectors.set(value, vectors[value])
+
+    missing = [v for v in values if v not in vectors]
+    if missing:
+        metrics.incr('facet_vectors_embedded', len(missing))
+        embedded = {value: _shorten(vector) for value, vector in zip(missing, embeddings.embed_documents(missing))}
+        redis_db.set_facet_vectors({value: array('f', vector).tobytes() for value, vector in embedded.items()})
+        for value, vector in embedded.items():
+            _vectors.set(value, vector)
+        vectors.update(embedded)
+
+    if not values:
+        return np.zeros((0, facet_dimensions), dtype=np.float32)
+    return np.stack([vectors[v] for v in values])
+
+
+def _migrate_filter_sets(uid: str):
+    # users from before the index have their values in the users:{uid}:filters:{category} sets, without counts
+    if not redis_db.claim_facet_index_migration(uid):
+        return  # done, or being done by another call
+    migrated = 0
+    for category in facet_categories:
+        values = redis_db.get_filter_category_items(uid, category)
+        redis_db.update_facet_index(uid, category, {value: 1 for value in values}, 0)
+        migrated += len(values)
+    # their memories weren't counted, as many as their values is a rough guess, that errs on the high side: a migrated
+    # user with more values than chat_fast_path_memories (utils/retrieval/graph.py) never takes the chat fast path,
+    # even with fewer memories, they get the filters selection as before the index
+    if migrated:
+        redis_db.incr_facet_index_memories(uid, migrated)
+    print('facets migrated filter sets', uid)
+
+
+def _get_index(uid: str) -> Dict[str, _CategoryIndex]:
+    version = redis_db.get_facet_index_version(uid)
+    cached = _indexes.get(uid)
+    if cached and cached[0] == version:
+        return cached[1]
+
+    if not version:
+        _migrate_filter_sets(uid)
+        version = redis_db.get_facet_index_version(uid)
+
+    index = {}
+    for category in facet_categories:
+        entries = redis_db.get_facet_index(uid, category) or {}
+        index[category] = _CategoryIndex(entries, _facet_vectors(list(entries)))
+    _indexes.set(uid, (version, index))
+    return index
+
+
+def _rank(category: _CategoryIndex, question: str, question_vector: Optional[np.ndarray], limit: int) -> List[str]:
+    if len(category.values) <= limit:
+        return category.values
+
+    similarity = category.matrix @ question_vector if question_vector is not None else 0
+    frequency = np.log1p(category.counts) / math.log1p(category.counts.max())
+    age_days = np.maximum(time.time() - category.seen, 0) / 86400
+    recency = np.exp(-age_days / recency_days)
+    scores = similarity + 0.1 * frequency + 0.05 * recency
+
+    # values the question names are always candidates
+    question = ' ' + re.sub(r'[^\w\s-]', ' ', question.lower()) + ' '
+    mentioned = np.array([f' {value} ' in question for value in category.values])
+    scores = np.where(mentioned, scores + 1, scores)
+
+    top = np.argpartition(-scores, limit - 1)[:limit]
+    return [category.values[i] for i in top[np.argsort(-scores[top])]]
+
+
+def select_candidate_facets(
+        uid: str, question: str, question_vector: Optional[List[float]], limit: int = facet_candidates
+) -> Dict[str, List[str]]:
+    """Up to `limit` values per category most likely to relate to the question, by similarity, frequency and recency."""
+    start = time.time()
+    index = _get_index(uid)
+    vector = _shorten(question_vector) if question_vector and any(question_vector) else None
+    result = {category: _rank(index[category], question, vector, limit) for category in facet_categories}
+    metrics.observe('facet_selection_seconds', time.time() - start)
+    return result
+
+
+def indexed_memories(uid: str) -> Optional[int]:
+    """How many memories the user index has seen, None if unknown."""
+    if not redis_db.get_facet_index_version(uid):
+        return None
+    return redis_db.get_facet_index_memories(uid)
+
+
+def index_memory_facets(uid: str, memory_id: str, metadata: dict):
+    """Counts the memory facets in the user index, replacing the ones it had when it's processed again."""
+    if not redis_db.get_facet_index_version(uid):
+        _migrate_filter_sets(uid)
+    # keeps the facets counted for the memory, so a retry counts nothing twice
+    facets = {category: metadata.get(category) or [] for category in facet_categories}
+    redis_db.update_memory_facet_index(uid, memory_id, facets, metadata.get('created_at') or int(time.time()))
+    # embedded now, not on the next chat question
+    _facet_vectors(list({v for category in facet_categories for v in metadata.get(category, []) if v}))
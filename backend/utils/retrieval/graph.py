@@ -1,11 +1,11 @@
+import contextvars
 import datetime
 import os
 import time
 import uuid
-from typing import List, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Generator, List, Optional, Tuple
 
-from langchain_openai import ChatOpenAI
-from langgraph.checkpoint.memory import MemorySaver
 from langgraph.constants import END
 from langgraph.graph import START, StateGraph
 from typing_extensions import TypedDict, Literal
@@ -16,15 +16,20 @@ from utils.other.endpoints import timeit
 
 import database.chat as chat_db
 import database.memories as memories_db
-from database.redis_db import get_filter_category_items
+from database.redis_db import get_generic_cache, set_generic_cache
 from database.vector_db import query_vectors_by_metadata
 from models.chat import Message
 from models.memory import Memory
 from models.plugin import Plugin
+from utils.llm_scheduler import ScheduledChatOpenAI, llm_priority, LLMPriority
 from utils.llm import requires_context, answer_simple_message, retrieve_context_dates, qa_rag, \
-    select_structured_filters, extract_question_from_conversation, generate_embedding
+    select_structured_filters, extract_question_from_conversation, generate_embedding, qa_rag_stream, \
+    answer_simple_message_stream
+from utils.llm_cache import cache_key, llm_cache_bypassed
+from utils.other import metrics
+from utils.retrieval.facets import select_candidate_facets, indexed_memories
 
-model = ChatOpenAI(model='gpt-4o-mini')
+model = ScheduledChatOpenAI(model='gpt-4o-mini')
 
 
 class StructuredFilters(TypedDict):
@@ -44,47 +49,142 @@ class GraphState(TypedDict):
     messages: List[Message]
     plugin_selected: Optional[Plugin]
 
+    requires_context: Optional[bool]
     filters: Optional[StructuredFilters]
     date_filters: Optional[DateRangeFilters]
 
+    memories_id: Optional[List[str]]
     memories_found: Optional[List[Memory]]
 
     parsed_question: Optional[str]
     answer: Optional[str]
 
 
-def determine_conversation_type(s: GraphState) -> Literal[
-    "no_context_conversation", "context_dependent_conversation"]:
-    requires = requires_context(s.get('messages', []))
+# Speculative calls of chat turns, running while the one they may be needed after is.
+chat_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv('CHAT_SPECULATION_WORKERS', 32)), thread_name_prefix='chat-speculation'
+)
+# The state up to the retrieved memories of a conversation is reused when the same messages come again (retries).
+chat_state_cache_seconds = int(os.getenv('CHAT_STATE_CACHE_SECONDS', 600))
+# Users with up to this many memories skip the filters selection, the vector search alone ranks them all.
+chat_fast_path_memories = int(os.getenv('CHAT_FAST_PATH_MEMORIES', 10))
 
-    if requires:
-        return 'context_dependent_conversation'
-    return 'no_context_conversation'
 
+def timed_node(func):
+    """Observes the node duration in the chat_node_seconds:{node} metric."""
 
-def no_context_conversation(state: GraphState):
-    print('no_context_conversation node')
-    return {'answer': answer_simple_message(state.get('uid'), state.get('messages'))}
+    def node(state: GraphState):
+        start = time.time()
+        try:
+            return func(state)
+        finally:
+            metrics.observe(f'chat_node_seconds:{func.__name__}', time.time() - start)
+
+    node.__name__ = func.__name__
+    return node
+
+
+def _submit(fn, *args) -> Future:
+    return chat_executor.submit(contextvars.copy_context().run, fn, *args)
+
+
+# *******************************************
+# ************* STATE CACHE *****************
+# *******************************************
+
+def _state_cache_path(uid: str, messages: List[Message]) -> str:
+    # the newest message id, so the same question asked again after clearing the chat isn't answered from the
+    # memories found the first time
+    newest = max(messages, key=lambda m: m.created_at).id if messages else ''
+    return 'chat_state:' + cache_key(uid, newest, *[f'{m.sender}: {m.text}' for m in messages])
+
+
+def _get_cached_state(uid: str, messages: List[Message]) -> Optional[dict]:
+    if llm_cache_bypassed():
+        return None
+    data = get_generic_cache(_state_cache_path(uid, messages))
+    if not data:
+        return None
+    metrics.incr('chat_state_cache_hit')
+    date_filters = {k: datetime.datetime.fromisoformat(v) for k, v in data.get('date_filters', {}).items()}
+    return {**data, 'date_filters': date_filters}
+
+
+def _set_cached_state(state: GraphState, data: dict):
+    if 'date_filters' in data:
+        data['date_filters'] = {k: v.isoformat() for k, v in data['date_filters'].items() if v}
+    set_generic_cache(
+        _state_cache_path(state.get('uid'), state.get('messages', [])), data, ttl=chat_state_cache_seconds
+    )
+
+
+# *************************************
+# ************* NODES *****************
+# *************************************
+
+def _extract_question(messages: List[Message]) -> str:
+    question = extract_question_from_conversation(messages)
+    # warms the embeddings cache for the filters selection and query_vectors
+    generate_embedding(question)
+    return question
+
+
+def _context_dates(messages: List[Message]) -> dict:
+    dates_range = retrieve_context_dates(messages)
+    if dates_range and len(dates_range) == 2:
+        return {'start': dates_range[0], 'end': dates_range[1]}
+    return {}
 
 
-def context_dependent_conversation(state: GraphState):
-    question = extract_question_from_conversation(state.get('messages', []))
-    print('context_dependent_conversation parsed question:', question)
-    return {'parsed_question': question}
+@timed_node
+def prepare_conversation(state: GraphState):
+    """
+    Asks if the conversation requires context while the question is extracted and embedded, and the dates are only
+    asked for once it does. A question that doesn't need context is answered without waiting for the rest.
+    """
+    messages = state.get('messages', [])
+    if cached := _get_cached_state(state.get('uid'), messages):
+        return cached
 
+    question = _submit(_extract_question, messages)
+    if not requires_context(messages):
+        _set_cached_state(state, {'requires_context': False})
+        return {'requires_context': False}
 
-# !! include a question extractor? node?
+    dates = _submit(_context_dates, messages)
+    question = question.result()
+    print('prepare_conversation parsed question:', question)
+    return {'requires_context': True, 'parsed_question': question, 'date_filters': dates.result()}
 
 
+def determine_conversation_type(s: GraphState) -> Literal[
+    "no_context_conversation", "retrieve_topics_filters", "query_vectors"]:
+    if not s.get('requires_context'):
+        return 'no_context_conversation'
+    if s.get('memories_id') is not None:
+        return 'query_vectors'
+    return 'retrieve_topics_filters'
+
+
+@timed_node
+def no_context_conversation(state: GraphState):
+    print('no_context_conversation node')
+    return {'answer': answer_simple_message(state.get('uid'), state.get('messages'))}
+
+
+@timed_node
 def retrieve_topics_filters(state: GraphState):
     print('retrieve_topics_filters')
-    filters = {
-        'people': get_filter_category_items(state.get('uid'), 'people'),
-        'topics': get_filter_category_items(state.get('uid'), 'topics'),
-        'entities': get_filter_category_items(state.get('uid'), 'entities'),
-        # 'dates': get_filter_category_items(state.get('uid'), 'dates'),
-    }
-    result = select_structured_filters(state.get('parsed_question', ''), filters)
+    uid = state.get('uid')
+    memories_count = indexed_memories(uid)
+    if memories_count is not None and memories_count <= chat_fast_path_memories:
+        metrics.incr('chat_fast_path')
+        return {'filters': {'topics': [], 'people': [], 'entities': []}}
+
+    question = state.get('parsed_question') or ''
+    # the embedding is cached, query_vectors gets it for free
+    filters = select_candidate_facets(uid, question, generate_embedding(question))
+    result = select_structured_filters(question, filters)
     return {'filters': {
         'topics': result.get('topics', []),
         'people': result.get('people', []),
@@ -93,32 +193,34 @@ def retrieve_topics_filters(state: GraphState):
     }}
 
 
-def retrieve_date_filters(state: GraphState):
-    dates_range = retrieve_context_dates(state.get('messages', []))
-    if dates_range and len(dates_range) == 2:
-        return {'date_filters': {'start': dates_range[0], 'end': dates_range[1]}}
-    return {'date_filters': {}}
-
-
+@timed_node
 def query_vectors(state: GraphState):
     print('query_vectors')
-    date_filters = state.get('date_filters')
     uid = state.get('uid')
-    vector = generate_embedding(state.get('parsed_question', '')) if state.get('parsed_question') else [0] * 3072
-    print('query_vectors vector:', vector[:5])
-    memories_id = query_vectors_by_metadata(
-        uid,
-        vector,
-        dates_filter=[date_filters.get('start'), date_filters.get('end')],
-        people=state.get('filters', {}).get('people', []),
-        topics=state.get('filters', {}).get('topics', []),
-        entities=state.get('filters', {}).get('entities', []),
-        dates=state.get('filters', {}).get('dates', []),
-    )
+    memories_id = state.get('memories_id')
+    if memories_id is None:
+        date_filters = state.get('date_filters') or {}
+        # no question embeds to a zero vector, without calling the api
+        vector = generate_embedding(state.get('parsed_question') or '')
+        print('query_vectors vector:', vector[:5])
+        memories_id = query_vectors_by_metadata(
+            uid,
+            vector,
+            dates_filter=[date_filters.get('start'), date_filters.get('end')],
+            people=state.get('filters', {}).get('people', []),
+            topics=state.get('filters', {}).get('topics', []),
+            entities=state.get('filters', {}).get('entities', []),
+            dates=state.get('filters', {}).get('dates', []),
+        )
+        _set_cached_state(state, {
+            'requires_context': True, 'parsed_question': state.get('parsed_question'),
+            'date_filters': dict(date_filters), 'filters': state.get('filters'), 'memories_id': memories_id,
+        })
     memories = memories_db.get_memories_by_id(uid, memories_id)
     return {'memories_found': memories}
 
 
+@timed_node
 def qa_handler(state: GraphState):
     uid = state.get('uid')
     memories = state.get('memories_found', [])
@@ -131,45 +233,83 @@ def qa_handler(state: GraphState):
     return {'answer': response}
 
 
-workflow = StateGraph(GraphState)
-
-workflow.add_conditional_edges(
-    START,
-    determine_conversation_type,
-)
-
-workflow.add_node("no_context_conversation", no_context_conversation)
-workflow.add_node("context_dependent_conversation", context_dependent_conversation)
-
-workflow.add_edge("no_context_conversation", END)
+def _compile(answer: bool):
+    """The chat graph, or without `answer` the part up to the retrieved memories, for the answer to be streamed."""
+    workflow = StateGraph(GraphState)
 
-workflow.add_edge("context_dependent_conversation", "retrieve_topics_filters")
-workflow.add_edge("context_dependent_conversation", "retrieve_date_filters")
+    workflow.add_edge(START, 'prepare_conversation')
+    workflow.add_node('prepare_conversation', prepare_conversation)
+    workflow.add_conditional_edges('prepare_conversation', determine_conversation_type, {
+        'no_context_conversation': 'no_context_conversation' if answer else END,
+        'retrieve_topics_filters': 'retrieve_topics_filters',
+        'query_vectors': 'query_vectors',
+    })
 
-workflow.add_node("retrieve_topics_filters", retrieve_topics_filters)
-workflow.add_node("retrieve_date_filters", retrieve_date_filters)
+    workflow.add_node("retrieve_topics_filters", retrieve_topics_filters)
+    workflow.add_edge('retrieve_topics_filters', 'query_vectors')
 
-workflow.add_edge('retrieve_topics_filters', 'query_vectors')
-workflow.add_edge('retrieve_date_filters', 'query_vectors')
+    workflow.add_node('query_vectors', query_vectors)
 
-workflow.add_node('query_vectors', query_vectors)
+    if answer:
+        workflow.add_node("no_context_conversation", no_context_conversation)
+        workflow.add_edge("no_context_conversation", END)
 
-workflow.add_edge('query_vectors', 'qa_handler')
+        workflow.add_edge('query_vectors', 'qa_handler')
+        workflow.add_node('qa_handler', qa_handler)
+        workflow.add_edge('qa_handler', END)
+    else:
+        workflow.add_edge('query_vectors', END)
 
-workflow.add_node('qa_handler', qa_handler)
+    # turns share nothing through the graph state, they did through a checkpointer thread, which kept every turn in
+    # memory
+    return workflow.compile()
 
-workflow.add_edge('qa_handler', END)
 
-checkpointer = MemorySaver()
-graph = workflow.compile(checkpointer=checkpointer)
+graph = _compile(answer=True)
+retrieval_graph = _compile(answer=False)
 
 
 @timeit
 def execute_graph_chat(uid: str, messages: List[Message]) -> Tuple[str, List[Memory]]:
-    result = graph.invoke({'uid': uid, 'messages': messages}, {"configurable": {"thread_id": str(uuid.uuid4())}})
+    start = time.time()
+    with llm_priority(LLMPriority.interactive, uid):
+        result = graph.invoke({'uid': uid, 'messages': messages})
+    metrics.observe('chat_seconds', time.time() - start)
     return result.get('answer'), result.get('memories_found', [])
 
 
+def execute_graph_chat_stream(uid: str, messages: List[Message]) -> Generator[dict, None, None]:
+    """
+    Events of a chat turn: {'type': 'progress', 'step': node} as the retrieval goes, {'type': 'memories', 'memories':
+    [...]}, then {'type': 'delta', 'text': ...} for each piece of the answer. Consume it from a single thread.
+    """
+    start = time.time()
+    with llm_priority(LLMPriority.interactive, uid):
+        state: GraphState = {'uid': uid, 'messages': messages}
+        for update in retrieval_graph.stream(state, stream_mode='updates'):
+            for node, values in update.items():
+                state.update(values or {})
+                yield {'type': 'progress', 'step': node}
+
+        memories = state.get('memories_found') or []
+        yield {'type': 'memories', 'memories': memories}
+        if state.get('requires_context'):
+            answer = qa_rag_stream(
+                uid, state.get('parsed_question'), Memory.memories_to_string(memories, True),
+                state.get('plugin_selected')
+            )
+        else:
+            answer = answer_simple_message_stream(uid, messages)
+
+        first = True
+        for delta in answer:
+            if first:
+                metrics.observe('chat_first_token_seconds', time.time() - start)
+                first = False
+            yield {'type': 'delta', 'text': delta}
+    metrics.observe('chat_seconds', time.time() - start)
+
+
 def _pretty_print_conversation(messages: List[Message]):
     for msg in messages:
         print(f'{msg.sender}: {msg.text}')
@@ -192,6 +332,6 @@ if __name__ == '__main__':
     # _send_message('Check again, Im pretty sure I had some')
     # raise Exception()
     start_time = time.time()
-    result = graph.invoke({'uid': uid, 'messages': messages}, {"configurable": {"thread_id": "foo"}})
+    result = graph.invoke({'uid': uid, 'messages': messages})
     print('result:', result.get('answer'))
     print('time:', time.time() - start_time)
@@ -0,0 +1,253 @@
+import asyncio
+import os
+import time
+from typing import Callable, List, Optional
+
+from utils.other import metrics
+from utils.stt.session import AudioTail
+from utils.stt.speech_gate import SpeechGate
+from utils.stt.streaming import process_audio_dg, process_audio_soniox, process_audio_speechmatics, \
+    soniox_valid_languages
+
+# Providers in order of preference for STTService.auto
+router_providers = os.getenv('STT_ROUTER_PROVIDERS', 'soniox,deepgram').split(',')
+# Seconds both providers get the audio, the first one returning words is kept.
+hedge_seconds = float(os.getenv('STT_HEDGE_SECONDS', 5))
+# Seconds of speech sent without a segment back before switching provider.
+stall_seconds = float(os.getenv('STT_STALL_SECONDS', 20))
+
+
+class ProviderStream:
+    """A provider socket with the same interface for all providers, its segments are in the provider timeline."""
+
+    def __init__(self, provider: str, socket):
+        self.provider = provider
+        self.socket = socket
+        self.opened_at = time.time()
+        self.first_segment_at = None
+        self.failed = False
+
+    @property
+    def alive(self) -> bool:
+        if self.failed:
+            return False
+        if self.provider == 'deepgram':
+            return not self.socket.closed
+        return self.socket.open
+
+    async def send(self, data):
+        try:
+            if self.provider == 'deepgram':
+                self.socket.send(data)
+            else:
+                await self.socket.send(data)
+        except Exception as e:
+            print(f'ProviderStream {self.provider} send failed: {e}')
+            self.failed = True
+
+    async def close(self):
+        try:
+            if self.provider == 'deepgram':
+                await asyncio.get_running_loop().run_in_executor(None, self.socket.finish)
+            else:
+                await self.socket.close()
+        except Exception as e:
+            print(f'ProviderStream {self.provider} close failed: {e}')
+
+
+async def open_provider_stream(provider: str, on_segments: Callable, language: str, sample_rate: int,
+                               uid: Optional[str] = None) -> ProviderStream:
+    if provider == 'deepgram':
+        socket = await process_audio_dg(on_segments, language, sample_rate, 1)
+    elif provider == 'soniox':
+        socket = await process_audio_soniox(on_segments, sample_rate, language, uid)
+    elif provider == 'speechmatics':
+        socket = await process_audio_speechmatics(on_segments, sample_rate, language)
+    else:
+        raise ValueError(f'Unsupported STT provider {provider}')
+    return ProviderStream(provider, socket)
+
+
+class STTProviderRouter:
+    """
+    Sends a session audio to one of several STT providers, and switches between them without the client noticing.
+
+    - Hedged start: the first `hedge_seconds` of audio go to the first two providers, the first one returning
+      words is kept and the other closed.
+    - Failover: if the active provider closes, fails, or returns nothing for `stall_seconds` of speech, the next
+      provider is opened and the audio after the last segment received is replayed into it.
+
+    Segments are forwarded to `stream_transcript` in the router timeline, seconds of audio since the session
+    started, so timestamps keep growing across provider switches.
+    """
+
+    def __init__(self, stream_transcript: Callable[[List[dict]], None], language: str, sample_rate: int,
+                 uid: Optional[str] = None, providers: Optional[List[str]] = None):
+        providers = providers or router_providers
+        if language not in soniox_valid_languages:
+            providers = [p for p in providers if p != 'soniox']
+        self.providers = providers
+        self.stream_transcript = stream_transcript
+        self.language = language
+        self.sample_rate = sample_rate
+        self.uid = uid
+
+        self.audio_tail = AudioTail(sample_rate)
+        self.candidates: List[ProviderStream] = []
+        self.active: Optional[ProviderStream] = None
+        self.offset = 0  # router timeline second of the active provider time 0
+        self.acked_seconds = 0  # router timeline end of the last segment forwarded
+        # silence is expected to return nothing, only speech counts towards a stall
+        self.speech_gate = SpeechGate(sample_rate, backend='energy')
+        self.speech_seconds = 0
+        self.last_segment_speech_seconds = 0
+        self.started_at = None
+        self.closed = False
+        self._loop = None
+        self._watchdog_task = None
+        self._replay_buffer: Optional[List[bytes]] = None  # live audio held while the tail is replayed
+
+    def _log(self, decision: str, provider: str, **kwargs):
+        print('STTProviderRouter', decision, provider, kwargs)
+        metrics.incr(f'stt_router_{decision}:{provider}')
+
+    def _segments_callback(self, stream_getter: Callable[[], ProviderStream]):
+        # called from the provider SDK threads (deepgram) or tasks, handled on the loop
+        def on_segments(segments):
+            self._loop.call_soon_threadsafe(self._on_segments, stream_getter(), segments)
+
+        return on_segments
+
+    async def _open(self, provider: str) -> ProviderStream:
+        holder = []
+        stream = await open_provider_stream(
+            provider, self._segments_callback(lambda: holder[0]), self.language, self.sample_rate, self.uid
+        )
+        holder.append(stream)
+        return stream
+
+    async def start(self):
+        self._loop = asyncio.get_running_loop()
+        self.started_at = time.time()
+        hedged = self.providers[:2]
+        results = await asyncio.gather(*[self._open(p) for p in hedged], return_exceptions=True)
+        for provider, result in zip(hedged, results):
+            if isinstance(result, Exception):
+                self._log('start_failed', provider, error=str(result))
+            else:
+                self.candidates.append(result)
+        if not self.candidates:
+            raise Exception(f'Could not open socket: all providers failed {hedged}')
+        if len(self.candidates) == 1:
+            self.active = self.candidates[0]
+            self._log('start', self.active.provider)
+        self._watchdog_task = asyncio.create_task(self._watchdog())
+
+    async def _choose(self, stream: ProviderStream, reason: str):
+        self.active = stream
+        losers = [c for c in self.candidates if c is not stream]
+        self.candidates = [stream]
+        latency = stream.first_segment_at - stream.opened_at if stream.first_segment_at else None
+        self._log('hedge_won', stream.provider, reason=reason, first_segment_seconds=latency,
+                  losers=[c.provider for c in losers])
+        if latency is not None:
+            metrics.observe(f'stt_router_first_segment_seconds:{stream.provider}', latency)
+        for loser in losers:
+            await loser.close()
+
+    def _on_segments(self, stream: ProviderStream, segments: List[dict]):
+        if self.closed or not segments:
+            return
+        if stream.first_segment_at is None:
+            stream.first_segment_at = time.time()
+        if self.active is None:
+            if stream not in self.candidates:
+                return
+            asyncio.create_task(self._choose(stream, 'first_segment'))
+            self.active = stream
+        if stream is not self.active:
+            return
+
+        for segment in segments:
+            segment['start'] += self.offset
+            segment['end'] += self.offset
+        self.acked_seconds = max(self.acked_seconds, segments[-1]['end'])
+        self.last_segment_speech_seconds = self.speech_seconds
+        self.stream_transcript(segments)
+
+    async def send(self, data):
+        self.audio_tail.append(data)
+        if self.speech_gate.process(data):
+            self.speech_seconds += len(data) / self.audio_tail.bytes_per_second
+        if self._replay_buffer is not None:
+            self._replay_buffer.append(data)
+            return
+        streams = self.candidates if self.active is None else [self.active]
+        for stream in streams:
+            await stream.send(data)
+
+    async def _watchdog(self):
+        while not self.closed:
+            await asyncio.sleep(0.5)
+            try:
+                if self.active is None:
+                    alive = [c for c in self.candidates if c.alive]
+                    if time.time() - self.started_at >= hedge_seconds or len(alive) < len(self.candidates):
+                        if alive:
+                            await self._choose(alive[0], 'hedge_timeout')
+                        else:
+                            await self._failover('error')
+                    continue
+
+                if not self.active.alive:
+                    await self._failover('error')
+                elif self.speech_seconds - self.last_segment_speech_seconds >= stall_seconds:
+                    await self._failover('stall')
+            except Exception as e:
+                print(f'STTProviderRouter watchdog error: {e}')
+
+    async def _failover(self, reason: str):
+        previous = self.active or (self.candidates[0] if self.candidates else None)
+        previous_provider = previous.provider if previous else None
+        order = self.providers[self.providers.index(previous_provider) + 1:] + self.providers \
+            if previous_provider in self.providers else self.providers
+        next_providers = [p for p in dict.fromkeys(order) if p != previous_provider] or [previous_provider]
+
+        for provider in next_providers:
+            try:
+                stream = await self._open(provider)
+            except Exception as e:
+                self._log('failover_failed', provider, error=str(e))
+                continue
+
+            # the new provider time 0 is the end of the last segment received, or the oldest audio still kept
+            start, tail = self.audio_tail.tail(self.acked_seconds)
+            self.offset = start
+            self.last_segment_speech_seconds = self.speech_seconds
+            self.active, self.candidates = stream, [stream]
+            self._log('failover', provider, reason=reason, previous=previous_provider,
+                      replayed_seconds=len(tail) / self.audio_tail.bytes_per_second,
+                      dropped_seconds=max(start - self.acked_seconds, 0))
+            # the live audio received meanwhile is sent after the tail, in order, sends can yield to it
+            self._replay_buffer = []
+            try:
+                chunk_size = self.audio_tail.bytes_per_second // 2
+                for i in range(0, len(tail), chunk_size):
+                    await stream.send(tail[i:i + chunk_size])
+                while self._replay_buffer:
+                    await stream.send(self._replay_buffer.pop(0))
+            finally:
+                self._replay_buffer = None
+            if previous:
+                await previous.close()
+            return
+
+        # nothing to switch to, try again on the next watchdog tick
+        self.last_segment_speech_seconds = self.speech_seconds
+
+    async def close(self):
+        self.closed = True
+        if self._watchdog_task:
+            self._watchdog_task.cancel()
+        for stream in self.candidates:
+            await stream.close()
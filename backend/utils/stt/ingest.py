@@ -0,0 +1,96 @@
+import asyncio
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Awaitable, Callable, List, Optional
+
+from utils.other import metrics
+
+# Blocking persistence (Firestore, Redis) of the streaming sessions runs here, never on the event loop.
+persistence_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv('STT_PERSISTENCE_WORKERS', 8)), thread_name_prefix='stt-persistence'
+)
+
+ingest_queue_max_size = int(os.getenv('STT_INGEST_QUEUE_MAX_SIZE', 200))
+
+
+def _running_loop() -> Optional[asyncio.AbstractEventLoop]:
+    try:
+        return asyncio.get_running_loop()
+    except RuntimeError:
+        return None
+
+
+class TranscriptIngestQueue:
+    """
+    Single consumer queue of normalized segments for one /v2/listen session.
+
+    Every STT provider pushes into it through `push`, from the event loop (Soniox, Speechmatics)
+    or from the SDK threads (Deepgram). Segments are handled in order by `run`, so a slow handler only
+    delays that session, and when the queue is full the oldest batch is dropped instead of growing unbounded.
+    """
+
+    def __init__(
+            self, loop: asyncio.AbstractEventLoop, handler: Callable[[List[dict]], Awaitable[None]],
+            max_size: int = ingest_queue_max_size,
+    ):
+        self.loop = loop
+        self.handler = handler
+        self.max_size = max_size
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.dropped = 0
+        self.processed = 0
+        self.max_depth = 0
+        self._closed = False
+        metrics.gauge_add('stt_ingest_sessions', 1)
+
+    def push(self, segments: List[dict]):
+        if self._closed or not segments:
+            return
+        item = (time.time(), segments)
+        if _running_loop() is self.loop:
+            self._put(item)
+        else:
+            self.loop.call_soon_threadsafe(self._put, item)
+
+    def _put(self, item):
+        if self._closed:
+            return
+        while self.queue.qsize() >= self.max_size:
+            self.queue.get_nowait()
+            self.queue.task_done()
+            self.dropped += 1
+            metrics.incr('stt_ingest_dropped')
+        self.queue.put_nowait(item)
+        depth = self.queue.qsize()
+        self.max_depth = max(self.max_depth, depth)
+        metrics.observe('stt_ingest_queue_depth', depth)
+
+    async def run(self):
+        while True:
+            item = await self.queue.get()
+            try:
+                if item is None:
+                    break
+                enqueued_at, segments = item
+                metrics.observe('stt_ingest_lag_seconds', time.time() - enqueued_at)
+                try:
+                    with metrics.timer('stt_ingest_handler_seconds'):
+                        await self.handler(segments)
+                except Exception as e:
+                    print(f'TranscriptIngestQueue handler failed: {e}')
+                    metrics.incr('stt_ingest_errors')
+                self.processed += 1
+                metrics.incr('stt_ingest_processed')
+            finally:
+                self.queue.task_done()
+
+    def close(self):
+        """Stops `run` after the segments already queued are handled."""
+        if self._closed:
+            return
+        self._closed = True
+        self.queue.put_nowait(None)
+        metrics.gauge_add('stt_ingest_sessions', -1)
+        print('TranscriptIngestQueue closed', 'processed:', self.processed, 'dropped:', self.dropped,
+              'max_depth:', self.max_depth)
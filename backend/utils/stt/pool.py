@@ -0,0 +1,185 @@
+import asyncio
+import inspect
+import os
+import random
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Dict, Tuple
+
+from utils.other import metrics
+
+# Most warm sockets kept per (provider, language, sample_rate), 0 disables the pool.
+pool_size = int(os.getenv('STT_POOL_SIZE', 2))
+# Providers drop sockets that don't get audio or config for a while, don't hand out older ones.
+pool_max_idle_seconds = float(os.getenv('STT_POOL_MAX_IDLE_SECONDS', 8))
+# Sessions opened for a key in this long set how many sockets it keeps warm, none once nobody asked for it.
+pool_key_ttl_seconds = float(os.getenv('STT_POOL_KEY_TTL_SECONDS', 300))
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker:
+    """
+    Stops calling a provider after `failure_threshold` consecutive connect failures, for `reset_timeout` seconds,
+    then lets a single attempt through to check if it's back.
+    """
+
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout: float = 30):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+
+    def allow(self) -> bool:
+        if self.opened_at is None:
+            return True
+        if time.time() - self.opened_at >= self.reset_timeout and not self._probing:
+            self._probing = True  # half open
+            return True
+        return False
+
+    def success(self):
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+
+    def failure(self):
+        self.failures += 1
+        self._probing = False
+        if self.failures >= self.failure_threshold:
+            if self.opened_at is None:
+                print(f'CircuitBreaker {self.name} opened after {self.failures} failures')
+                metrics.incr(f'stt_circuit_opened:{self.name}')
+            self.opened_at = time.time()
+
+
+def calculate_backoff_with_jitter(attempt, base_delay=1000, max_delay=32000):
+    jitter = random.random() * base_delay
+    backoff = min(((2 ** attempt) * base_delay) + jitter, max_delay)
+    return backoff
+
+
+_breakers: Dict[str, CircuitBreaker] = {}
+
+
+def get_circuit_breaker(provider: str) -> CircuitBreaker:
+    if provider not in _breakers:
+        _breakers[provider] = CircuitBreaker(provider)
+    return _breakers[provider]
+
+
+async def connect_with_backoff(provider: str, connect: Callable[[], Awaitable[Any]], retries: int = 3):
+    breaker = get_circuit_breaker(provider)
+    for attempt in range(retries):
+        if not breaker.allow():
+            raise CircuitOpenError(f'Could not open socket: {provider} circuit is open')
+        start = time.time()
+        try:
+            socket = await connect()
+            metrics.observe(f'stt_connect_seconds:{provider}', time.time() - start)
+            breaker.success()
+            return socket
+        except Exception as error:
+            print(f'An error occurred connecting to {provider}: {error}')
+            metrics.incr(f'stt_connect_errors:{provider}')
+            breaker.failure()
+            if attempt == retries - 1:  # Last attempt
+                raise
+        backoff_delay = calculate_backoff_with_jitter(attempt)
+        print(f"Waiting {backoff_delay:.0f}ms before next retry...")
+        await asyncio.sleep(backoff_delay / 1000)
+
+    raise Exception(f'Could not open socket: All retry attempts failed.')
+
+
+async def _maybe_await(result):
+    if inspect.isawaitable(result):
+        await result
+
+
+class STTConnectionPool:
+    """
+    Keeps a few connected provider sockets per (provider, language, sample_rate), to hand to sessions on demand.
+
+    Sockets are connected and authenticated, but not configured for a session yet, that's done by the caller after
+    `acquire`. Every socket opened is a provider connection, so a key only keeps as many as the sessions expected in
+    the next `max_idle` seconds, from the ones opened in the last `key_ttl`, up to `size`. A key with less than one
+    session every two `max_idle` keeps none, its sessions connect when they start, as without the pool.
+    """
+
+    def __init__(self, size: int = pool_size, max_idle: float = pool_max_idle_seconds,
+                 key_ttl: float = pool_key_ttl_seconds):
+        self.size = size
+        self.max_idle = max_idle
+        self.key_ttl = key_ttl
+        self._idle: Dict[Tuple, deque] = {}
+        self._acquired: Dict[Tuple, deque] = {}
+        self._warming: Dict[Tuple, asyncio.Task] = {}
+
+    def _target(self, key: Tuple) -> int:
+        acquired = self._acquired.get(key)
+        if not acquired:
+            return 0
+        while acquired and time.time() - acquired[0] >= self.key_ttl:
+            acquired.popleft()
+        expected = len(acquired) * self.max_idle / self.key_ttl
+        return min(self.size, int(expected + 0.5))
+
+    async def acquire(
+            self, key: Tuple, connect: Callable[[], Awaitable[Any]],
+            is_alive: Callable[[Any], bool], close: Callable[[Any], Any],
+    ):
+        provider = key[0]
+        if self.size <= 0:
+            return await connect_with_backoff(provider, connect)
+        self._acquired.setdefault(key, deque()).append(time.time())
+
+        idle = self._idle.setdefault(key, deque())
+        while idle:
+            created_at, socket = idle.popleft()
+            if time.time() - created_at < self.max_idle and is_alive(socket):
+                metrics.incr(f'stt_pool_hit:{provider}')
+                self._warm(key, connect, is_alive, close)
+                return socket
+            asyncio.create_task(_maybe_await(close(socket)))
+
+        metrics.incr(f'stt_pool_miss:{provider}')
+        self._warm(key, connect, is_alive, close)
+        return await connect_with_backoff(provider, connect)
+
+    def _warm(self, key, connect, is_alive, close):
+        task = self._warming.get(key)
+        if task is None or task.done():
+            self._warming[key] = asyncio.create_task(self._keep_warm(key, connect, is_alive, close))
+
+    async def _keep_warm(self, key, connect, is_alive, close):
+        provider = key[0]
+        idle = self._idle.setdefault(key, deque())
+        while (target := self._target(key)) or idle:
+            # sockets are only replaced once they can't be handed out anymore, and only if still expected to be used
+            while idle and (len(idle) > target or time.time() - idle[0][0] >= self.max_idle
+                            or not is_alive(idle[0][1])):
+                _, socket = idle.popleft()
+                metrics.incr(f'stt_pool_expired:{provider}')
+                await _maybe_await(close(socket))
+
+            if len(idle) < target and get_circuit_breaker(provider).opened_at is None:
+                try:
+                    socket = await connect_with_backoff(provider, connect, retries=1)
+                    metrics.incr(f'stt_pool_warmed:{provider}')
+                    idle.append((time.time(), socket))
+                    continue
+                except Exception as e:
+                    print(f'STTConnectionPool could not warm {key}: {e}')
+            await asyncio.sleep(1)
+
+        if not self._acquired.get(key):
+            self._acquired.pop(key, None)
+        self._warming.pop(key, None)
+
+
+stt_pool = STTConnectionPool()
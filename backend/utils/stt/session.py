@@ -0,0 +1,101 @@
+import os
+import uuid
+from typing import Optional, Tuple
+
+from database import redis_db
+
+# Seconds of audio kept per session to be replayed into the new STT socket when the client resumes.
+resume_audio_seconds = int(os.getenv('LISTEN_SESSION_RESUME_AUDIO_SECONDS', 30))
+
+
+class AudioTail:
+    """
+    Bounded ring of the pcm16 audio sent to the STT provider in a session.
+
+    Positions are seconds in the provider timeline, that is, seconds of audio sent so far, which is also
+    what the provider timestamps segments with.
+    """
+
+    def __init__(self, sample_rate: int, max_seconds: int = resume_audio_seconds):
+        self.bytes_per_second = sample_rate * 2
+        self._buffer = bytearray(self.bytes_per_second * max_seconds)
+        self._view = memoryview(self._buffer)
+        self.total_bytes = 0
+
+    @property
+    def seconds(self) -> float:
+        return self.total_bytes / self.bytes_per_second
+
+    def append(self, data):
+        data = memoryview(data).cast('B')
+        capacity = len(self._buffer)
+        if len(data) >= capacity:
+            self.total_bytes += len(data) - capacity
+            data = data[-capacity:]
+
+        offset = self.total_bytes % capacity
+        first = min(len(data), capacity - offset)
+        self._view[offset:offset + first] = data[:first]
+        if first < len(data):
+            self._view[:len(data) - first] = data[first:]
+        self.total_bytes += len(data)
+
+    def tail(self, from_seconds: float) -> Tuple[float, bytes]:
+        """
+        Audio from `from_seconds` until now, or as much of it as is still in the ring, with the second it actually
+        starts at, later than `from_seconds` when the start was already dropped.
+        """
+        capacity = len(self._buffer)
+        start = int(from_seconds * self.bytes_per_second)
+        start -= start % 2
+        start = max(start, self.total_bytes - capacity, 0)
+        if start >= self.total_bytes:
+            return self.seconds, b''
+
+        offset, end = start % capacity, self.total_bytes % capacity or capacity
+        if offset < end:
+            return start / self.bytes_per_second, bytes(self._view[offset:end])
+        return start / self.bytes_per_second, bytes(self._view[offset:]) + bytes(self._view[:end])
+
+
+def new_session_token() -> str:
+    return str(uuid.uuid4())
+
+
+def save_session_checkpoint(
+        session_token: str, uid: str, sample_rate: int, memory_id: Optional[str], seconds_to_shift: Optional[float],
+        acked_seconds: float, audio_tail: AudioTail, ttl: int,
+):
+    """
+    Stores where the session was, so a reconnection with the same token continues it.
+
+    `acked_seconds` is the provider time of the end of the last segment received, the audio after it has not been
+    transcribed yet and is stored to be replayed. `seconds_to_shift` moves provider times to the memory timeline.
+    Provider times must be `audio_tail` times, sessions with a speech profile preamble are not checkpointed.
+    """
+    # later than acked_seconds if the ring no longer has all the audio since
+    start, audio = audio_tail.tail(acked_seconds)
+    if start > acked_seconds:
+        print('save_session_checkpoint dropped', start - acked_seconds, 'seconds', session_token)
+    checkpoint = {
+        'uid': uid,
+        'sample_rate': sample_rate,
+        'memory_id': memory_id,
+        # memory timeline seconds of the first replayed audio byte
+        'seconds_to_add': seconds_to_shift + start if seconds_to_shift is not None else None,
+        'audio_seconds': len(audio) / audio_tail.bytes_per_second,
+    }
+    print('save_session_checkpoint', session_token, checkpoint)
+    redis_db.set_listen_session_checkpoint(session_token, checkpoint, audio, ttl)
+
+
+def get_session_checkpoint(session_token: str, uid: str, sample_rate: int):
+    """Returns the checkpoint and audio to replay, once, if the token belongs to this user and stream format."""
+    result = redis_db.get_listen_session_checkpoint(session_token)
+    if not result:
+        return None, b''
+    checkpoint, audio = result
+    if checkpoint['uid'] != uid or checkpoint['sample_rate'] != sample_rate:
+        return None, b''
+    redis_db.remove_listen_session_checkpoint(session_token)
+    return checkpoint, audio
@@ -0,0 +1,121 @@
+import os
+
+import numpy as np
+
+# webrtcvad only accepts frames of 10, 20 or 30 ms.
+FRAME_MS = 10
+
+
+class SpeechGate:
+    """
+    Decides which audio packets of a session are worth sending to the STT provider.
+
+    Packets are split into 10 ms frames without copying, the bytes of an incomplete trailing frame are
+    carried over to the next packet instead of being padded with silence. Frames are classified by a
+    vectorized energy / zero crossing rate pre-filter, and by webrtcvad for those that are not obvious silence.
+
+    The gate opens after `attack_frames` consecutive speech frames and stays open for `hangover_ms` after the
+    last one, so short pauses inside speech are kept, and isolated speech frames do not open it.
+    """
+
+    def __init__(
+            self, sample_rate: int, backend: str = 'webrtcvad', mode: int = 1, hangover_ms: int = 300,
+            attack_frames: int = 2, energy_threshold: float = 80.0, zcr_threshold: float = 0.4,
+    ):
+        if backend not in ('webrtcvad', 'energy'):
+            raise ValueError(f'Unsupported speech gate backend {backend}')
+
+        self.sample_rate = sample_rate
+        self.backend = backend
+        self.frame_samples = sample_rate * FRAME_MS // 1000
+        self.frame_bytes = self.frame_samples * 2  # pcm16
+        self.hangover_frames = max(1, hangover_ms // FRAME_MS)
+        self.attack_frames = max(1, attack_frames)
+        self.energy_threshold = energy_threshold
+        self.zcr_threshold = zcr_threshold
+
+        self.vad = None
+        if backend == 'webrtcvad':
+            import webrtcvad
+            self.vad = webrtcvad.Vad()
+            self.vad.set_mode(mode)
+
+        self._carry = bytearray(self.frame_bytes)
+        self._carry_len = 0
+        self._speech_run = 0
+        self._hangover = 0
+
+    @property
+    def is_open(self) -> bool:
+        return self._hangover > 0
+
+    def _classify(self, frames: np.ndarray, raw: memoryview) -> np.ndarray:
+        samples = frames.astype(np.float32)
+        rms = np.sqrt(np.mean(samples * samples, axis=1))
+        signs = np.signbit(frames)
+        zcr = np.count_nonzero(signs[:, 1:] != signs[:, :-1], axis=1) / (self.frame_samples - 1)
+
+        # Quiet frames are silence, whatever the backend, no need to run the model on them.
+        candidates = rms >= self.energy_threshold
+        if self.vad is None:
+            # Noise (hiss, wind) is loud but crosses zero far more often than voiced speech.
+            return candidates & (zcr < self.zcr_threshold)
+
+        result = np.zeros(len(frames), dtype=bool)
+        for i in np.flatnonzero(candidates):
+            start = i * self.frame_bytes
+            result[i] = self.vad.is_speech(raw[start:start + self.frame_bytes], self.sample_rate)
+        return result
+
+    def _update(self, is_speech: np.ndarray) -> bool:
+        opened = False
+        for speech in is_speech:
+            if speech:
+                self._speech_run += 1
+                if self._speech_run >= self.attack_frames or self._hangover > 0:
+                    self._hangover = self.hangover_frames
+            else:
+                self._speech_run = 0
+                if self._hangover > 0:
+                    self._hangover -= 1
+            opened = opened or self._hangover > 0
+        return opened
+
+    def process(self, data) -> bool:
+        """Returns True if the packet has speech, or falls within the hangover of previous speech."""
+        data = memoryview(data).cast('B')
+        opened = False
+
+        # Complete the frame left over from the previous packet.
+        if self._carry_len:
+            needed = self.frame_bytes - self._carry_len
+            taken = min(needed, len(data))
+            self._carry[self._carry_len:self._carry_len + taken] = data[:taken]
+            self._carry_len += taken
+            data = data[taken:]
+            if self._carry_len < self.frame_bytes:
+                return self.is_open
+            carry = memoryview(self._carry)
+            frame = np.frombuffer(carry, dtype=np.int16).reshape(1, self.frame_samples)
+            opened = self._update(self._classify(frame, carry))
+            self._carry_len = 0
+
+        n_frames = len(data) // self.frame_bytes
+        if n_frames:
+            raw = data[:n_frames * self.frame_bytes]
+            frames = np.frombuffer(raw, dtype=np.int16).reshape(n_frames, self.frame_samples)
+            opened = self._update(self._classify(frames, raw)) or opened
+
+        remainder = len(data) - n_frames * self.frame_bytes
+        if remainder:
+            self._carry[:remainder] = data[n_frames * self.frame_bytes:]
+            self._carry_len = remainder
+        return opened or self.is_open
+
+
+def get_speech_gate(sample_rate: int) -> SpeechGate:
+    return SpeechGate(
+        sample_rate,
+        backend=os.getenv('SPEECH_GATE_BACKEND', 'webrtcvad'),
+        hangover_ms=int(os.getenv('SPEECH_GATE_HANGOVER_MS', 300)),
+    )
@@ -1,12 +1,13 @@
 import json
 import os
-from typing import List
+import tempfile
+from typing import List, Optional, Tuple
 
 import requests
 from pydub import AudioSegment
 
 from utils.other.storage import get_profile_audio_if_exists, get_additional_profile_recordings, get_user_people_ids, \
-    get_user_person_speech_samples
+    get_user_person_speech_samples, get_profile_audio_generation, download_profile_audio
 
 
 def get_speech_profile_matching_predictions(uid: str, audio_file_path: str, segments: List) -> List[dict]:
@@ -36,6 +37,81 @@ def get_speech_profile_matching_predictions(uid: str, audio_file_path: str, segm
         return default
 
 
+def get_speech_profile_pcm(uid: str) -> Tuple[Optional[str], float, int]:
+    """
+    Returns the path to the user speech profile as raw pcm16 mono, its duration, and sample rate.
+
+    Files are cached in `_speech_profiles/{uid}/{generation}.pcm` with a json sidecar, a new upload has a new GCS
+    generation, so a cached file is never stale, and only the first connection after an upload downloads it.
+    """
+    generation = get_profile_audio_generation(uid)
+    if not generation:
+        return None, 0, 0
+
+    directory = f'_speech_profiles/{uid}'
+    pcm_path = f'{directory}/{generation}.pcm'
+    sidecar_path = f'{directory}/{generation}.json'
+    if sidecar := _read_sidecar(sidecar_path):
+        return pcm_path, sidecar['duration'], sidecar['sample_rate']
+
+    # connections right after an upload may all get here, each works on its own temporary files, named after the
+    # generation so the cleanup of another one leaves them alone
+    os.makedirs(directory, exist_ok=True)
+    wav_path = _temp_path(directory, generation, '.wav')
+    pcm_tmp_path = _temp_path(directory, generation, '.pcm')
+    sidecar_tmp_path = _temp_path(directory, generation, '.json')
+    try:
+        try:
+            download_profile_audio(uid, generation, wav_path)
+        except Exception as e:
+            print('get_speech_profile_pcm', uid, generation, e)
+            return None, 0, 0
+
+        # another connection finished while this one was downloading
+        if sidecar := _read_sidecar(sidecar_path):
+            return pcm_path, sidecar['duration'], sidecar['sample_rate']
+
+        aseg = AudioSegment.from_wav(wav_path).set_channels(1).set_sample_width(2)
+        with open(pcm_tmp_path, 'wb') as f:
+            f.write(aseg.raw_data)
+        os.replace(pcm_tmp_path, pcm_path)
+        sidecar = {'duration': aseg.duration_seconds, 'sample_rate': aseg.frame_rate, 'generation': generation}
+        with open(sidecar_tmp_path, 'w') as f:
+            json.dump(sidecar, f)
+        os.replace(sidecar_tmp_path, sidecar_path)
+    finally:
+        for path in [wav_path, pcm_tmp_path, sidecar_tmp_path]:
+            _remove(path)
+
+    # previous generations are not needed anymore
+    for name in os.listdir(directory):
+        if not name.startswith(f'{generation}.'):
+            _remove(os.path.join(directory, name))
+    return pcm_path, sidecar['duration'], sidecar['sample_rate']
+
+
+def _read_sidecar(path: str) -> Optional[dict]:
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def _temp_path(directory: str, generation: int, suffix: str) -> str:
+    fd, path = tempfile.mkstemp(dir=directory, prefix=f'{generation}.', suffix=f'{suffix}.tmp')
+    os.close(fd)
+    return path
+
+
+def _remove(path: str):
+    # another connection may have removed it already
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
 def get_speech_profile_expanded(uid: str):
     main = get_profile_audio_if_exists(uid, download=True)
     if not main:
@@ -1,6 +1,5 @@
 import asyncio
 import os
-import random
 import time
 from typing import List
 
@@ -8,6 +7,7 @@ import websockets
 from deepgram import DeepgramClient, DeepgramClientOptions, LiveTranscriptionEvents
 from deepgram.clients.live.v1 import LiveOptions
 
+from utils.stt.pool import stt_pool
 from utils.stt.soniox_util import *
 
 headers = {
@@ -16,20 +16,25 @@ headers = {
 }
 
 
-async def send_initial_file_path(file_path: str, transcript_socket_async_send):
-    print('send_initial_file_path')
+# Seconds of audio per message when sending the speech profile preamble. It's sent as fast as the socket takes it,
+# big messages are cheaper for both sides, but each provider has its own message size limits.
+preamble_chunk_seconds = {
+    'deepgram': 1.0,
+    'soniox': 0.5,
+    'speechmatics': 0.5,
+}
+
+
+async def send_speech_profile_preamble(
+        pcm_path: str, transcript_socket_async_send, provider: str, sample_rate: int = 16000
+):
     start = time.time()
-    # Reading and sending in chunks
-    with open(file_path, "rb") as file:
-        while True:
-            chunk = file.read(320)
-            if not chunk:
-                break
-            # print('Uploading', len(chunk))
-            await transcript_socket_async_send(bytes(chunk))
-            await asyncio.sleep(0.0001)  # if it takes too long to transcribe
+    chunk_size = int(preamble_chunk_seconds.get(provider, 0.5) * sample_rate) * 2
+    with open(pcm_path, "rb") as file:
+        while chunk := file.read(chunk_size):
+            await transcript_socket_async_send(chunk)
 
-    print('send_initial_file_path', time.time() - start)
+    print('send_speech_profile_preamble', provider, time.time() - start)
 
 
 async def send_initial_file(data: List[List[int]], transcript_socket):
@@ -45,8 +50,13 @@ async def send_initial_file(data: List[List[int]], transcript_socket):
     print('send_initial_file', time.time() - start)
 
 
+# Provider endpoints can be pointed to testing/fake_stt_provider.py
+soniox_uri = os.getenv('SONIOX_WS_URI', 'wss://api.soniox.com/transcribe-websocket')
+speechmatics_uri = os.getenv('SPEECHMATICS_WS_URI', 'wss://eu2.rt.speechmatics.com/v2')
+
 deepgram = DeepgramClient(os.getenv('DEEPGRAM_API_KEY'),
-                          DeepgramClientOptions(options={"keepalive": "true", "termination_exception_connect": "true"}))
+                          DeepgramClientOptions(url=os.getenv('DEEPGRAM_API_URL', ''),
+                                                options={"keepalive": "true", "termination_exception_connect": "true"}))
 
 
 async def process_audio_dg(
@@ -80,12 +90,12 @@ async def process_audio_dg(
                 last_segment = segments[-1]
                 if last_segment['speaker'] == f"SPEAKER_{word.speaker}":
                     last_segment['text'] += f" {word.punctuated_word}"
-                    last_segment['end'] = word.end
+                    last_segment['end'] = word.end - preseconds
                 else:
                     segments.append({
                         'speaker': f"SPEAKER_{word.speaker}",
-                        'start': word.start,
-                        'end': word.end,
+                        'start': word.start - preseconds,
+                        'end': word.end - preseconds,
                         'text': word.punctuated_word,
                         'is_user': is_user,
                         'person_id': None,
@@ -98,38 +108,59 @@ async def process_audio_dg(
         print(f"Error: {error}")
 
     print("Connecting to Deepgram")  # Log before connection attempt
-    return connect_to_deepgram_with_backoff(on_message, on_error, language, sample_rate, channels)
+    loop = asyncio.get_running_loop()
+
+    async def connect():
+        return await loop.run_in_executor(None, connect_to_deepgram, language, sample_rate, channels)
 
+    async def close(socket):
+        await loop.run_in_executor(None, socket.finish)
 
-# Calculate backoff with jitter
-def calculate_backoff_with_jitter(attempt, base_delay=1000, max_delay=32000):
-    jitter = random.random() * base_delay
-    backoff = min(((2 ** attempt) * base_delay) + jitter, max_delay)
-    return backoff
+    socket = await stt_pool.acquire(
+        ('deepgram', language, sample_rate, channels), connect, lambda socket: not socket.closed, close
+    )
+    socket.on_message, socket.on_error = on_message, on_error
+    return socket
 
 
-def connect_to_deepgram_with_backoff(on_message, on_error, language: str, sample_rate: int, channels: int, retries=3):
-    print("connect_to_deepgram_with_backoff")
-    for attempt in range(retries):
-        try:
-            return connect_to_deepgram(on_message, on_error, language, sample_rate, channels)
-        except Exception as error:
-            print(f'An error occurred: {error}')
-            if attempt == retries - 1:  # Last attempt
-                raise
-        backoff_delay = calculate_backoff_with_jitter(attempt)
-        print(f"Waiting {backoff_delay:.0f}ms before next retry...")
-        time.sleep(backoff_delay / 1000)  # Convert ms to seconds for sleep
+class DeepgramSocket:
+    """
+    Deepgram connection whose callbacks can be set after it's opened, so it can be warmed before a session uses it.
+    """
 
-    raise Exception(f'Could not open socket: All retry attempts failed.')
+    def __init__(self):
+        self.connection = None
+        self.on_message = None
+        self.on_error = None
+        self.closed = False
 
+    def _on_message(self, connection, result, **kwargs):
+        if self.on_message:
+            self.on_message(connection, result, **kwargs)
 
-def connect_to_deepgram(on_message, on_error, language: str, sample_rate: int, channels: int):
+    def _on_error(self, connection, error, **kwargs):
+        if self.on_error:
+            self.on_error(connection, error, **kwargs)
+
+    def _on_close(self, connection, close, **kwargs):
+        self.closed = True
+
+    def send(self, data):
+        return self.connection.send(data)
+
+    def finish(self):
+        self.closed = True
+        return self.connection.finish()
+
+
+def connect_to_deepgram(language: str, sample_rate: int, channels: int) -> DeepgramSocket:
     # 'wss://api.deepgram.com/v1/listen?encoding=linear16&sample_rate=8000&language=$recordingsLanguage&model=nova-2-general&no_delay=true&endpointing=100&interim_results=false&smart_format=true&diarize=true'
     try:
+        socket = DeepgramSocket()
         dg_connection = deepgram.listen.websocket.v("1")
-        dg_connection.on(LiveTranscriptionEvents.Transcript, on_message)
-        dg_connection.on(LiveTranscriptionEvents.Error, on_error)
+        dg_connection.on(LiveTranscriptionEvents.Transcript, socket._on_message)
+        dg_connection.on(LiveTranscriptionEvents.Error, socket._on_error)
+        dg_connection.on(LiveTranscriptionEvents.Close, socket._on_close)
 
         # if language == 'es': # TODO: consider it later.
         #     language = 'multi'
@@ -176,13 +207,34 @@ def connect_to_deepgram(on_message, on_error, language: str, sample_rate: int, c
         )
         result = dg_connection.start(options)
         print('Deepgram connection started:', result)
-        return dg_connection
+        if not result:
+            raise Exception('Deepgram connection did not start')
+        socket.connection = dg_connection
+        return socket
     except websockets.exceptions.WebSocketException as e:
         raise Exception(f'Could not open socket: WebSocketException {e}')
     except Exception as e:
         raise Exception(f'Could not open socket: {e}')
 
 
+def _websocket_is_open(socket) -> bool:
+    return socket.open
+
+
+async def _close_websocket(socket):
+    await socket.close()
+
+
+async def connect_to_soniox():
+    # authenticated with the initial request, sent once the socket is used by a session
+    return await websockets.connect(soniox_uri, ping_timeout=10, ping_interval=10)
+
+
+async def connect_to_speechmatics():
+    api_key = os.getenv('SPEECHMATICS_API_KEY')
+    return await websockets.connect(speechmatics_uri, extra_headers={"Authorization": f"Bearer {api_key}"})
+
+
 soniox_valid_languages = ['en']
 
 
@@ -192,8 +244,6 @@ async def process_audio_soniox(stream_transcript, sample_rate: int, language: st
     if not api_key:
         raise ValueError("API key is not set. Please set the SONIOX_API_KEY environment variable.")
 
-    uri = 'wss://api.soniox.com/transcribe-websocket'
-
     # Validate the language and construct the model name
     if language not in soniox_valid_languages:
         raise ValueError(f"Unsupported language '{language}'. Supported languages are: {soniox_valid_languages}")
@@ -236,7 +286,9 @@ async def process_audio_soniox(stream_transcript, sample_rate: int, language: st
     try:
         # Connect to Soniox WebSocket
         print("Connecting to Soniox WebSocket...")
-        soniox_socket = await websockets.connect(uri, ping_timeout=10, ping_interval=10)
+        soniox_socket = await stt_pool.acquire(
+            ('soniox', language, sample_rate), connect_to_soniox, _websocket_is_open, _close_websocket
+        )
         print("Connected to Soniox WebSocket.")
         # Send the initial request
         await soniox_socket.send(json.dumps(request))
@@ -313,9 +365,6 @@ async def process_audio_soniox(stream_transcript, sample_rate: int, language: st
 
 
 async def process_audio_speechmatics(stream_transcript, sample_rate: int, language: str, preseconds: int = 0):
-    api_key = os.getenv('SPEECHMATICS_API_KEY')
-    uri = 'wss://eu2.rt.speechmatics.com/v2'
-
     request = {
         "message": "StartRecognition",
         "transcription_config": {
@@ -339,7 +388,9 @@ async def process_audio_speechmatics(stream_transcript, sample_rate: int, langua
     }
     try:
         print("Connecting to Speechmatics WebSocket...")
-        socket = await websockets.connect(uri, extra_headers={"Authorization": f"Bearer {api_key}"})
+        socket = await stt_pool.acquire(
+            ('speechmatics', language, sample_rate), connect_to_speechmatics, _websocket_is_open, _close_websocket
+        )
         print("Connected to Speechmatics WebSocket.")
 
         await socket.send(json.dumps(request))
@@ -378,6 +429,8 @@ async def process_audio_speechmatics(stream_transcript, sample_rate: int, langua
                             if r_start < preseconds:
                                 # print('Skipping word', r_start, r_content)
                                 continue
+                            r_start -= preseconds
+                            r_end -= preseconds
                             # print(r_content, r_speaker, [r_start, r_end])
                             if not segments:
                                 segments.append({
@@ -392,7 +445,7 @@ async def process_audio_speechmatics(stream_transcript, sample_rate: int, langua
                                 last_segment = segments[-1]
                                 if last_segment['speaker'] == speaker:
                                     last_segment['text'] += f' {r_content}'
-                                    last_segment['end'] += r_end
+                                    last_segment['end'] = r_end
                                 else:
                                     segments.append({
                                         'speaker': speaker,
@@ -1,5 +1,6 @@
 import asyncio
 import json
+import os
 from datetime import datetime
 from typing import List
 
@@ -8,8 +9,15 @@ import websockets
 
 from database.redis_db import get_user_webhook_db, user_webhook_status_db, disable_user_webhook_db, \
     enable_user_webhook_db, set_user_webhook_db
+from models.job import Job, JobType
 from models.memory import Memory
 from models.users import WebhookType
+from utils.jobs import job_handler
+from utils.other.fanout import realtime_fanout
+from utils.plugins import get_realtime_targets
+
+# Seconds a developer webhook has to answer a realtime transcript request.
+realtime_webhook_deadline_seconds = float(os.getenv('REALTIME_WEBHOOK_DEADLINE_SECONDS', 15))
 
 
 def memory_created_webhook(uid, memory: Memory):
@@ -50,25 +58,27 @@ def day_summary_webhook(uid, summary: str):
         return
 
 
+@job_handler(JobType.day_summary_webhook)
+def _day_summary_webhook_job(job: Job):
+    day_summary_webhook(job.uid, job.payload['summary'])
+
+
 async def realtime_transcript_webhook(uid, segments: List[dict]):
-    toggled = user_webhook_status_db(uid, WebhookType.realtime_transcript)
-    if toggled:
-        webhook_url = get_user_webhook_db(uid, WebhookType.realtime_transcript)
-        if not webhook_url:
-            return
-        webhook_url += f'?uid={uid}'
-        try:
-            response = requests.post(
-                webhook_url,
-                json={'segments': segments, 'session_id': uid},
-                headers={'Content-Type': 'application/json'},
-                timeout=15,
-            )
-            print('realtime_transcript_webhook:', response.status_code)
-        except Exception as e:
-            print(f"Error sending realtime transcript to developer webhook: {e}")
-    else:
+    try:
+        targets = await get_realtime_targets(uid)
+    except Exception as e:
+        print(f"Error reading realtime transcript webhook: {e}")
         return
+    if not targets.webhook_url:
+        return
+
+    async def on_response(response):
+        print('realtime_transcript_webhook:', response.status_code)
+
+    realtime_fanout.submit(
+        uid, f'webhook:{WebhookType.realtime_transcript.value}', f'{targets.webhook_url}?uid={uid}', segments,
+        realtime_webhook_deadline_seconds, on_response,
+    )
 
 
 def get_audio_bytes_webhook_seconds(uid: str):
@@ -0,0 +1,61 @@
+import json
+import os
+
+import firebase_admin
+
+from modal import Image, App, Secret, Cron
+
+# handlers are registered when their modules are imported
+import utils.memories.process_memory  # noqa: F401
+import utils.other.storage  # noqa: F401
+import utils.webhooks  # noqa: F401
+from database.jobs import get_jobs_stats
+from utils.jobs import run_worker
+
+if os.environ.get('SERVICE_ACCOUNT_JSON'):
+    service_account_info = json.loads(os.environ["SERVICE_ACCOUNT_JSON"])
+    credentials = firebase_admin.credentials.Certificate(service_account_info)
+    firebase_admin.initialize_app(credentials)
+else:
+    firebase_admin.initialize_app()
+
+# Worker containers started every minute, each runs jobs for a minute, throughput is replicas * concurrency.
+job_worker_replicas = int(os.getenv('JOB_WORKER_REPLICAS', 2))
+
+modal_app = App(
+    name='worker',
+    secrets=[Secret.from_name("gcp-credentials"), Secret.from_name('envs')],
+)
+image = (
+    Image.debian_slim()
+    .apt_install('ffmpeg', 'git', 'unzip')
+    .pip_install_from_requirements('requirements.txt')
+)
+
+
+@modal_app.function(
+    image=image,
+    memory=(512, 1024),
+    cpu=2,
+    timeout=60 * 12,  # a minute of claiming, then the running jobs can take up to their lease
+)
+def jobs_worker():
+    run_worker(max_seconds=60)
+
+
+@modal_app.function(image=image, schedule=Cron('* * * * *'))
+def jobs_worker_cronjob():
+    print('jobs_worker_cronjob', get_jobs_stats())
+    for _ in range(job_worker_replicas):
+        jobs_worker.spawn()
+
+
+paths = ['_temp', '_samples', '_segments', '_speech_profiles']
+for path in paths:
+    if not os.path.exists(path):
+        os.makedirs(path)
+
+
+if __name__ == '__main__':
+    # local worker, against the REDIS_DB_* configured
+    run_worker()